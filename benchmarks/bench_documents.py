@@ -0,0 +1,95 @@
+"""Benchmark of building Solr documents for large notebooks
+
+    python -m benchmarks.bench_documents [number of cells ...]
+
+Compares ipynb_to_documents, which folds the cell documents into the notebook
+document, with the previous implementation, which converted the cells again
+for the notebook document and concatenated the fields by _add_field.
+
+"again" shares the heading levels between the cell documents as
+ipynb_to_documents did just before the folding, and "baseline" gets the
+heading levels of all cells for each cell as the original implementation.
+The recursive section lookups of the original implementation are not
+reproduced, because they exceed the recursion limit for large notebooks.
+"""
+import os
+import sys
+import time
+
+from nbsearch import solr
+
+from .corpus import generate_notebook
+
+
+def _baseline_notebook_to_solr_document(path, notebook_data, attr=None):
+    # Copy of notebook_to_solr_document before the cell documents were folded
+    notebook_id = solr.notebook_to_notebook_id(path, notebook_data)
+    _, filename = os.path.split(path)
+    doc = {
+        'id': notebook_id,
+        'filename': filename,
+    }
+    if attr is not None:
+        doc.update(attr)
+    memes = []
+    if 'cells' not in notebook_data:
+        return doc
+    execution_end_times = []
+    doc['source'] = ''
+    doc['outputs'] = ''
+    for i, cell in enumerate(notebook_data['cells']):
+        if 'metadata' in cell and 'lc_cell_meme' in cell['metadata'] and 'current' in cell['metadata']['lc_cell_meme']:
+            memes.append(cell['metadata']['lc_cell_meme']['current'])
+        fields = solr.cell_to_solr_document(notebook_id, path, cell, i)
+        for k, v in fields.items():
+            if k == 'lc_cell_meme__execution_end_time':
+                execution_end_times.append(v)
+                continue
+            if k.split('_')[0] not in ['outputs', 'source']:
+                continue
+            solr._add_field(doc, k, v)
+    doc['lc_cell_memes'] = ' '.join(memes)
+    if len(execution_end_times) > 0:
+        doc['lc_cell_meme__execution_end_time'] = sorted(execution_end_times)[-1]
+    doc['_text_'] = doc['filename'] + '\n' + doc['source'] + '\n' + doc['outputs']
+    if 'source__markdown__heading' in doc:
+        doc['source__markdown__heading_count'] = str(len(doc['source__markdown__heading'].split('\n')))
+    else:
+        doc['source__markdown__heading_count'] = '0'
+    return doc
+
+
+def convert_again(path, notebook_data, share_heading_levels=True):
+    notebook_attr = solr._get_notebook_attr(notebook_data)
+    notebook_doc = _baseline_notebook_to_solr_document(path, notebook_data, attr=notebook_attr)
+    notebook_id = solr.notebook_to_notebook_id(path, notebook_data)
+    # Without heading_levels, the heading levels of all cells are got for each cell as the original implementation
+    heading_levels = solr.get_heading_levels(notebook_data['cells']) if share_heading_levels else None
+    cell_docs = [solr.cell_to_solr_document(notebook_id, path, cell, i, cells=notebook_data['cells'],
+                                            notebook_attr=notebook_attr, heading_levels=heading_levels)
+                 for i, cell in enumerate(notebook_data['cells'])]
+    return {'jupyter-cell': cell_docs, 'jupyter-notebook': [notebook_doc]}
+
+
+def measure(func, *args, repeat=3):
+    elapsed = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        elapsed.append(time.perf_counter() - started)
+    return min(elapsed)
+
+
+def main(sizes):
+    print(f'{"cells":>8} {"fold (s)":>10} {"again (s)":>10} {"speedup":>8} {"baseline (s)":>13} {"speedup":>8}')
+    for size in sizes:
+        notebook_data = generate_notebook(0, num_cells=size)
+        folded = measure(solr.ipynb_to_documents, 'bench.ipynb', notebook_data)
+        again = measure(convert_again, 'bench.ipynb', notebook_data)
+        baseline = measure(convert_again, 'bench.ipynb', notebook_data, False)
+        print(f'{size:>8} {folded:>10.3f} {again:>10.3f} {again / folded:>7.2f}x'
+              f' {baseline:>13.3f} {baseline / folded:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100, 500, 1000])
@@ -0,0 +1,133 @@
+"""Deterministic synthetic notebooks for benchmarks
+
+The same seed and parameters always produce the same notebooks, so results
+can be compared between versions of nbsearch.
+"""
+import json
+import os
+import random
+
+
+WORDS = [
+    'data', 'model', 'train', 'loss', 'config', 'server', 'deploy', 'cluster',
+    'backup', 'network', 'storage', 'result', 'metric', 'report', 'install',
+    'ansible', 'docker', 'kernel', 'python', 'pandas', '設定', '構築', '確認',
+]
+
+
+def _sentence(rng, length):
+    return ' '.join([rng.choice(WORDS) for _ in range(length)])
+
+
+def _meme(rng):
+    return '{:08x}-{:04x}-{:04x}-{:04x}-{:012x}'.format(
+        rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(16),
+        rng.getrandbits(16), rng.getrandbits(48),
+    )
+
+
+def _markdown_cell(rng, level):
+    lines = []
+    if level > 0:
+        lines.append('#' * level + ' ' + _sentence(rng, 3) + '\n')
+    lines.append(_sentence(rng, 12) + ' **' + rng.choice(WORDS) + '**\n')
+    if rng.random() < 0.3:
+        lines.append('- [link](https://example.com/' + rng.choice(WORDS) + ') `' + rng.choice(WORDS) + '`\n')
+    if rng.random() < 0.1:
+        lines.append('#' + rng.choice(WORDS) + ' TODO\n')
+    return {'cell_type': 'markdown', 'metadata': {}, 'source': lines}
+
+
+def _code_cell(rng, output_lines, execution_count):
+    source = ['{} = {}("{}")\n'.format(rng.choice(WORDS[:15]), rng.choice(WORDS[:15]), _sentence(rng, 2))
+              for _ in range(rng.randint(1, 8))]
+    outputs = []
+    if output_lines > 0:
+        outputs.append({
+            'output_type': 'stream',
+            'name': 'stdout',
+            'text': [_sentence(rng, 8) + '\n' for _ in range(rng.randint(1, output_lines))],
+        })
+        if rng.random() < 0.3:
+            outputs.append({
+                'output_type': 'execute_result',
+                'execution_count': execution_count,
+                'metadata': {},
+                'data': {'text/plain': [_sentence(rng, 4)]},
+            })
+    return {
+        'cell_type': 'code',
+        'execution_count': execution_count,
+        'metadata': {},
+        'source': source,
+        'outputs': outputs,
+    }
+
+
+def generate_notebook(seed, num_cells=50, heading_depth=3, meme_ratio=1.0, output_lines=5):
+    """Generate a notebook
+
+    `heading_depth` is the deepest markdown heading level (0 for no headings),
+    `meme_ratio` the fraction of cells with lc_cell_meme, and `output_lines`
+    the maximum number of stdout lines of each code cell.
+    """
+    rng = random.Random(seed)
+    cells = []
+    for i in range(num_cells):
+        if heading_depth > 0 and i % 10 == 0:
+            cell = _markdown_cell(rng, rng.randint(1, heading_depth))
+        elif rng.random() < 0.2:
+            cell = _markdown_cell(rng, 0)
+        else:
+            cell = _code_cell(rng, output_lines, i + 1)
+        if rng.random() < meme_ratio:
+            cell['metadata']['lc_cell_meme'] = {'current': _meme(rng)}
+        cells.append(cell)
+    for prev, cell in zip(cells, cells[1:]):
+        prev_meme = prev['metadata'].get('lc_cell_meme')
+        meme = cell['metadata'].get('lc_cell_meme')
+        if prev_meme is not None and meme is not None:
+            prev_meme['next'] = meme['current']
+            meme['previous'] = prev_meme['current']
+    metadata = {
+        'kernelspec': {'name': 'python3', 'display_name': 'Python 3', 'language': 'python'},
+    }
+    if meme_ratio > 0:
+        metadata['lc_notebook_meme'] = {
+            'current': _meme(rng),
+            'lc_server_signature': {
+                'current': {
+                    'signature_id': '{:012x}'.format(rng.getrandbits(48)),
+                    'server_url': 'https://jupyter.example.com/',
+                    'notebook_path': '/',
+                },
+            },
+        }
+    return {'cells': cells, 'metadata': metadata, 'nbformat': 4, 'nbformat_minor': 4}
+
+
+def generate_corpus(base_dir, num_notebooks, fan_out=4, depth=2, seed=0, **kwargs):
+    """Write notebooks into a directory tree with `fan_out` subdirectories per level
+
+    Cell counts vary between notebooks around `num_cells` given in kwargs.
+    Returns the relative paths of the notebooks.
+    """
+    rng = random.Random(seed)
+    num_cells = kwargs.pop('num_cells', 50)
+    directories = ['']
+    for _ in range(depth):
+        directories = [os.path.join(d, f'dir{i}') for d in directories for i in range(fan_out)]
+    paths = []
+    for i in range(num_notebooks):
+        directory = directories[i % len(directories)]
+        os.makedirs(os.path.join(base_dir, directory), exist_ok=True)
+        path = os.path.join(directory, f'notebook{i:05d}.ipynb')
+        notebook = generate_notebook(
+            rng.getrandbits(32),
+            num_cells=max(1, int(num_cells * rng.uniform(0.5, 1.5))),
+            **kwargs
+        )
+        with open(os.path.join(base_dir, path), 'w') as f:
+            json.dump(notebook, f, ensure_ascii=False)
+        paths.append(path)
+    return paths
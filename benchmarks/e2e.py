@@ -0,0 +1,95 @@
+"""End-to-end benchmark of `jupyter nbsearch update-index`
+
+    python -m benchmarks.e2e [--notebooks N] [--cells N] [--fan-out N] [--depth N]
+                             [--solr-latency SEC] [--s3-latency SEC] [--seed N]
+
+Generates a synthetic corpus, indexes it by UpdateIndexHandler.update into
+in-process Solr and S3 stubs, and prints notebooks/s, peak RSS and the time spent in each stage as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from traitlets.config import Config
+
+from nbsearch.db import UpdateIndexHandler
+
+from .corpus import generate_corpus
+from .stubs import SolrStub, S3Stub
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+async def run(num_notebooks, num_cells=50, fan_out=4, depth=2, seed=0,
+              solr_latency=0.0, s3_latency=0.0, work_dir=None):
+    with tempfile.TemporaryDirectory(dir=work_dir) as tempdirname:
+        corpus_dir = os.path.join(tempdirname, 'corpus')
+        generate_corpus(corpus_dir, num_notebooks, fan_out=fan_out, depth=depth, seed=seed,
+                        num_cells=num_cells)
+        solr_stub = SolrStub(latency=solr_latency)
+        s3_stub = S3Stub(latency=s3_latency)
+        solr_url = solr_stub.start()
+        config_path = os.path.join(tempdirname, 'nbsearch_config.py')
+        with open(config_path, 'w') as f:
+            f.write(f'c.NBSearchDB.solr_base_url = {solr_url!r}\n')
+            f.write(f'c.LocalSource.base_dir = {corpus_dir!r}\n')
+            f.write("c.LocalSource.server = 'http://localhost:8888/'\n")
+        report_path = os.path.join(tempdirname, 'report.json')
+        try:
+            handler = UpdateIndexHandler(config=Config(), report_path=report_path)
+            started = time.perf_counter()
+            with mock.patch('nbsearch.db.aioboto3.Session', s3_stub):
+                await handler.update(config_path, 'local', None)
+            elapsed = time.perf_counter() - started
+        finally:
+            solr_stub.stop()
+        with open(report_path) as f:
+            report = json.load(f)
+        return {
+            'notebooks': num_notebooks,
+            'cells_per_notebook': num_cells,
+            'elapsed': elapsed,
+            'notebooks_per_second': num_notebooks / elapsed,
+            'solr_requests': solr_stub.requests,
+            'solr_posted_bytes': solr_stub.posted_bytes,
+            's3_uploaded_bytes': s3_stub.uploaded_bytes,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': dict([(stage, stats['total']) for stage, stats in report['stages'].items()]),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of indexing notebooks')
+    parser.add_argument('--notebooks', type=int, default=100)
+    parser.add_argument('--cells', type=int, default=50)
+    parser.add_argument('--fan-out', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--solr-latency', type=float, default=0.0)
+    parser.add_argument('--s3-latency', type=float, default=0.0)
+    args = parser.parse_args(argv)
+    result = asyncio.run(run(
+        args.notebooks, num_cells=args.cells, fan_out=args.fan_out, depth=args.depth,
+        seed=args.seed, solr_latency=args.solr_latency, s3_latency=args.s3_latency,
+    ))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""Load test of the nbsearch API against Solr and S3 stubs
+
+    python -m benchmarks.loadtest [--concurrency N] [--duration SEC] [--think-time SEC]
+                                  [--mix search=6,data=3,import=1] [--queries a,b,c]
+                                  [--solr-latency SEC] [--s3-latency SEC] [--output FILE]
+
+The API handlers run in a tornado application on a local port with the
+authentication disabled, backed by in-process Solr and S3 stubs holding a
+synthetic corpus. Workers send requests drawn from the mix, wait for the
+think time, and repeat until the duration elapses. Throughput and
+p50/p95/p99 latency per endpoint are printed as JSON, which can be saved and
+compared between versions.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import random
+import tempfile
+import time
+from unittest import mock
+from urllib.parse import quote
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+import tornado.web
+from traitlets.config import Config, Configurable
+
+from nbsearch import solr
+from nbsearch.server import get_api_handlers
+
+from .corpus import generate_notebook
+from .stubs import SolrStub, S3Stub
+
+
+ENDPOINTS = ['search', 'data', 'import']
+
+DEFAULT_QUERIES = ['data', 'model', 'server', 'pandas']
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of the sorted values"""
+    if len(sorted_values) == 0:
+        return None
+    rank = max(1, int(math.ceil(p / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    result = {}
+    for endpoint in sorted(set(latencies.keys()) | set(errors.keys())):
+        values = sorted(latencies.get(endpoint, []))
+        result[endpoint] = {
+            'requests': len(values) + errors.get(endpoint, 0),
+            'errors': errors.get(endpoint, 0),
+            'throughput': len(values) / elapsed,
+            'p50_ms': _ms(percentile(values, 50)),
+            'p95_ms': _ms(percentile(values, 95)),
+            'p99_ms': _ms(percentile(values, 99)),
+            'max_ms': _ms(values[-1] if len(values) > 0 else None),
+        }
+    return result
+
+
+def _ms(value):
+    return value * 1000 if value is not None else None
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, weight = item.split('=')
+        if name not in ENDPOINTS:
+            raise ValueError(f'Unknown endpoint: {name}')
+        mix[name] = float(weight)
+    return mix
+
+
+def _unauthenticated(handler_class):
+    return type(handler_class.__name__, (handler_class,), {
+        'get_current_user': lambda self: 'loadtest',
+        'check_xsrf_cookie': lambda self: None,
+    })
+
+
+def _populate(solr_stub, s3_stub, bucket, num_notebooks, num_cells, seed):
+    notebook_ids = []
+    for i in range(num_notebooks):
+        notebook_data = generate_notebook(seed + i, num_cells=num_cells)
+        docs = solr.ipynb_to_documents(f'notebook{i:05d}.ipynb', notebook_data, attr={
+            'server': 'http://localhost:8888/',
+            'owner': 'loadtest',
+            'mtime': '2024-01-01T00:00:00Z',
+        })
+        for core, core_docs in docs.items():
+            solr_stub.add_documents(core, core_docs)
+        notebook_id = docs['jupyter-notebook'][0]['id']
+        s3_stub.put_notebook(bucket, notebook_id, notebook_data)
+        notebook_ids.append(notebook_id)
+    return notebook_ids
+
+
+async def _worker(client, base_url, rng, mix, queries, notebook_ids, think_time, deadline,
+                  latencies, errors):
+    endpoints = list(mix.keys())
+    weights = [mix[e] for e in endpoints]
+    while time.monotonic() < deadline:
+        endpoint = rng.choices(endpoints, weights=weights)[0]
+        if endpoint == 'search':
+            target = rng.choice(['notebook', 'cell'])
+            url = f'{base_url}/v1/{target}/search?query=' + quote('_text_:' + rng.choice(queries))
+        elif endpoint == 'data':
+            url = f'{base_url}/v1/data/{quote(rng.choice(notebook_ids))}'
+        else:
+            url = f'{base_url}/v1/import/{quote(rng.choice(notebook_ids))}'
+        started = time.perf_counter()
+        response = await client.fetch(url, raise_error=False)
+        elapsed = time.perf_counter() - started
+        if response.code == 200:
+            latencies.setdefault(endpoint, []).append(elapsed)
+        else:
+            errors[endpoint] = errors.get(endpoint, 0) + 1
+        if think_time > 0:
+            await asyncio.sleep(rng.uniform(0, 2 * think_time))
+
+
+@contextlib.asynccontextmanager
+async def serve(solr_latency=0.0, s3_latency=0.0, num_notebooks=50, num_cells=50, seed=0):
+    """Serve the API handlers on a local port and yield the base URL and the ids of the notebooks"""
+    solr_stub = SolrStub(latency=solr_latency)
+    s3_stub = S3Stub(latency=s3_latency)
+    solr_url = solr_stub.start()
+    config = Config()
+    config.NBSearchDB.solr_base_url = solr_url
+    with tempfile.TemporaryDirectory() as base_dir:
+        parent = Configurable(config=config)
+        handlers = [(path, _unauthenticated(handler), options)
+                    for path, handler, options in get_api_handlers(parent, base_dir)]
+        db = handlers[0][2]['db']
+        notebook_ids = _populate(solr_stub, s3_stub, db.s3_bucket_name, num_notebooks, num_cells, seed)
+        sock, port = bind_unused_port()
+        server = HTTPServer(tornado.web.Application(handlers))
+        server.add_sockets([sock])
+        try:
+            with mock.patch('nbsearch.db.aioboto3.Session', s3_stub):
+                yield f'http://127.0.0.1:{port}', notebook_ids
+        finally:
+            server.stop()
+            solr_stub.stop()
+
+
+async def run(concurrency=10, duration=10.0, think_time=0.0, mix=None, queries=None,
+              solr_latency=0.0, s3_latency=0.0, num_notebooks=50, num_cells=50, seed=0):
+    mix = mix or {'search': 6, 'data': 3, 'import': 1}
+    queries = queries or DEFAULT_QUERIES
+    latencies = {}
+    errors = {}
+    async with serve(solr_latency=solr_latency, s3_latency=s3_latency, num_notebooks=num_notebooks,
+                     num_cells=num_cells, seed=seed) as (base_url, notebook_ids):
+        client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+        try:
+            started = time.perf_counter()
+            deadline = time.monotonic() + duration
+            await asyncio.gather(*[
+                _worker(client, base_url, random.Random(seed + i), mix, queries,
+                        notebook_ids, think_time, deadline, latencies, errors)
+                for i in range(concurrency)
+            ])
+            elapsed = time.perf_counter() - started
+        finally:
+            client.close()
+    return {
+        'config': {
+            'concurrency': concurrency,
+            'duration': duration,
+            'think_time': think_time,
+            'mix': mix,
+            'solr_latency': solr_latency,
+            's3_latency': s3_latency,
+            'notebooks': num_notebooks,
+            'cells_per_notebook': num_cells,
+            'seed': seed,
+        },
+        'elapsed': elapsed,
+        'endpoints': summarize(latencies, errors, elapsed),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the nbsearch API against Solr and S3 stubs')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--think-time', type=float, default=0.0)
+    parser.add_argument('--mix', type=parse_mix, default=None)
+    parser.add_argument('--queries', type=lambda v: v.split(','), default=None)
+    parser.add_argument('--solr-latency', type=float, default=0.0)
+    parser.add_argument('--s3-latency', type=float, default=0.0)
+    parser.add_argument('--notebooks', type=int, default=50)
+    parser.add_argument('--cells', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='The file to save the JSON result')
+    args = parser.parse_args(argv)
+    result = asyncio.run(run(
+        concurrency=args.concurrency, duration=args.duration, think_time=args.think_time,
+        mix=args.mix, queries=args.queries, solr_latency=args.solr_latency,
+        s3_latency=args.s3_latency, num_notebooks=args.notebooks, num_cells=args.cells,
+        seed=args.seed,
+    ))
+    data = json.dumps(result, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    print(data)
+
+
+if __name__ == '__main__':
+    main()
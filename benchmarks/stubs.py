@@ -0,0 +1,173 @@
+"""In-process Solr and S3 stubs for benchmarks
+
+SolrStub serves the subset of the Solr HTTP API used by NBSearchDB on a
+local port, and S3Stub replaces aioboto3.Session in nbsearch.db. Both keep
+the documents in memory and can add a fixed latency to each request.
+"""
+import asyncio
+import io
+import json
+import zlib
+from urllib.parse import parse_qs
+
+from botocore.exceptions import ClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+import tornado.web
+
+
+class _SolrHandler(tornado.web.RequestHandler):
+    def initialize(self, stub):
+        self.stub = stub
+
+    async def get(self, core, action):
+        await self.stub.delay()
+        self.stub.requests += 1
+        docs = self.stub.cores.setdefault(core, {})
+        if action == 'get':
+            self.write({'doc': docs.get(self.get_query_argument('id'))})
+            return
+        if action != 'select':
+            raise tornado.web.HTTPError(404)
+        start = int(self.get_query_argument('start', '0'))
+        rows = int(self.get_query_argument('rows', '10'))
+        params = parse_qs(self.request.query)
+        matched = list(docs.values())
+        response = {
+            'responseHeader': {'status': 0, 'QTime': 0},
+            'response': {'numFound': len(matched), 'start': start, 'docs': matched[start:start + rows]},
+        }
+        if 'cursorMark' in params:
+            cursor = int(params['cursorMark'][0]) if params['cursorMark'][0] != '*' else 0
+            response['response']['docs'] = matched[cursor:cursor + rows]
+            response['nextCursorMark'] = str(min(cursor + rows, len(matched)))
+        self.write(response)
+
+    async def post(self, core, action):
+        await self.stub.delay()
+        self.stub.requests += 1
+        if action != 'update':
+            raise tornado.web.HTTPError(404)
+        docs = self.stub.cores.setdefault(core, {})
+        for doc in json.loads(self.request.body):
+            docs[doc['id']] = doc
+        self.stub.posted_bytes += len(self.request.body)
+        self.write({'responseHeader': {'status': 0, 'QTime': 0}})
+
+
+class SolrStub(object):
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.cores = {}
+        self.requests = 0
+        self.posted_bytes = 0
+        self._server = None
+        self.port = None
+
+    async def delay(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def start(self):
+        """Listen on an unused local port of the running event loop"""
+        app = tornado.web.Application([
+            (r'/solr/(?P<core>[^/]+)/(?P<action>[^/]+)', _SolrHandler, {'stub': self}),
+        ])
+        sock, self.port = bind_unused_port()
+        self._server = HTTPServer(app)
+        self._server.add_sockets([sock])
+        return f'http://127.0.0.1:{self.port}'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def add_documents(self, core, docs):
+        self.cores.setdefault(core, {}).update([(doc['id'], doc) for doc in docs])
+
+
+class _Body(object):
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    async def read(self, size=-1):
+        return self._data.read(size)
+
+
+def _client_error(code, operation):
+    return ClientError({'Error': {'Code': code}}, operation)
+
+
+class _S3Client(object):
+    def __init__(self, stub):
+        self.stub = stub
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def list_buckets(self):
+        await self.stub.delay()
+        return {'Buckets': [{'Name': name} for name in self.stub.buckets]}
+
+    async def create_bucket(self, Bucket):
+        await self.stub.delay()
+        self.stub.buckets.setdefault(Bucket, {})
+
+    async def upload_fileobj(self, f, bucket, key, ExtraArgs=None):
+        await self.stub.delay()
+        data = f.read()
+        self.stub.uploaded_bytes += len(data)
+        self.stub.buckets.setdefault(bucket, {})[key] = (data, dict(ExtraArgs or {}))
+
+    async def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None):
+        await self.stub.delay()
+        if Key not in self.stub.buckets.get(Bucket, {}):
+            raise _client_error('NoSuchKey', 'GetObject')
+        data, extra_args = self.stub.buckets[Bucket][Key]
+        etag = f'"{zlib.crc32(data):08x}"'
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise _client_error('304', 'GetObject')
+        response = {'ETag': etag, 'ContentEncoding': extra_args.get('ContentEncoding')}
+        if Range is not None:
+            start, end = [int(v) for v in Range[len('bytes='):].split('-')]
+            response['ContentRange'] = f'bytes {start}-{end}/{len(data)}'
+            data = data[start:end + 1]
+        self.stub.downloaded_bytes += len(data)
+        response['Body'] = _Body(data)
+        return response
+
+    async def download_fileobj(self, bucket, key, f):
+        response = await self.get_object(Bucket=bucket, Key=key)
+        data = await response['Body'].read()
+        result = f.write(data)
+        if asyncio.iscoroutine(result):
+            await result
+
+
+class S3Stub(object):
+    """Callable in place of aioboto3.Session"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.buckets = {}
+        self.uploaded_bytes = 0
+        self.downloaded_bytes = 0
+
+    async def delay(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def __call__(self, **kwargs):
+        return self
+
+    def client(self, service_name, endpoint_url=None):
+        return _S3Client(self)
+
+    def put_notebook(self, bucket, notebook_id, notebook_data):
+        data = json.dumps(notebook_data, ensure_ascii=False).encode('utf8')
+        self.buckets.setdefault(bucket, {})[notebook_id] = (data, {})
@@ -0,0 +1,59 @@
+"""Benchmarks of each stage of indexing
+
+    python -m pytest benchmarks/test_indexing.py --benchmark-only
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from nbsearch import solr
+from nbsearch.source import LocalSource
+
+from .corpus import generate_corpus, generate_notebook
+from . import e2e
+
+
+@pytest.mark.parametrize('num_cells', [10, 100, 1000])
+def test_ipynb_to_documents(benchmark, num_cells):
+    notebook_data = generate_notebook(0, num_cells=num_cells)
+    result = benchmark(solr.ipynb_to_documents, 'bench.ipynb', notebook_data)
+    assert len(result['jupyter-cell']) == num_cells
+
+
+@pytest.mark.parametrize('meme_encoding', ['lists', 'positions'])
+def test_ipynb_to_documents_meme_encoding(benchmark, meme_encoding):
+    notebook_data = generate_notebook(0, num_cells=500)
+    benchmark(solr.ipynb_to_documents, 'bench.ipynb', notebook_data, meme_encoding=meme_encoding)
+
+
+@pytest.mark.parametrize('meme_ratio', [0.0, 1.0])
+@pytest.mark.parametrize('output_lines', [0, 50])
+def test_ipynb_to_documents_memes_and_outputs(benchmark, meme_ratio, output_lines):
+    notebook_data = generate_notebook(0, num_cells=200, meme_ratio=meme_ratio, output_lines=output_lines)
+    benchmark(solr.ipynb_to_documents, 'bench.ipynb', notebook_data)
+
+
+@pytest.mark.parametrize('heading_depth', [0, 2, 6])
+def test_markdown_to_solr_fields(benchmark, heading_depth):
+    notebook_data = generate_notebook(0, num_cells=200, heading_depth=heading_depth)
+    markdowns = [''.join(cell['source']) for cell in notebook_data['cells']
+                 if cell['cell_type'] == 'markdown']
+    benchmark(lambda: [solr.markdown_to_solr_fields(m) for m in markdowns])
+
+
+@pytest.mark.parametrize('fan_out,depth', [(1, 0), (4, 2), (10, 3)])
+def test_local_source_get_files(benchmark, tmp_path, fan_out, depth):
+    paths = generate_corpus(str(tmp_path), 200, fan_out=fan_out, depth=depth, num_cells=5)
+    source = LocalSource(base_dir=str(tmp_path), server='http://localhost:8888/')
+    files = benchmark(lambda: list(source._get_files(str(tmp_path), '')))
+    assert len(files) == len(paths)
+
+
+def test_update_index(benchmark, tmp_path):
+    def update():
+        return asyncio.run(e2e.run(20, num_cells=30, work_dir=str(tmp_path)))
+    result = benchmark.pedantic(update, rounds=3)
+    benchmark.extra_info.update(result)
+    assert result['solr_requests'] == 40
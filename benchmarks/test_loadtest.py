@@ -0,0 +1,18 @@
+import asyncio
+
+from . import loadtest
+
+
+def test_percentile():
+    values = [0.1 * i for i in range(1, 101)]
+    assert loadtest.percentile(values, 50) == values[49]
+    assert loadtest.percentile(values, 99) == values[98]
+    assert loadtest.percentile([], 50) is None
+
+
+def test_run():
+    result = asyncio.run(loadtest.run(concurrency=2, duration=0.5, num_notebooks=3, num_cells=5))
+    assert set(result['endpoints'].keys()) <= set(loadtest.ENDPOINTS)
+    for endpoint, stats in result['endpoints'].items():
+        assert stats['errors'] == 0, endpoint
+        assert stats['p50_ms'] <= stats['p99_ms']
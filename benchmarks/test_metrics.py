@@ -0,0 +1,51 @@
+"""Overhead of the metrics on the request path
+
+    python -m pytest benchmarks/test_metrics.py --benchmark-only
+
+test_request_metrics records what a single search request records, to be
+compared with a search request against the stubs in test_search_request.
+"""
+import asyncio
+from urllib.parse import quote
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from tornado.httpclient import AsyncHTTPClient
+
+from nbsearch.db import NBSearchDB
+
+from . import loadtest
+
+
+def test_request_metrics(benchmark):
+    metrics = NBSearchDB().metrics
+    result = {'responseHeader': {'status': 0, 'QTime': 3}}
+
+    def record():
+        metrics.request_started('search')
+        metrics.observe_solr('query', 0.004)
+        metrics.observe_solr_result(result)
+        metrics.request_finished('search', 'GET', 200, 0.005, 20000)
+
+    benchmark(record)
+
+
+def test_search_request(benchmark):
+    loop = asyncio.new_event_loop()
+    server = loadtest.serve(num_notebooks=10, num_cells=20)
+    try:
+        base_url, _ = loop.run_until_complete(server.__aenter__())
+        client = AsyncHTTPClient(force_instance=True)
+        url = f'{base_url}/v1/cell/search?query=' + quote('_text_:data')
+
+        async def search():
+            return await client.fetch(url)
+
+        response = benchmark(lambda: loop.run_until_complete(search()))
+        assert response.code == 200
+        client.close()
+    finally:
+        loop.run_until_complete(server.__aexit__(None, None, None))
+        loop.close()
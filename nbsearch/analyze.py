@@ -0,0 +1,196 @@
+import asyncio
+import json
+import random
+import re
+
+from traitlets import Unicode, Int, List
+from traitlets.config import LoggingConfigurable
+from traitlets.config.loader import PyFileConfigLoader
+
+from .db import NBSearchDB
+from .source import get_source
+from . import solr
+
+
+# An approximation of the tokens produced by the standard tokenizer of Solr
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def _field_text(value):
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _truncate(text, limit):
+    if isinstance(text, list):
+        text = ''.join(text)
+    return text[:limit]
+
+
+def truncate_outputs(notebook_data, limit):
+    """Copy of the notebook whose stream and execute_result outputs are truncated to the limit in characters"""
+    cells = []
+    for cell in notebook_data.get('cells', []):
+        if 'outputs' not in cell:
+            cells.append(cell)
+            continue
+        outputs = []
+        for output in cell['outputs']:
+            output = dict(output)
+            if 'text' in output:
+                output['text'] = _truncate(output['text'], limit)
+            if 'data' in output:
+                output['data'] = dict([(k, _truncate(v, limit) if k in ['text/plain', 'text/html'] else v)
+                                       for k, v in output['data'].items()])
+            outputs.append(output)
+        cells.append(dict(cell, outputs=outputs))
+    return dict(notebook_data, cells=cells)
+
+
+class _CoreStats(object):
+
+    def __init__(self):
+        self.documents = 0
+        self.bytes = 0
+        self.fields = {}
+
+    def add(self, docs):
+        self.documents += len(docs)
+        self.bytes += len(json.dumps(docs))
+        for doc in docs:
+            for name, value in doc.items():
+                text = _field_text(value)
+                stats = self.fields.setdefault(name, {'documents': 0, 'bytes': 0, 'tokens': 0})
+                stats['documents'] += 1
+                stats['bytes'] += len(text.encode('utf8'))
+                stats['tokens'] += len(TOKEN_PATTERN.findall(text))
+
+    def summarize(self):
+        total = sum([f['bytes'] for f in self.fields.values()])
+        fields = [dict(stats, name=name, share=stats['bytes'] / total if total > 0 else 0.0)
+                  for name, stats in self.fields.items()]
+        return {
+            'documents': self.documents,
+            'bytes': self.bytes,
+            'fields': sorted(fields, key=lambda f: -f['bytes']),
+        }
+
+
+class AnalyzeIndexHandler(LoggingConfigurable):
+
+    sample_size = Int(0, help='The number of notebooks sampled from the source (all notebooks if 0)').tag(config=True)
+
+    sample_seed = Int(0, help='The seed to sample notebooks').tag(config=True)
+
+    top = Int(10, help='The number of the largest notebooks and cells in the report').tag(config=True)
+
+    truncate_outputs = List(Int(), [1024, 10240], help='The limits in characters of each output to estimate the savings of truncating outputs').tag(config=True)
+
+    report_path = Unicode('', help='The file to write the JSON report (disabled if empty)').tag(config=True)
+
+    def __init__(self, **kwargs):
+        super(AnalyzeIndexHandler, self).__init__(**kwargs)
+
+    def analyze(self, cpath, source_path):
+        """Build the documents of the notebooks without posting them, and summarize their size"""
+        self.log.info('analyzing indices for {}({})'.format(source_path, cpath))
+        self.config.merge(PyFileConfigLoader(cpath).load_config())
+        db = NBSearchDB(config=self.config)
+        source = get_source(source_path, self.config)
+        compact = asyncio.run(db.get_compact_documents(log=self.log))
+
+        files = list(source.get_files())
+        if 0 < self.sample_size < len(files):
+            files = random.Random(self.sample_seed).sample(files, self.sample_size)
+        cores = {}
+        notebooks = []
+        cells = []
+        truncated_bytes = dict([(limit, 0) for limit in self.truncate_outputs])
+        failed = []
+        for file in files:
+            try:
+                notebook_data = source.get_notebook(file['server'], file['path'])
+                attr = dict([(k, v) for k, v in file.items()
+                             if k in ['server', 'owner', 'mtime', 'ctime', 'atime'] and v is not None])
+
+                def to_documents(notebook_data):
+                    return solr.ipynb_to_documents(file['path'], notebook_data, attr=attr,
+                                                   meme_encoding=db.solr_meme_encoding,
+                                                   compact=compact)
+
+                r = to_documents(notebook_data)
+                for core, docs in r.items():
+                    cores.setdefault(core, _CoreStats()).add(docs)
+                notebooks.append({
+                    'path': file['path'],
+                    'cells': len(r.get('jupyter-cell', [])),
+                    'bytes': sum([len(json.dumps(docs)) for docs in r.values()]),
+                })
+                for doc in r.get('jupyter-cell', []):
+                    cells.append({
+                        'path': file['path'],
+                        'index': doc['index'],
+                        'cell_type': doc.get('cell_type'),
+                        'bytes': len(json.dumps(doc)),
+                    })
+                for limit in self.truncate_outputs:
+                    truncated = to_documents(truncate_outputs(notebook_data, limit))
+                    truncated_bytes[limit] += sum([len(json.dumps(docs)) for docs in truncated.values()])
+            except:
+                self.log.exception('failed to analyze {}'.format(file['path']))
+                failed.append(file['path'])
+        total = sum([stats.bytes for stats in cores.values()])
+        summary = {
+            'notebooks': len(notebooks),
+            'failed': failed,
+            'meme_encoding': db.solr_meme_encoding,
+            'compact_documents': compact,
+            'bytes': total,
+            'cores': dict([(core, stats.summarize()) for core, stats in sorted(cores.items())]),
+            'largest_notebooks': sorted(notebooks, key=lambda n: -n['bytes'])[:self.top],
+            'largest_cells': sorted(cells, key=lambda c: -c['bytes'])[:self.top],
+            'truncate_outputs': [{
+                'limit': limit,
+                'bytes': truncated_bytes[limit],
+                'saved_bytes': total - truncated_bytes[limit],
+                'saved_ratio': (total - truncated_bytes[limit]) / total if total > 0 else 0.0,
+            } for limit in self.truncate_outputs],
+        }
+        if self.report_path:
+            with open(self.report_path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
+
+
+def format_summary(summary, max_fields=20):
+    """Render the summary of AnalyzeIndexHandler.analyze as text"""
+    lines = ['{} notebooks, {} bytes posted to Solr (meme_encoding={}, compact_documents={})'.format(
+        summary['notebooks'], summary['bytes'], summary['meme_encoding'], summary['compact_documents'],
+    )]
+    if len(summary['failed']) > 0:
+        lines.append('failed: {}'.format(', '.join(summary['failed'])))
+    for core, stats in summary['cores'].items():
+        lines.append('')
+        lines.append('{}: {} documents, {} bytes'.format(core, stats['documents'], stats['bytes']))
+        lines.append('  {:<48} {:>9} {:>12} {:>10} {:>7}'.format('field', 'documents', 'bytes', 'tokens', 'share'))
+        for field in stats['fields'][:max_fields]:
+            lines.append('  {:<48} {:>9} {:>12} {:>10} {:>6.1f}%'.format(
+                field['name'], field['documents'], field['bytes'], field['tokens'], field['share'] * 100,
+            ))
+    lines.append('')
+    lines.append('largest notebooks:')
+    for notebook in summary['largest_notebooks']:
+        lines.append('  {:>12} {} ({} cells)'.format(notebook['bytes'], notebook['path'], notebook['cells']))
+    lines.append('largest cells:')
+    for cell in summary['largest_cells']:
+        lines.append('  {:>12} {}#{} ({})'.format(cell['bytes'], cell['path'], cell['index'], cell['cell_type']))
+    lines.append('truncating each output to:')
+    for estimate in summary['truncate_outputs']:
+        lines.append('  {:>8} chars saves {} bytes ({:.1f}%)'.format(
+            estimate['limit'], estimate['saved_bytes'], estimate['saved_ratio'] * 100,
+        ))
+    lines.append('dropping a field saves its bytes in the tables above')
+    if summary['compact_documents']:
+        lines.append('source, outputs and _text_ filled by copyField rules of Solr are not included')
+    return '\n'.join(lines)
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class NotebookCache(object):
+    """Size-capped LRU cache of notebook blobs on the local disk
+
+    Each entry consists of `<key>.ipynb` holding the blob and `<key>.etag`
+    holding the ETag of the S3 object. The mtime of the blob records the last
+    access (used to restore the LRU order on startup) and the mtime of the
+    ETag file records the last validation against S3.
+
+    Blobs are returned as files opened while holding the lock, so that a
+    concurrent eviction cannot remove them before they are read.
+    """
+
+    def __init__(self, cache_dir, max_size, log=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.log = log
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _key(self, notebook_id):
+        return hashlib.sha256(notebook_id.encode('utf8')).hexdigest()
+
+    def _blob_path(self, key):
+        return os.path.join(self.cache_dir, key + '.ipynb')
+
+    def _etag_path(self, key):
+        return os.path.join(self.cache_dir, key + '.etag')
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.ipynb'):
+                continue
+            key = name[:-len('.ipynb')]
+            if not os.path.exists(self._etag_path(key)):
+                continue
+            stat = os.stat(self._blob_path(key))
+            entries.append((stat.st_mtime, key, stat.st_size))
+        self._entries = OrderedDict([(key, size) for _, key, size in sorted(entries)])
+
+    def lookup(self, notebook_id):
+        """Return (file, etag, validated_at) of the cached blob, or None
+
+        The caller must close the returned file.
+        """
+        key = self._key(notebook_id)
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                return None
+            try:
+                with open(self._etag_path(key), 'r') as f:
+                    etag = f.read()
+                validated_at = os.stat(self._etag_path(key)).st_mtime
+                blob = open(self._blob_path(key), 'rb')
+            except FileNotFoundError:
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            os.utime(blob.fileno())
+            return blob, etag, validated_at
+
+    def validated(self, notebook_id):
+        key = self._key(notebook_id)
+        with self._lock:
+            os.utime(self._etag_path(key))
+
+    def temporary_file(self):
+        with self._lock:
+            self._load()
+        return tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False)
+
+    def commit(self, notebook_id, temp_path, etag):
+        """Move the downloaded temporary file into the cache, evict old entries and return the opened blob"""
+        key = self._key(notebook_id)
+        with self._lock:
+            self._load()
+            os.replace(temp_path, self._blob_path(key))
+            with open(self._etag_path(key), 'w') as f:
+                f.write(etag)
+            self._entries[key] = os.stat(self._blob_path(key)).st_size
+            self._entries.move_to_end(key)
+            blob = open(self._blob_path(key), 'rb')
+            self._evict()
+            return blob
+
+    def _evict(self):
+        total = sum(self._entries.values())
+        while total > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            for path in [self._blob_path(key), self._etag_path(key)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            if self.log is not None:
+                self.log.debug(f'evicted cached notebook: {key}')
@@ -1,22 +1,144 @@
+import asyncio
+import contextlib
+import gzip
+import inspect
 import io
 import json
+import math
 import os
+import random
 import re
+import shutil
+import time
+from fnmatch import fnmatch
 from urllib.parse import urljoin, urlencode
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.simple_httpclient import HTTPTimeoutError
 from tornado.web import HTTPError
 
-from traitlets import Unicode, Int
+from traitlets import Unicode, Int, Float, Bool, CaselessStrEnum, List
 from traitlets.config.configurable import Configurable
 from traitlets.config import LoggingConfigurable
 from traitlets.config.loader import PyFileConfigLoader
 import aioboto3
+from botocore.exceptions import ClientError
 
+from .cache import NotebookCache
+from .metrics import NBSearchMetrics, current_trace
+from .profiling import start_profile
 from .source import get_source
 from . import solr
 
 
+NOTEBOOK_META_FIELDS = [
+    'id', 'filename', 'owner', 'server', 'mtime', 'signature_server_url',
+]
+
+
+CELL_INDEX_SUFFIX = '.cells.json'
+
+LIGHT_VARIANT_SUFFIX = '.light.json'
+
+CELLS_PLACEHOLDER = '\x00nbsearch-cells\x00'
+
+UPDATE_INDEX_STAGES = ['discover', 'read', 'parse', 'markdown', 'documents', 'solr', 's3']
+
+FIELD_VALUE_PATTERN = re.compile(r'([\w.]+):("(?:[^"\\]|\\.)*"|\[[^\]]*\]|\{[^}]*\}|[^\s()]+)')
+
+MEME_NEIGHBORHOOD_PATTERN = re.compile(r'lc_cell_memes__(previous|next)__in_(notebook|section):("[^"]*"|[^\s()]+)')
+
+
+def _serialize_notebook(notebook_data):
+    """Serialize the notebook and compute [start, end) byte offsets of each cell in it"""
+    if not isinstance(notebook_data.get('cells'), list):
+        return json.dumps(notebook_data, ensure_ascii=False).encode('utf8'), None
+    placeholder = json.dumps(CELLS_PLACEHOLDER).encode('utf8')
+    envelope = json.dumps(dict(notebook_data, cells=CELLS_PLACEHOLDER), ensure_ascii=False).encode('utf8')
+    prefix, suffix = envelope.split(placeholder)
+    # The same separators as json.dumps so that the body is identical
+    parts = [prefix, b'[']
+    offsets = []
+    position = len(prefix) + 1
+    for i, cell in enumerate(notebook_data['cells']):
+        if i > 0:
+            parts.append(b', ')
+            position += 2
+        data = json.dumps(cell, ensure_ascii=False).encode('utf8')
+        parts.append(data)
+        offsets.append([position, position + len(data)])
+        position += len(data)
+    parts += [b']', suffix]
+    return b''.join(parts), offsets
+
+
+def _strip_outputs(notebook_data):
+    if not isinstance(notebook_data.get('cells'), list):
+        return notebook_data
+    cells = []
+    for cell in notebook_data['cells']:
+        cell = dict([(k, v) for k, v in cell.items() if k != 'attachments'])
+        if 'outputs' in cell:
+            cell['outputs'] = []
+        cells.append(cell)
+    return dict(notebook_data, cells=cells)
+
+
+def _copy_to(src, f):
+    with src:
+        shutil.copyfileobj(src, f)
+
+
+class _CountingWriter(object):
+    """File wrapper counting the bytes written, whose write is a coroutine if the wrapped one is"""
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        if inspect.iscoroutinefunction(f.write):
+            self.write = self._write_async
+
+    def write(self, data):
+        self.size += len(data)
+        return self.f.write(data)
+
+    async def _write_async(self, data):
+        self.size += len(data)
+        return await self.f.write(data)
+
+
+def normalize_query(query):
+    """Replace the values of field queries with ? so that queries of the same shape can be grouped"""
+    query = ' '.join(query.split())
+    return FIELD_VALUE_PATTERN.sub(lambda m: m.group(1) + ':?', query)
+
+
+def _quote_phrase(value):
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def _meme_neighborhood_clause(direction, scope, anchors):
+    clauses = []
+    for anchor in anchors:
+        index = anchor['index']
+        terms = [f'notebook_id:{_quote_phrase(anchor["notebook_id"])}']
+        if direction == 'previous':
+            # Cells which have the anchor cell before them
+            terms.append(f'index:{{{index} TO *]')
+            if scope == 'section':
+                terms.append(f'lc_cell_position__section_beginning:[* TO {index}]')
+        else:
+            # Cells which have the anchor cell after them
+            terms.append(f'index:[* TO {index}}}')
+            if scope == 'section':
+                terms.append(f'lc_cell_position__section_ending:{{{index} TO *]')
+        clauses.append('(' + ' AND '.join(terms) + ')')
+    if len(clauses) == 0:
+        return '(-*:*)'
+    return '(' + ' OR '.join(clauses) + ')'
+
+
 class NBSearchDB(Configurable):
 
     solr_base_url = Unicode('http://localhost:8983', help='The base URL of Solr').tag(config=True)
@@ -35,45 +157,418 @@ class NBSearchDB(Configurable):
 
     s3_bucket_name = Unicode('notebooks', help='The bucket on S3').tag(config=True)
 
+    s3_stream_chunk_size = Int(1024 * 1024, help='The chunk size in bytes for streaming notebooks from S3').tag(config=True)
+
+    s3_light_variant = Bool(True, help='Whether to store the variant of notebooks without outputs for previews').tag(config=True)
+
+    s3_light_variant_compression = Bool(False, help='Whether to compress the variant of notebooks without outputs by gzip').tag(config=True)
+
+    s3_cache_dir = Unicode('', help='The local directory to cache notebooks downloaded from S3 (disabled if empty)').tag(config=True)
+
+    s3_cache_max_size = Int(1024 * 1024 * 1024, help='The maximum total size in bytes of the local notebook cache').tag(config=True)
+
+    s3_cache_max_age = Float(60.0, help='The time in seconds to serve cached notebooks without revalidating them on S3').tag(config=True)
+
     solr_notebook = Unicode('jupyter-notebook', help='The core for notebooks on Solr').tag(config=True)
 
     solr_cell = Unicode('jupyter-cell', help='The core for cells on Solr').tag(config=True)
 
+    solr_export_rows = Int(1000, help='The number of documents fetched per cursor page on export').tag(config=True)
+
+    solr_http_client = CaselessStrEnum(['simple', 'curl'], 'simple', help='The HTTP client implementation for Solr (curl requires pycurl)').tag(config=True)
+
+    solr_query_max_clients = Int(10, help='The maximum number of concurrent search requests to Solr').tag(config=True)
+
+    solr_update_max_clients = Int(2, help='The maximum number of concurrent update requests to Solr').tag(config=True)
+
+    solr_connect_timeout = Float(10.0, help='The timeout in seconds for connecting to Solr').tag(config=True)
+
+    solr_query_timeout = Float(30.0, help='The timeout in seconds for search requests to Solr').tag(config=True)
+
+    solr_update_timeout = Float(300.0, help='The timeout in seconds for update requests to Solr').tag(config=True)
+
+    solr_time_allowed = Int(None, help='The timeAllowed parameter in milliseconds for search requests to Solr', allow_none=True).tag(config=True)
+
+    solr_max_retries = Int(2, help='The maximum number of retries of search requests on 503 or connection reset').tag(config=True)
+
+    solr_retry_backoff = Float(0.2, help='The base delay in seconds of the jittered exponential backoff between retries').tag(config=True)
+
+    s3_max_concurrent_downloads = Int(4, help='The maximum number of concurrent downloads from S3 for a bulk import').tag(config=True)
+
+    solr_meta_cache_ttl = Float(30.0, help='The time in seconds to cache metadata of notebooks (disabled if 0)').tag(config=True)
+
+    solr_meta_cache_size = Int(1024, help='The maximum number of notebooks whose metadata is cached').tag(config=True)
+
+    parsed_notebook_cache_ttl = Float(60.0, help='The time in seconds to keep parsed notebooks in memory for section requests (disabled if 0)').tag(config=True)
+
+    parsed_notebook_cache_size = Int(16, help='The maximum number of parsed notebooks kept in memory').tag(config=True)
+
+    solr_meme_encoding = CaselessStrEnum(['lists', 'positions'], 'lists', help='How cells are indexed for MEME neighborhood searches: lists of MEMEs per cell, or positions resolved at query time (positions requires reindexing)').tag(config=True)
+
+    solr_compact_documents = Bool(None, allow_none=True, help='Whether to send each text once and let copyField rules of the schemas fill source, outputs and _text_ (detected from the copyField rules of the cores if not set)').tag(config=True)
+
+    slow_query_threshold = Float(0.0, help='The time in seconds above which API requests are logged with their Solr queries (disabled if 0)').tag(config=True)
+
+    solr_meme_anchor_rows = Int(100, help='The maximum number of cells with the MEME used to resolve a neighborhood search in the positions encoding').tag(config=True)
+
+    prefetch_top_n = Int(0, help='The number of top search hits to prefetch into the local notebook cache (disabled if 0, requires s3_cache_dir)').tag(config=True)
+
+    prefetch_max_concurrency_per_user = Int(2, help='The maximum number of concurrent prefetches per user').tag(config=True)
+
+    prefetch_max_bytes = Int(256 * 1024 * 1024, help='The maximum total size in bytes of prefetched notebooks not yet requested').tag(config=True)
+
+    prefetch_ttl = Float(300.0, help='The time in seconds after which unrequested prefetched notebooks no longer count against prefetch_max_bytes').tag(config=True)
+
+    prefetch_reserved_bytes = Int(1024 * 1024, help='The size in bytes counted against prefetch_max_bytes for each prefetch in progress, until its actual size is known').tag(config=True)
+
+    profile_dir = Unicode('', help='The directory to write profiles of API requests (disabled if empty)').tag(config=True)
+
+    profile_sample_rate = Float(0.0, help='The fraction of API requests to profile').tag(config=True)
+
+    profile_slow_threshold = Float(0.0, help='The time in seconds above which profiles of API requests are kept, all requests are profiled to catch them (disabled if 0)').tag(config=True)
+
+    profile_engine = CaselessStrEnum(['auto', 'cprofile', 'pyinstrument'], 'auto', help='The profiler, auto uses pyinstrument if installed and cProfile otherwise').tag(config=True)
+
+    def __init__(self, **kwargs):
+        super(NBSearchDB, self).__init__(**kwargs)
+        self._http_clients = {}
+        self._meta_cache = {}
+        self._parsed_notebook_cache = {}
+        self._cache = None
+        if self.s3_cache_dir:
+            self._cache = NotebookCache(self.s3_cache_dir, self.s3_cache_max_size)
+        self._compact_documents = None
+        self._prefetched = {}
+        self._prefetch_tasks = set()
+        self._prefetch_running = {}
+        self.prefetch_issued = 0
+        self.prefetch_hits = 0
+        self.meta_cache_hits = 0
+        self.meta_cache_misses = 0
+        self.parsed_notebook_cache_hits = 0
+        self.parsed_notebook_cache_misses = 0
+        self.metrics = NBSearchMetrics(self)
+
     async def post_document(self, core_internal, jsondoc):
         core = self.solr_cell if core_internal == 'jupyter-cell' else self.solr_notebook
-        http_client = AsyncHTTPClient()
-        response = await http_client.fetch(HTTPRequest(
+        response = await self._fetch('update', HTTPRequest(
             urljoin(self.solr_base_url, f'solr/{core}/update?commit=true'),
             method='POST',
             body=json.dumps(jsondoc),
             headers={'Content-Type': 'application/json'},
             **self._http_kwargs(),
         ))
+        response.rethrow()
+
+    async def get_compact_documents(self, log=None):
+        """Whether to build compact documents, detected from the copyField rules of the cores unless configured
 
-    def _build_query(self, query, q_op=None, start=None, rows=None, sort=None):
+        Cores created from the current schemas copy the text fields into source, outputs
+        and _text_, so legacy documents would index every text twice. Cores created from
+        older schemas have no such rules and require _text_.
+        """
+        if self.solr_compact_documents is not None:
+            return self.solr_compact_documents
+        if self._compact_documents is not None:
+            return self._compact_documents
+        try:
+            results = await asyncio.gather(*[
+                self._has_compact_copy_fields(core) for core in ['jupyter-notebook', 'jupyter-cell']
+            ])
+        except Exception as e:
+            if log is not None:
+                log.warning(f'failed to read the copyField rules of the cores, sending legacy documents: {e}')
+            return False
+        self._compact_documents = all(results)
+        return self._compact_documents
+
+    async def _has_compact_copy_fields(self, core_internal):
+        core = self.solr_cell if core_internal == 'jupyter-cell' else self.solr_notebook
+        response = await self._fetch('query', HTTPRequest(
+            urljoin(self.solr_base_url, f'solr/{core}/schema/copyfields?wt=json'),
+            method='GET',
+            **self._http_kwargs(),
+        ))
+        response.rethrow()
+        copy_fields = [(r['source'], r['dest']) for r in json.loads(response.body)['copyFields']]
+        return solr.has_compact_copy_fields(core_internal, copy_fields)
+
+    def _get_http_client(self, kind):
+        loop = asyncio.get_running_loop()
+        if kind in self._http_clients:
+            client_loop, http_client = self._http_clients[kind]
+            if client_loop is loop:
+                return http_client
+        if self.solr_http_client == 'curl':
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            client_class = CurlAsyncHTTPClient
+        else:
+            client_class = AsyncHTTPClient
+        if kind == 'update':
+            max_clients = self.solr_update_max_clients
+            request_timeout = self.solr_update_timeout
+        else:
+            max_clients = self.solr_query_max_clients
+            request_timeout = self.solr_query_timeout
+        http_client = client_class(
+            force_instance=True,
+            max_clients=max_clients,
+            defaults=dict(
+                connect_timeout=self.solr_connect_timeout,
+                request_timeout=request_timeout,
+            ),
+        )
+        self._http_clients[kind] = (loop, http_client)
+        return http_client
+
+    async def _fetch(self, kind, request):
+        # Only search requests are idempotent and safe to be retried
+        retries = self.solr_max_retries if kind == 'query' else 0
+        http_client = self._get_http_client(kind)
+        attempt = 0
+        while True:
+            try:
+                started = time.perf_counter()
+                response = await http_client.fetch(request, raise_error=False)
+                self.metrics.observe_solr(kind, time.perf_counter() - started)
+                if response.code != 503 or attempt >= retries:
+                    return response
+            except HTTPClientError as e:
+                if attempt >= retries or not self._is_connection_closed(e):
+                    raise
+            await asyncio.sleep(random.uniform(0, self.solr_retry_backoff * (2 ** attempt)))
+            attempt += 1
+
+    def _is_connection_closed(self, e):
+        # Both clients report network errors as 599; timeouts are not retried
+        if e.code != 599 or isinstance(e, HTTPTimeoutError):
+            return False
+        if self.solr_http_client == 'curl':
+            import pycurl
+            return getattr(e, 'errno', None) != pycurl.E_OPERATION_TIMEDOUT
+        return True
+
+    def _loads(self, response):
+        result = json.loads(response.body)
+        self.metrics.observe_solr_result(result)
+        return result
+
+    def _build_filter_queries(self, filters=None, ranges=None):
+        fqs = []
+        # Values are sorted so that the same filter always produces the same fq string
+        # and can be shared in filterCache across queries and users
+        for field, values in sorted((filters or {}).items()):
+            if len(values) == 0:
+                continue
+            terms = ' OR '.join([_quote_phrase(v) for v in sorted(set(values))])
+            fqs.append(f'{field}:({terms})')
+        for field, (range_from, range_to) in sorted((ranges or {}).items()):
+            fqs.append(f'{field}:[{range_from or "*"} TO {range_to or "*"}]')
+        return fqs
+
+    def _build_query(self, query, q_op=None, start=None, rows=None, sort=None, fl=None, cursor_mark=None,
+                     time_allowed=None, filters=None, ranges=None, collapse=None, expand_rows=None):
         params = {}
         params['q.op'] = q_op or 'AND'
         params['q'] = query
+        fqs = self._build_filter_queries(filters=filters, ranges=ranges)
+        if collapse is not None:
+            # Collapse results to the top document per group, ordered by the same sort as the results
+            collapse_sort = f" sort='{sort}'" if sort is not None else ''
+            fqs.append(f'{{!collapse field={collapse}{collapse_sort}}}')
+            if expand_rows is not None:
+                # expand.rows=0 still returns numFound of each group
+                params['expand'] = 'true'
+                params['expand.rows'] = expand_rows
+                if sort is not None:
+                    params['expand.sort'] = sort
+        if len(fqs) > 0:
+            params['fq'] = fqs
         if start is not None:
             params['start'] = start
         if rows is not None:
             params['rows'] = rows
         if sort is not None:
             params['sort'] = sort
-        return urlencode(params)
+        if fl is not None:
+            params['fl'] = fl
+        if cursor_mark is not None:
+            params['cursorMark'] = cursor_mark
+        if time_allowed is not None:
+            params['timeAllowed'] = time_allowed
+        return urlencode(params, doseq=True)
 
-    async def query(self, core_internal, query, q_op=None, start=None, rows=None, sort=None):
+    async def query(self, core_internal, query, q_op=None, start=None, rows=None, sort=None,
+                    filters=None, ranges=None, collapse=None, expand_rows=None):
         core = self.solr_cell if core_internal == 'jupyter-cell' else self.solr_notebook
-        urlquery = self._build_query(query, q_op=q_op, start=start, rows=rows, sort=sort)
-        http_client = AsyncHTTPClient()
-        response = await http_client.fetch(HTTPRequest(
+        if core_internal == 'jupyter-cell':
+            query = await self.resolve_meme_neighborhoods(query)
+        urlquery = self._build_query(query, q_op=q_op, start=start, rows=rows, sort=sort,
+                                     time_allowed=self.solr_time_allowed,
+                                     filters=filters, ranges=ranges,
+                                     collapse=collapse, expand_rows=expand_rows)
+        response = await self._fetch('query', HTTPRequest(
             urljoin(self.solr_base_url, f'solr/{core}/select?{urlquery}'),
             method='GET',
             **self._http_kwargs(),
-        ), raise_error=False)
+        ))
         if response.code >= 500:
             raise HTTPError(response.code)
-        return urlquery, json.loads(response.body)
+        result = self._loads(response)
+        trace = current_trace()
+        if trace is not None:
+            trace.queries.append({
+                'core': core,
+                'query': query,
+                'rows': rows,
+                'start': start,
+                'sort': sort,
+                'qtime': result.get('responseHeader', {}).get('QTime'),
+            })
+        return urlquery, result
+
+    async def export(self, core_internal, query, q_op=None, sort=None, fl=None, filters=None, ranges=None):
+        """Iterate over all matched documents page by page using Solr's cursorMark"""
+        core = self.solr_cell if core_internal == 'jupyter-cell' else self.solr_notebook
+        # cursorMark requires the uniqueKey as a tie-breaker of the sort
+        if sort is None:
+            sort = 'id asc'
+        elif 'id' not in [s.strip().split(' ')[0] for s in sort.split(',')]:
+            sort = f'{sort},id asc'
+        if core_internal == 'jupyter-cell':
+            query = await self.resolve_meme_neighborhoods(query)
+        # One entry summarizes all the pages; it is added first to be logged even if the export is aborted
+        record = {
+            'core': core,
+            'query': query,
+            'rows': self.solr_export_rows,
+            'start': None,
+            'sort': sort,
+            'qtime': 0,
+            'pages': 0,
+        }
+        trace = current_trace()
+        if trace is not None:
+            trace.queries.append(record)
+        cursor_mark = '*'
+        while True:
+            urlquery = self._build_query(
+                query, q_op=q_op, rows=self.solr_export_rows, sort=sort, fl=fl,
+                cursor_mark=cursor_mark, filters=filters, ranges=ranges,
+            )
+            response = await self._fetch('query', HTTPRequest(
+                urljoin(self.solr_base_url, f'solr/{core}/select?{urlquery}'),
+                method='GET',
+                **self._http_kwargs(),
+            ))
+            if response.code >= 500:
+                raise HTTPError(response.code)
+            result = self._loads(response)
+            record['qtime'] += result.get('responseHeader', {}).get('QTime', 0)
+            record['pages'] += 1
+            if 'error' in result:
+                raise HTTPError(response.code, result['error'].get('msg'))
+            docs = result['response']['docs']
+            if len(docs) > 0:
+                yield docs
+            next_cursor_mark = result['nextCursorMark']
+            if next_cursor_mark == cursor_mark:
+                break
+            cursor_mark = next_cursor_mark
+
+    async def resolve_meme_neighborhoods(self, query):
+        """Rewrite MEME neighborhood clauses into ranges of cell positions around the cells with the MEME"""
+        if self.solr_meme_encoding != 'positions':
+            return query
+        matches = list(MEME_NEIGHBORHOOD_PATTERN.finditer(query))
+        if len(matches) == 0:
+            return query
+        values = sorted(set([m.group(3) for m in matches]))
+        results = await asyncio.gather(*[self._get_meme_anchors(value) for value in values])
+        anchors = dict(zip(values, results))
+        parts = []
+        position = 0
+        for m in matches:
+            parts.append(query[position:m.start()])
+            parts.append(_meme_neighborhood_clause(m.group(1), m.group(2), anchors[m.group(3)]))
+            position = m.end()
+        parts.append(query[position:])
+        return ''.join(parts)
+
+    async def _get_meme_anchors(self, value):
+        urlquery = self._build_query(
+            f'lc_cell_meme__current:{value}', rows=self.solr_meme_anchor_rows, fl='notebook_id,index',
+        )
+        response = await self._fetch('query', HTTPRequest(
+            urljoin(self.solr_base_url, f'solr/{self.solr_cell}/select?{urlquery}'),
+            method='GET',
+            **self._http_kwargs(),
+        ))
+        if response.code >= 500:
+            raise HTTPError(response.code)
+        result = self._loads(response)
+        if 'error' in result:
+            raise HTTPError(400, result['error'].get('msg'))
+        return result['response']['docs']
+
+    async def get_notebook_meta(self, notebook_id):
+        """Get the notebook document by the real-time get handler of Solr, or None if not found"""
+        now = time.monotonic()
+        if notebook_id in self._meta_cache:
+            expires, doc = self._meta_cache[notebook_id]
+            if expires > now:
+                self.meta_cache_hits += 1
+                return doc
+            del self._meta_cache[notebook_id]
+        self.meta_cache_misses += 1
+        urlquery = urlencode({'id': notebook_id, 'fl': ','.join(NOTEBOOK_META_FIELDS)})
+        response = await self._fetch('query', HTTPRequest(
+            urljoin(self.solr_base_url, f'solr/{self.solr_notebook}/get?{urlquery}'),
+            method='GET',
+            **self._http_kwargs(),
+        ))
+        if response.code >= 500:
+            raise HTTPError(response.code)
+        doc = self._loads(response).get('doc')
+        if doc is not None:
+            self._put_notebook_meta(notebook_id, doc, now)
+        return doc
+
+    async def get_notebook_metas(self, notebook_ids):
+        """Get the notebook documents of the ids by a single query, as a dict keyed by id"""
+        now = time.monotonic()
+        docs = {}
+        missing = []
+        for notebook_id in notebook_ids:
+            cached = self._meta_cache.get(notebook_id)
+            if cached is not None and cached[0] > now:
+                self.meta_cache_hits += 1
+                docs[notebook_id] = cached[1]
+            elif notebook_id not in missing:
+                self.meta_cache_misses += 1
+                missing.append(notebook_id)
+        if len(missing) == 0:
+            return docs
+        query = 'id:({})'.format(' OR '.join([_quote_phrase(i) for i in missing]))
+        urlquery = self._build_query(query, q_op='OR', rows=len(missing), fl=','.join(NOTEBOOK_META_FIELDS))
+        response = await self._fetch('query', HTTPRequest(
+            urljoin(self.solr_base_url, f'solr/{self.solr_notebook}/select?{urlquery}'),
+            method='GET',
+            **self._http_kwargs(),
+        ))
+        if response.code >= 500:
+            raise HTTPError(response.code)
+        for doc in self._loads(response)['response']['docs']:
+            docs[doc['id']] = doc
+            self._put_notebook_meta(doc['id'], doc, now)
+        return docs
+
+    def _put_notebook_meta(self, notebook_id, doc, now):
+        if self.solr_meta_cache_ttl <= 0:
+            return
+        self._meta_cache[notebook_id] = (now + self.solr_meta_cache_ttl, doc)
+        while len(self._meta_cache) > self.solr_meta_cache_size:
+            del self._meta_cache[next(iter(self._meta_cache))]
 
     async def _ensure_bucket(self, s3):
         buckets = await s3.list_buckets()
@@ -90,17 +585,285 @@ class NBSearchDB(Configurable):
         )
         async with session.client('s3', endpoint_url=self.s3_endpoint_url) as s3:
             await self._ensure_bucket(s3)
-            data = io.BytesIO(json.dumps(notebook_data, ensure_ascii=False).encode('utf8'))
-            await s3.upload_fileobj(data, self.s3_bucket_name, notebook_id)
+            body, offsets = _serialize_notebook(notebook_data)
+            await s3.upload_fileobj(io.BytesIO(body), self.s3_bucket_name, notebook_id)
+            if offsets is None:
+                return
+            cell_index = json.dumps({'size': len(body), 'cells': offsets}).encode('utf8')
+            await s3.upload_fileobj(io.BytesIO(cell_index), self.s3_bucket_name,
+                                    notebook_id + CELL_INDEX_SUFFIX)
+            if not self.s3_light_variant:
+                return
+            light = json.dumps(_strip_outputs(notebook_data), ensure_ascii=False).encode('utf8')
+            extra_args = {'ContentType': 'application/json'}
+            if self.s3_light_variant_compression:
+                light = gzip.compress(light)
+                extra_args['ContentEncoding'] = 'gzip'
+            await s3.upload_fileobj(io.BytesIO(light), self.s3_bucket_name,
+                                    notebook_id + LIGHT_VARIANT_SUFFIX, ExtraArgs=extra_args)
+
+    async def download_light(self, notebook_id):
+        """Get the notebook without outputs and attachments"""
+        session = aioboto3.Session(
+            aws_access_key_id=self.s3_access_key,
+            aws_secret_access_key=self.s3_secret_key,
+            region_name=self.s3_region_name,
+        )
+        async with session.client('s3', endpoint_url=self.s3_endpoint_url) as s3:
+            try:
+                started = time.perf_counter()
+                response = await s3.get_object(Bucket=self.s3_bucket_name,
+                                               Key=notebook_id + LIGHT_VARIANT_SUFFIX)
+                data = await response['Body'].read()
+                self.metrics.observe_s3_download('light', len(data), time.perf_counter() - started)
+                if response.get('ContentEncoding') == 'gzip':
+                    data = gzip.decompress(data)
+                return json.loads(data)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+                    raise
+        # Fall back to the whole notebook for notebooks uploaded without the variant
+        data = io.BytesIO()
+        await self.download_file(notebook_id, data)
+        return _strip_outputs(json.loads(data.getvalue()))
+
+    async def download_cells(self, notebook_id, start, end):
+        """Get cells[start:end] and the number of cells by a ranged GET using the cell index"""
+        session = aioboto3.Session(
+            aws_access_key_id=self.s3_access_key,
+            aws_secret_access_key=self.s3_secret_key,
+            region_name=self.s3_region_name,
+        )
+        async with session.client('s3', endpoint_url=self.s3_endpoint_url) as s3:
+            try:
+                response = await s3.get_object(Bucket=self.s3_bucket_name,
+                                               Key=notebook_id + CELL_INDEX_SUFFIX)
+                cell_index = json.loads(await response['Body'].read())
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+                    raise
+                cell_index = None
+            if cell_index is not None:
+                offsets = cell_index['cells']
+                start, end, _ = slice(start, end).indices(len(offsets))
+                if start >= end:
+                    return [], len(offsets)
+                started = time.perf_counter()
+                response = await s3.get_object(
+                    Bucket=self.s3_bucket_name,
+                    Key=notebook_id,
+                    Range=f'bytes={offsets[start][0]}-{offsets[end - 1][1] - 1}',
+                )
+                # The notebook has been replaced without the index if the size does not match
+                if response['ContentRange'].split('/')[-1] == str(cell_index['size']):
+                    data = await response['Body'].read()
+                    self.metrics.observe_s3_download('cells', len(data), time.perf_counter() - started)
+                    return json.loads(b'[' + data + b']'), len(offsets)
+        # Fall back to the whole notebook for notebooks uploaded without the index
+        data = io.BytesIO()
+        await self.download_file(notebook_id, data)
+        cells = json.loads(data.getvalue()).get('cells', [])
+        return cells[start:end], len(cells)
 
     async def download_file(self, notebook_id, f):
+        if self._cache is not None:
+            blob = await self._download_to_cache(notebook_id)
+            if inspect.iscoroutinefunction(f.write):
+                async for chunk in self._read_file(blob):
+                    await f.write(chunk)
+                return
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, _copy_to, blob, f)
+            return
         session = aioboto3.Session(
             aws_access_key_id=self.s3_access_key,
             aws_secret_access_key=self.s3_secret_key,
             region_name=self.s3_region_name,
         )
         async with session.client('s3', endpoint_url=self.s3_endpoint_url) as s3:
-            await s3.download_fileobj(self.s3_bucket_name, notebook_id, f)
+            started = time.perf_counter()
+            writer = _CountingWriter(f)
+            await s3.download_fileobj(self.s3_bucket_name, notebook_id, writer)
+            self.metrics.observe_s3_download('file', writer.size, time.perf_counter() - started)
+
+    def prefetch(self, notebook_ids, user=None, log=None):
+        """Warm the local notebook cache with the top search hits in the background"""
+        if self._cache is None or self.prefetch_top_n <= 0:
+            return
+        now = time.monotonic()
+        for notebook_id, (expires, _, done) in list(self._prefetched.items()):
+            if done and expires <= now:
+                del self._prefetched[notebook_id]
+        for notebook_id in notebook_ids[:self.prefetch_top_n]:
+            if notebook_id in self._prefetched:
+                continue
+            if self._prefetch_running.get(user, 0) >= self.prefetch_max_concurrency_per_user:
+                break
+            # Prefetches in progress count with the reserved size, so that concurrent
+            # searches of many users cannot start more than the budget
+            if sum([size for _, size, _ in self._prefetched.values()]) >= self.prefetch_max_bytes:
+                break
+            self._prefetch_running[user] = self._prefetch_running.get(user, 0) + 1
+            # Reserve the entry so that concurrent searches do not fetch it twice
+            self._prefetched[notebook_id] = (now + self.prefetch_ttl, self.prefetch_reserved_bytes, False)
+            task = asyncio.ensure_future(self._prefetch(notebook_id, user, log))
+            self._prefetch_tasks.add(task)
+            task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def _prefetch(self, notebook_id, user, log):
+        try:
+            with await self._download_to_cache(notebook_id, prefetch=True) as blob:
+                size = os.fstat(blob.fileno()).st_size
+            if notebook_id in self._prefetched:
+                self._prefetched[notebook_id] = (time.monotonic() + self.prefetch_ttl, size, True)
+            self.prefetch_issued += 1
+        except Exception as e:
+            self._prefetched.pop(notebook_id, None)
+            if log is not None:
+                log.warning(f'failed to prefetch {notebook_id}: {e}')
+        finally:
+            self._prefetch_running[user] -= 1
+            if self._prefetch_running[user] <= 0:
+                del self._prefetch_running[user]
+
+    async def _download_to_cache(self, notebook_id, prefetch=False):
+        """Return the cached blob of the notebook opened for reading, downloading it if needed
+
+        The blob is opened by the cache, so that it stays readable even if a concurrent
+        download evicts it. The caller must close the returned file.
+        """
+        loop = asyncio.get_running_loop()
+        if not prefetch:
+            prefetched = self._prefetched.pop(notebook_id, None)
+            # Reserved entries not done are still being prefetched
+            if prefetched is not None and prefetched[2]:
+                self.prefetch_hits += 1
+        entry = await loop.run_in_executor(None, self._cache.lookup, notebook_id)
+        if entry is not None:
+            blob, etag, validated_at = entry
+            if time.time() - validated_at < self.s3_cache_max_age:
+                self._cache.hits += 1
+                return blob
+            try:
+                return await self._fetch_to_cache(notebook_id, blob, etag)
+            except:
+                blob.close()
+                raise
+        return await self._fetch_to_cache(notebook_id)
+
+    async def _fetch_to_cache(self, notebook_id, blob=None, etag=None):
+        loop = asyncio.get_running_loop()
+        session = aioboto3.Session(
+            aws_access_key_id=self.s3_access_key,
+            aws_secret_access_key=self.s3_secret_key,
+            region_name=self.s3_region_name,
+        )
+        async with session.client('s3', endpoint_url=self.s3_endpoint_url) as s3:
+            kwargs = {}
+            if blob is not None:
+                kwargs['IfNoneMatch'] = etag
+            started = time.perf_counter()
+            try:
+                response = await s3.get_object(Bucket=self.s3_bucket_name, Key=notebook_id, **kwargs)
+            except ClientError as e:
+                if blob is None or e.response['Error']['Code'] not in ['304', 'NotModified']:
+                    raise
+                await loop.run_in_executor(None, self._cache.validated, notebook_id)
+                self._cache.hits += 1
+                return blob
+            if blob is not None:
+                blob.close()
+            self._cache.misses += 1
+            temp = await loop.run_in_executor(None, self._cache.temporary_file)
+            try:
+                body = response['Body']
+                size = 0
+                while True:
+                    chunk = await body.read(self.s3_stream_chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    await loop.run_in_executor(None, temp.write, chunk)
+                await loop.run_in_executor(None, temp.close)
+                self.metrics.observe_s3_download('cache', size, time.perf_counter() - started)
+                return await loop.run_in_executor(
+                    None, self._cache.commit, notebook_id, temp.name, response['ETag'],
+                )
+            except:
+                temp.close()
+                if os.path.exists(temp.name):
+                    os.remove(temp.name)
+                raise
+
+    async def get_parsed_notebook(self, notebook_id):
+        """Get the notebook and the heading levels of its cells, cached for repeated section requests"""
+        now = time.monotonic()
+        if notebook_id in self._parsed_notebook_cache:
+            expires, parsed = self._parsed_notebook_cache.pop(notebook_id)
+            if expires > now:
+                self._parsed_notebook_cache[notebook_id] = (expires, parsed)
+                self.parsed_notebook_cache_hits += 1
+                return parsed
+        self.parsed_notebook_cache_misses += 1
+        data = io.BytesIO()
+        await self.download_file(notebook_id, data)
+        notebook_data = json.loads(data.getvalue())
+        parsed = (notebook_data, solr.get_heading_levels(notebook_data.get('cells', [])))
+        if self.parsed_notebook_cache_ttl <= 0:
+            return parsed
+        self._parsed_notebook_cache[notebook_id] = (now + self.parsed_notebook_cache_ttl, parsed)
+        while len(self._parsed_notebook_cache) > self.parsed_notebook_cache_size:
+            del self._parsed_notebook_cache[next(iter(self._parsed_notebook_cache))]
+        return parsed
+
+    async def _read_file(self, f):
+        loop = asyncio.get_running_loop()
+        with f:
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, self.s3_stream_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def stream_file(self, notebook_id):
+        if self._cache is not None:
+            blob = await self._download_to_cache(notebook_id)
+            async for chunk in self._read_file(blob):
+                yield chunk
+            return
+        session = aioboto3.Session(
+            aws_access_key_id=self.s3_access_key,
+            aws_secret_access_key=self.s3_secret_key,
+            region_name=self.s3_region_name,
+        )
+        async with session.client('s3', endpoint_url=self.s3_endpoint_url) as s3:
+            started = time.perf_counter()
+            response = await s3.get_object(Bucket=self.s3_bucket_name, Key=notebook_id)
+            body = response['Body']
+            size = 0
+            while True:
+                chunk = await body.read(self.s3_stream_chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                yield chunk
+            self.metrics.observe_s3_download('stream', size, time.perf_counter() - started)
+
+    def start_request_profile(self):
+        """Start profiling an API request if it is sampled or may be slow, or return None"""
+        if not self.profile_dir:
+            return None
+        sampled = self.profile_sample_rate > 0 and random.random() < self.profile_sample_rate
+        if not sampled and self.profile_slow_threshold <= 0:
+            return None
+        return start_profile(engine=self.profile_engine, sampled=sampled)
+
+    def finish_request_profile(self, profile, name, duration):
+        """Stop profiling and write the profile if the request was sampled or slow, returning the path"""
+        profile.stop()
+        if not profile.sampled and duration < self.profile_slow_threshold:
+            return None
+        return profile.save(self.profile_dir, f'{name}-{int(duration * 1000)}ms')
 
     def _http_kwargs(self):
         if self.solr_basic_auth_username or self.solr_basic_auth_password:
@@ -113,8 +876,72 @@ class NBSearchDB(Configurable):
 
 
 
+def _percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[max(1, int(math.ceil(p / 100 * len(sorted_values)))) - 1]
+
+
+@contextlib.contextmanager
+def _timed(timings, stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+
+class UpdateIndexReport(object):
+    """Time spent in each stage of indexing per notebook"""
+
+    def __init__(self):
+        self.notebooks = []
+        self.started = time.perf_counter()
+
+    def add(self, path, size, timings, failed=False):
+        self.notebooks.append({
+            'path': path,
+            'size': size,
+            'failed': failed,
+            'total': sum(timings.values()),
+            'timings': dict([(stage, timings.get(stage, 0.0)) for stage in UPDATE_INDEX_STAGES]),
+        })
+
+    def summarize(self, slowest=10):
+        elapsed = time.perf_counter() - self.started
+        stages = {}
+        for stage in UPDATE_INDEX_STAGES:
+            values = sorted([n['timings'][stage] for n in self.notebooks])
+            stages[stage] = {
+                'total': sum(values),
+                'p50': _percentile(values, 50),
+                'p95': _percentile(values, 95),
+                'p99': _percentile(values, 99),
+                'max': values[-1] if len(values) > 0 else None,
+            }
+        return {
+            'elapsed': elapsed,
+            'notebooks': len(self.notebooks),
+            'failed': len([n for n in self.notebooks if n['failed']]),
+            'bytes': sum([n['size'] for n in self.notebooks]),
+            'notebooks_per_second': len(self.notebooks) / elapsed if elapsed > 0 else None,
+            'stages': stages,
+            'slowest': sorted(self.notebooks, key=lambda n: -n['total'])[:slowest],
+        }
+
+
 class UpdateIndexHandler(LoggingConfigurable):
 
+    report_path = Unicode('', help='The file to write the JSON report of the time spent in each stage of indexing (disabled if empty)').tag(config=True)
+
+    report_slowest = Int(10, help='The number of the slowest notebooks in the report').tag(config=True)
+
+    profile_dir = Unicode('', help='The directory to write profiles of indexing notebooks (disabled if empty)').tag(config=True)
+
+    profile_paths = List(Unicode(), help='The glob patterns of the paths of notebooks to profile while indexing').tag(config=True)
+
+    profile_engine = CaselessStrEnum(['auto', 'cprofile', 'pyinstrument'], 'auto', help='The profiler, auto uses pyinstrument if installed and cProfile otherwise').tag(config=True)
+
     def __init__(self, **kwargs):
         super(UpdateIndexHandler, self).__init__(**kwargs)
 
@@ -124,28 +951,89 @@ class UpdateIndexHandler(LoggingConfigurable):
         db = NBSearchDB(config=self.config)
         source = get_source(source_path, self.config)
 
+        compact = await db.get_compact_documents(log=self.log)
+        self.log.info('compact documents: {}'.format(compact))
         updated = 0
         failed = []
-        for file in source.get_files():
-            if path is not None and os.path.split(file['path'])[-1] != os.path.split(path)[-1]:
-                continue
+        report = UpdateIndexReport()
+        files = source.get_files()
+        while True:
+            timings = {}
+            with _timed(timings, 'discover'):
+                file = next(files, None)
+                while file is not None and path is not None and \
+                        os.path.split(file['path'])[-1] != os.path.split(path)[-1]:
+                    file = next(files, None)
+            if file is None:
+                break
+            size = 0
+            profile = self._start_profile(file['path'])
             try:
-                notebook_data = source.get_notebook(file['server'], file['path'])
+                with _timed(timings, 'read'):
+                    data = source.read_notebook(file['server'], file['path'])
+                size = len(data)
+                with _timed(timings, 'parse'):
+                    notebook_data = json.loads(data)
                 attr = dict([(k, v) for k, v in file.items()
                              if k in ['server', 'owner', 'mtime', 'ctime', 'atime'] and v is not None])
-                r = solr.ipynb_to_documents(file['path'], notebook_data, attr=attr)
+                with _timed(timings, 'documents'):
+                    r = solr.ipynb_to_documents(file['path'], notebook_data, attr=attr,
+                                                meme_encoding=db.solr_meme_encoding,
+                                                compact=compact,
+                                                timings=timings)
+                # Markdown is parsed while building the documents
+                timings['documents'] -= timings.get('markdown', 0.0)
                 results = []
                 for core, docs in r.items():
                     self.log.info(f"{file['path']} - {core}")
-                    await db.post_document(core, docs)
+                    with _timed(timings, 'solr'):
+                        await db.post_document(core, docs)
                     updated += 1
                     if core != 'jupyter-notebook':
                         continue
-                    await db.upload_file(docs[0]['id'], notebook_data)
+                    with _timed(timings, 's3'):
+                        await db.upload_file(docs[0]['id'], notebook_data)
                 updated += 1
+                report.add(file['path'], size, timings)
             except:
                 self.log.exception('failed to update index for {}'.format(file['path']))
                 failed.append(file)
+                report.add(file['path'], size, timings, failed=True)
+            finally:
+                if profile is not None:
+                    self._finish_profile(profile, file['path'])
         self.log.info('finished: {} updates, {} fails'.format(updated, len(failed)))
+        self._write_report(report.summarize(slowest=self.report_slowest))
         if len(failed) > 0:
             raise RuntimeError('Failed to update: {}'.format(','.join([f['path'] for f in failed])))
+
+    def _start_profile(self, path):
+        if not self.profile_dir or not any([fnmatch(path, pattern) for pattern in self.profile_paths]):
+            return None
+        return start_profile(engine=self.profile_engine, sampled=True)
+
+    def _finish_profile(self, profile, path):
+        profile.stop()
+        try:
+            self.log.info('profile of {}: {}'.format(path, profile.save(self.profile_dir, 'index-' + path)))
+        except Exception:
+            self.log.exception('failed to write the profile of {}'.format(path))
+
+    def _write_report(self, summary):
+        self.log.info('{} notebooks, {} bytes in {:.3f}s'.format(
+            summary['notebooks'], summary['bytes'], summary['elapsed'],
+        ))
+        for stage, stats in summary['stages'].items():
+            if stats['max'] is None:
+                continue
+            self.log.info('{}: total {:.3f}s, p50 {:.3f}s, p95 {:.3f}s, p99 {:.3f}s'.format(
+                stage, stats['total'], stats['p50'], stats['p95'], stats['p99'],
+            ))
+        for notebook in summary['slowest']:
+            stages = ', '.join(['{} {:.3f}s'.format(stage, notebook['timings'][stage])
+                                for stage in UPDATE_INDEX_STAGES])
+            self.log.info('slow: {} {:.3f}s ({})'.format(notebook['path'], notebook['total'], stages))
+        if not self.report_path:
+            return
+        with open(self.report_path, 'w') as f:
+            json.dump(summary, f, indent=2)
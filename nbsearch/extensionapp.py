@@ -9,6 +9,7 @@ from traitlets.config.application import Application
 from traitlets import Dict, List
 
 from .db import UpdateIndexHandler
+from .analyze import AnalyzeIndexHandler, format_summary
 
 
 class UpdateIndexApp(Application):
@@ -22,7 +23,8 @@ class UpdateIndexApp(Application):
     """
 
     classes = List([UpdateIndexHandler])
-    aliases = Dict({'log-level': 'Application.log_level'})
+    aliases = Dict({'log-level': 'Application.log_level',
+                    'report': 'UpdateIndexHandler.report_path'})
     flags = Dict({'debug': ({'Application': {'log_level': 10}},
                             'Set loglevel to DEBUG')})
 
@@ -41,6 +43,39 @@ class UpdateIndexApp(Application):
         asyncio.run(self.handler.update(config_path, source, path))
 
 
+class AnalyzeIndexApp(Application):
+    """Analyze the size of the documents for Solr"""
+    name = "jupyter nbsearch analyze-index"
+    description = "Analyze the size of the documents for Solr without posting them"
+    version = __version__
+
+    examples = """
+        jupyter nbsearch analyze-index [options] <config-path> <source>
+    """
+
+    classes = List([AnalyzeIndexHandler])
+    aliases = Dict({'log-level': 'Application.log_level',
+                    'sample': 'AnalyzeIndexHandler.sample_size',
+                    'seed': 'AnalyzeIndexHandler.sample_seed',
+                    'top': 'AnalyzeIndexHandler.top',
+                    'report': 'AnalyzeIndexHandler.report_path'})
+    flags = Dict({'debug': ({'Application': {'log_level': 10}},
+                            'Set loglevel to DEBUG')})
+
+    @catch_config_error
+    def initialize(self, argv=None):
+        super(AnalyzeIndexApp, self).initialize(argv)
+        self.handler = AnalyzeIndexHandler(config=self.config)
+
+    def start(self):
+        if len(self.extra_args) < 2:
+            self.print_help()
+            sys.exit(-1)
+        config_path = self.extra_args[0]
+        source = self.extra_args[1]
+        print(format_summary(self.handler.analyze(config_path, source)))
+
+
 class ExtensionApp(Application):
     '''CLI for extension management.'''
     name = u'jupyter_nbsearch extension'
@@ -55,6 +90,10 @@ class ExtensionApp(Application):
             UpdateIndexApp,
             "Update Index of Solr"
         ),
+        "analyze-index": (
+            AnalyzeIndexApp,
+            "Analyze the size of the documents for Solr"
+        ),
     })
 
     def _classes_default(self):
@@ -0,0 +1,144 @@
+import contextvars
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 1KiB to 256MiB
+SIZE_BUCKETS = tuple([1024 * (4 ** i) for i in range(10)])
+
+
+class RequestTrace(object):
+    """Time spent in Solr, S3 and serialization, and the Solr queries of an API request"""
+
+    def __init__(self):
+        self.durations = {'solr': 0.0, 's3': 0.0, 'serialize': 0.0}
+        self.queries = []
+
+    def add(self, name, duration):
+        self.durations[name] += duration
+
+    def server_timing(self, total):
+        """The value of the Server-Timing header in milliseconds"""
+        entries = list(self.durations.items()) + [('total', total)]
+        return ', '.join(['{};dur={:.1f}'.format(name, duration * 1000) for name, duration in entries])
+
+
+# Tasks started by the request copy the context and share its trace
+_current_trace = contextvars.ContextVar('nbsearch_request_trace', default=None)
+
+
+def start_trace():
+    trace = RequestTrace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class _CacheCollector(object):
+    """Hits and misses of the caches of NBSearchDB, read from its counters on each scrape"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def _stats(self):
+        stats = {
+            'notebook_meta': (self.db.meta_cache_hits, self.db.meta_cache_misses),
+            'parsed_notebook': (self.db.parsed_notebook_cache_hits, self.db.parsed_notebook_cache_misses),
+        }
+        if self.db._cache is not None:
+            stats['notebook_file'] = (self.db._cache.hits, self.db._cache.misses)
+        return stats
+
+    def collect(self):
+        hits = CounterMetricFamily('nbsearch_cache_hits', 'Lookups served from the cache', labels=['cache'])
+        misses = CounterMetricFamily('nbsearch_cache_misses', 'Lookups not served from the cache', labels=['cache'])
+        ratio = GaugeMetricFamily('nbsearch_cache_hit_ratio', 'Ratio of lookups served from the cache', labels=['cache'])
+        for cache, (cache_hits, cache_misses) in sorted(self._stats().items()):
+            hits.add_metric([cache], cache_hits)
+            misses.add_metric([cache], cache_misses)
+            if cache_hits + cache_misses > 0:
+                ratio.add_metric([cache], cache_hits / (cache_hits + cache_misses))
+        yield hits
+        yield misses
+        yield ratio
+        if self.db._cache is None:
+            return
+        yield CounterMetricFamily('nbsearch_prefetch_issued', 'Notebooks prefetched into the cache',
+                                  value=self.db.prefetch_issued)
+        yield CounterMetricFamily('nbsearch_prefetch_hits', 'Prefetched notebooks requested afterwards',
+                                  value=self.db.prefetch_hits)
+        if self.db.prefetch_issued > 0:
+            yield GaugeMetricFamily('nbsearch_prefetch_hit_ratio', 'Ratio of prefetched notebooks requested afterwards',
+                                    value=self.db.prefetch_hits / self.db.prefetch_issued)
+
+
+class NBSearchMetrics(object):
+    """Prometheus metrics of the API handlers and the NBSearchDB they use, in a registry of their own"""
+
+    def __init__(self, db):
+        self.registry = CollectorRegistry()
+        self.request_duration = Histogram(
+            'nbsearch_request_duration_seconds', 'Latency of API requests',
+            ['endpoint', 'method', 'code'], buckets=LATENCY_BUCKETS, registry=self.registry,
+        )
+        self.response_size = Histogram(
+            'nbsearch_response_size_bytes', 'Size of API responses',
+            ['endpoint'], buckets=SIZE_BUCKETS, registry=self.registry,
+        )
+        self.requests_in_flight = Gauge(
+            'nbsearch_requests_in_flight', 'API requests being processed',
+            ['endpoint'], registry=self.registry,
+        )
+        self.solr_request_duration = Histogram(
+            'nbsearch_solr_request_duration_seconds', 'Round-trip time of requests to Solr, per attempt',
+            ['kind'], buckets=LATENCY_BUCKETS, registry=self.registry,
+        )
+        self.solr_qtime = Histogram(
+            'nbsearch_solr_qtime_seconds', 'QTime reported by Solr',
+            buckets=LATENCY_BUCKETS, registry=self.registry,
+        )
+        self.s3_download_duration = Histogram(
+            'nbsearch_s3_download_duration_seconds', 'Time to download objects from S3',
+            ['operation'], buckets=LATENCY_BUCKETS, registry=self.registry,
+        )
+        self.s3_download_bytes = Counter(
+            'nbsearch_s3_download_bytes', 'Bytes downloaded from S3',
+            ['operation'], registry=self.registry,
+        )
+        self.registry.register(_CacheCollector(db))
+
+    def request_started(self, endpoint):
+        self.requests_in_flight.labels(endpoint).inc()
+
+    def request_finished(self, endpoint, method, code, duration, size):
+        self.requests_in_flight.labels(endpoint).dec()
+        self.request_duration.labels(endpoint, method, str(code)).observe(duration)
+        self.response_size.labels(endpoint).observe(size)
+
+    def observe_solr(self, kind, duration):
+        self.solr_request_duration.labels(kind).observe(duration)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add('solr', duration)
+
+    def observe_solr_result(self, result):
+        header = result.get('responseHeader') if isinstance(result, dict) else None
+        if header is not None and 'QTime' in header:
+            self.solr_qtime.observe(header['QTime'] / 1000)
+
+    def observe_s3_download(self, operation, size, duration):
+        self.s3_download_bytes.labels(operation).inc(size)
+        self.s3_download_duration.labels(operation).observe(duration)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add('s3', duration)
+
+    def generate(self):
+        """Render the metrics in the Prometheus text format"""
+        return generate_latest(self.registry)
@@ -0,0 +1,74 @@
+import cProfile
+import os
+import re
+import time
+import uuid
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+# cProfile and pyinstrument hook the whole thread, so only one profile runs at a time
+_active = None
+
+
+class Profile(object):
+    """A profile of the thread by cProfile or pyinstrument, written as .prof or .html"""
+
+    def __init__(self, engine='auto', sampled=False):
+        if engine == 'auto':
+            engine = 'pyinstrument' if pyinstrument is not None else 'cprofile'
+        if engine == 'pyinstrument' and pyinstrument is None:
+            raise ValueError('pyinstrument is not installed')
+        self.engine = engine
+        self.sampled = sampled
+        self._profiler = None
+
+    def start(self):
+        if self.engine == 'pyinstrument':
+            self._profiler = pyinstrument.Profiler(async_mode='disabled')
+            self._profiler.start()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self):
+        global _active
+        if self._profiler is None:
+            return
+        if self.engine == 'pyinstrument':
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+        if _active is self:
+            _active = None
+
+    def save(self, profile_dir, name):
+        """Write the profile into the directory with a filename starting with the time and the name"""
+        os.makedirs(profile_dir, exist_ok=True)
+        filename = '{}-{}-{}'.format(
+            time.strftime('%Y%m%dT%H%M%S'),
+            re.sub(r'[^0-9A-Za-z._-]+', '_', name).strip('_'),
+            uuid.uuid4().hex[:8],
+        )
+        if self.engine == 'pyinstrument':
+            path = os.path.join(profile_dir, filename + '.html')
+            with open(path, 'w', encoding='utf8') as f:
+                f.write(self._profiler.output_html())
+        else:
+            path = os.path.join(profile_dir, filename + '.prof')
+            self._profiler.dump_stats(path)
+        return path
+
+
+def start_profile(engine='auto', sampled=False):
+    """Start profiling the thread, or return None if another profile is running"""
+    global _active
+    if _active is not None:
+        return None
+    profile = Profile(engine=engine, sampled=sampled)
+    profile.start()
+    _active = profile
+    return profile
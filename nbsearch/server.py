@@ -8,8 +8,15 @@ from .handlers import (MainHandler)
 from .v1.handlers import (
     NBSEARCH_TMP,
     SearchHandler,
+    CombinedSearchHandler,
+    ExportHandler,
     ImportHandler,
+    BulkImportHandler,
     DataHandler,
+    CellsHandler,
+    SectionHandler,
+    DiffHandler,
+    MetricsHandler,
 )
 
 
@@ -34,9 +41,16 @@ def get_api_handlers(parent_app, base_dir):
     handler_settings['base_dir'] = base_dir
 
     return [
+        (r"/v1/search", CombinedSearchHandler, handler_settings),
         (r"/v1/(?P<target>[^\/]+)/search", SearchHandler, handler_settings),
+        (r"/v1/(?P<target>[^\/]+)/export", ExportHandler, handler_settings),
+        (r"/v1/import", BulkImportHandler, handler_settings),
         (r"/v1/import(?P<path>/.+)?/(?P<id>[^\/]+)", ImportHandler, handler_settings),
         (r"/v1/data/(?P<id>[^\/]+)", DataHandler, handler_settings),
+        (r"/v1/data/(?P<id>[^\/]+)/cells", CellsHandler, handler_settings),
+        (r"/v1/data/(?P<id>[^\/]+)/section", SectionHandler, handler_settings),
+        (r"/v1/diff", DiffHandler, handler_settings),
+        (r"/metrics", MetricsHandler, handler_settings),
     ]
 
 
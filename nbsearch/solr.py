@@ -1,7 +1,10 @@
+from difflib import SequenceMatcher
+import hashlib
 import io
 import json
 import os
 import re
+import time
 from datetime import datetime
 import pytz
 import requests
@@ -10,6 +13,25 @@ import mistletoe
 from mistletoe.ast_renderer import ASTRenderer
 
 
+# Fields copied into source and _text_ by copyField rules of the schemas in compact documents
+COMPACT_TEXT_FIELDS = ['source__code', 'source__markdown']
+
+COMPACT_OUTPUT_FIELDS = ['outputs__stdout', 'outputs__stderr', 'outputs__result_plain', 'outputs__result_html']
+
+# copyField rules (source, dest) filling the fields left out of compact documents
+COMPACT_COPY_FIELDS = [(f, 'source') for f in COMPACT_TEXT_FIELDS] + \
+    [(f, 'outputs') for f in COMPACT_OUTPUT_FIELDS] + \
+    [(f, '_text_') for f in COMPACT_TEXT_FIELDS + COMPACT_OUTPUT_FIELDS]
+
+
+def has_compact_copy_fields(core, copy_fields):
+    """Whether the copyField rules (source, dest) of the core fill the fields left out of compact documents"""
+    required = COMPACT_COPY_FIELDS
+    if core == 'jupyter-notebook':
+        required = required + [('filename', '_text_')]
+    return set(required) <= set(copy_fields)
+
+
 def notebook_to_notebook_id(path, notebook_data):
     _, filename = os.path.split(path)
     if 'metadata' not in notebook_data:
@@ -144,42 +166,120 @@ def _get_markdown_ast_heading_levels(ast):
         return None
     return (pre_r, post_r)
 
-def _get_markdown_heading_levels(cell):
+def _markdown_ast(markdown, timings=None):
+    if timings is None:
+        return json.loads(mistletoe.markdown(markdown, ASTRenderer))
+    started = time.perf_counter()
+    ast = json.loads(mistletoe.markdown(markdown, ASTRenderer))
+    timings['markdown'] = timings.get('markdown', 0.0) + time.perf_counter() - started
+    return ast
+
+def _get_markdown_heading_levels(cell, timings=None):
     if cell['cell_type'] != 'markdown' or 'source' not in cell:
         return None
     markdown = ''.join(cell['source'])
-    ast = json.loads(mistletoe.markdown(markdown, ASTRenderer))
+    ast = _markdown_ast(markdown, timings=timings)
     return _get_markdown_ast_heading_levels(ast)
 
 def _find_section_beginning(headings, index, start_level=None):
-    if index == 0:
-        return 0
-    current = headings[index]
-    if current is not None:
-        if start_level is None:
-            return index
-        if start_level - 1 >= current[0]:
-            return index
-    return _find_section_beginning(headings, index - 1, start_level=start_level)
+    while index > 0:
+        current = headings[index]
+        if current is not None:
+            if start_level is None:
+                return index
+            if start_level - 1 >= current[0]:
+                return index
+        index -= 1
+    return 0
 
 def _find_section_ending(headings, index, start_level=None):
     if index + 1 >= len(headings):
         return len(headings)
     current_levels = [h[-1] for h in headings[:index + 1] if h is not None]
-    post = headings[index + 1]
     if len(current_levels) == 0:
         # If there is no preceding heading, then it will be applied to the end.
         return len(headings)
-    if post is None:
-        return _find_section_ending(headings, index + 1, start_level=start_level)
     current_level = start_level if start_level is not None else current_levels[-1]
-    post_level, _ = post
-    if current_level < post_level:
-        return _find_section_ending(headings, index + 1, start_level=current_level)
-    return index + 1
+    # Iterate instead of recursing so that notebooks with thousands of cells do not exceed the recursion limit
+    while index + 1 < len(headings):
+        post = headings[index + 1]
+        if post is not None:
+            post_level, _ = post
+            if current_level >= post_level:
+                return index + 1
+        index += 1
+    return len(headings)
 
-def markdown_to_solr_fields(markdown, prefix=''):
-    ast = json.loads(mistletoe.markdown(markdown, ASTRenderer))
+def get_heading_levels(cells, timings=None):
+    return [_get_markdown_heading_levels(c, timings=timings) for c in cells]
+
+def find_cell_by_meme(cells, meme):
+    for i, cell in enumerate(cells):
+        if _get_current_meme(cell) == meme:
+            return i
+    return None
+
+def find_section(heading_levels, index):
+    """Get [beginning, ending) of the section containing the cell, or starting at the cell if it is a heading"""
+    if heading_levels[index] is not None:
+        beginning = index
+    else:
+        beginning = _find_section_beginning(heading_levels, index)
+    ending = _find_section_ending(heading_levels, index)
+    return beginning, ending
+
+def _get_cell_hash(cell, include_outputs=False):
+    # Metadata is ignored since MEMEs of neighbors change on every insertion
+    keys = ['cell_type', 'source', 'outputs'] if include_outputs else ['cell_type', 'source']
+    content = dict([(k, v) for k, v in cell.items() if k in keys])
+    if isinstance(content.get('source'), list):
+        content['source'] = ''.join(content['source'])
+    data = json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf8')
+    return hashlib.sha1(data).hexdigest()
+
+def _get_cell_key(cell):
+    meme = _get_current_meme(cell)
+    if meme is not None:
+        return 'meme:' + meme
+    return 'hash:' + _get_cell_hash(cell)
+
+def _diff_hunk(op, left_cells, left_start, left_end, right_cells, right_start, right_end):
+    return {
+        'op': op,
+        'left': {'start': left_start, 'end': left_end, 'cells': left_cells[left_start:left_end]},
+        'right': {'start': right_start, 'end': right_end, 'cells': right_cells[right_start:right_end]},
+    }
+
+def diff_cells(left_cells, right_cells):
+    """Get the changed hunks between the cells, matched by MEME or by content if no MEME"""
+    matcher = SequenceMatcher(
+        None,
+        [_get_cell_key(c) for c in left_cells],
+        [_get_cell_key(c) for c in right_cells],
+        autojunk=False,
+    )
+    hunks = []
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op != 'equal':
+            hunks.append(_diff_hunk(op, left_cells, i1, i2, right_cells, j1, j2))
+            continue
+        # Cells with the same MEME may have been edited
+        changed = None
+        for offset in range(i2 - i1 + 1):
+            modified = offset < i2 - i1 and \
+                _get_cell_hash(left_cells[i1 + offset], True) != _get_cell_hash(right_cells[j1 + offset], True)
+            if modified and changed is None:
+                changed = offset
+            elif not modified and changed is not None:
+                hunks.append(_diff_hunk(
+                    'replace', left_cells, i1 + changed, i1 + offset,
+                    right_cells, j1 + changed, j1 + offset,
+                ))
+                changed = None
+    return hunks
+
+def markdown_to_solr_fields(markdown, prefix='', timings=None):
+    ast = _markdown_ast(markdown, timings=timings)
     r = {}
     r = markdown_ast_to_solr_fields(r, ast, prefix=prefix)
 
@@ -201,7 +301,8 @@ def markdown_to_solr_fields(markdown, prefix=''):
 
     return r
 
-def cell_to_solr_document(notebook_id, path, cell, cell_index, cells=None, notebook_attr=None):
+def cell_to_solr_document(notebook_id, path, cell, cell_index, cells=None, notebook_attr=None,
+                          meme_encoding='lists', heading_levels=None, compact=False, timings=None):
     doc = {
         'id': notebook_id + f'_{cell_index}',
         'index': cell_index,
@@ -222,13 +323,20 @@ def cell_to_solr_document(notebook_id, path, cell, cell_index, cells=None, noteb
     if 'metadata' in cell and 'lc_cell_meme' in cell['metadata']:
         doc.update(_meme_to_solr_document(cell['metadata']['lc_cell_meme']))
     if cells is not None:
-        all_memes = [_get_current_meme(c) for c in cells]
-        all_heading_levels = [_get_markdown_heading_levels(c) for c in cells]
+        all_heading_levels = heading_levels if heading_levels is not None else get_heading_levels(cells)
         current_heading_level_ = all_heading_levels[cell_index]
         if current_heading_level_ is None:
             current_heading_level = None
         else:
             current_heading_level, _ = current_heading_level_
+    if cells is not None and meme_encoding == 'positions':
+        # Neighborhoods are resolved by NBSearchDB as ranges of `index` instead of meme lists
+        doc['lc_cell_position__section_beginning'] = _find_section_beginning(
+            all_heading_levels, cell_index, start_level=current_heading_level,
+        )
+        doc['lc_cell_position__section_ending'] = _find_section_ending(all_heading_levels, cell_index)
+    elif cells is not None:
+        all_memes = [_get_current_meme(c) for c in cells]
         doc['lc_cell_memes__previous__in_notebook'] = ' '.join(
             [meme for meme in all_memes[:cell_index] if meme is not None]
         )
@@ -248,32 +356,45 @@ def cell_to_solr_document(notebook_id, path, cell, cell_index, cells=None, noteb
     if cell['cell_type'] == 'code' and 'source' in cell:
         code = ''.join(cell['source'])
         doc['source__code'] = code
-        doc['source'] = code
+        if not compact:
+            doc['source'] = code
     if cell['cell_type'] == 'markdown' and 'source' in cell:
         markdown = ''.join(cell['source'])
         doc['source__markdown'] = markdown
-        doc['source'] = markdown
-        doc.update(markdown_to_solr_fields(markdown, prefix='source__markdown__'))
-    doc['_text_'] = doc['source'] if 'source' in doc else ''
+        if not compact:
+            doc['source'] = markdown
+        doc.update(markdown_to_solr_fields(markdown, prefix='source__markdown__', timings=timings))
+    if not compact:
+        doc['_text_'] = doc['source'] if 'source' in doc else ''
     if 'notebook_mtime' in doc or 'lc_cell_meme__execution_end_time' in doc:
         doc['estimated_mtime'] = doc['lc_cell_meme__execution_end_time'] if 'lc_cell_meme__execution_end_time' in doc else doc['notebook_mtime']
-    if 'outputs' not in cell:
-        return doc
-    for output in cell['outputs']:
-        if 'output_type' in output and output['output_type'] == 'execute_result':
-            if 'data' in output and 'text/plain' in output['data']:
-                doc['outputs__result_plain'] = ''.join(output['data']['text/plain'])
-            if 'data' in output and 'text/html' in output['data']:
-                doc['outputs__result_html'] = ''.join(output['data']['text/html'])
-            continue
-        if 'name' not in output or output['name'] not in ['stdout', 'stderr']:
-            continue
-        doc['outputs__{}'.format(output['name'])] = ''.join(output['text'])
-    doc['outputs'] = ' '.join([doc[k] for k in sorted(doc.keys()) if k.split('_')[0] == 'outputs'])
-    doc['_text_'] += '\n' + doc['outputs']
+    if 'outputs' in cell:
+        for output in cell['outputs']:
+            if 'output_type' in output and output['output_type'] == 'execute_result':
+                if 'data' in output and 'text/plain' in output['data']:
+                    doc['outputs__result_plain'] = ''.join(output['data']['text/plain'])
+                if 'data' in output and 'text/html' in output['data']:
+                    doc['outputs__result_html'] = ''.join(output['data']['text/html'])
+                continue
+            if 'name' not in output or output['name'] not in ['stdout', 'stderr']:
+                continue
+            doc['outputs__{}'.format(output['name'])] = ''.join(output['text'])
+        if not compact:
+            doc['outputs'] = ' '.join([doc[k] for k in sorted(doc.keys()) if k.split('_')[0] == 'outputs'])
+            doc['_text_'] += '\n' + doc['outputs']
+    if compact and not any([k in COMPACT_TEXT_FIELDS or k.startswith('outputs__') for k in doc.keys()]):
+        # _text_ is required and nothing is copied into it by Solr
+        doc['_text_'] = ''
     return doc
 
-def notebook_to_solr_document(path, notebook_data, attr=None, user_pattern=None):
+def _join_field(texts):
+    # The same result as adding each text by _add_field, joined at once
+    for i, text in enumerate(texts):
+        if len(text) > 0:
+            return '\n'.join(texts[i:])
+    return ''
+
+def notebook_to_solr_document(path, notebook_data, attr=None, user_pattern=None, compact=False, cell_docs=None):
     notebook_id = notebook_to_notebook_id(path, notebook_data)
     _, filename = os.path.split(path)
     doc = {
@@ -285,24 +406,27 @@ def notebook_to_solr_document(path, notebook_data, attr=None, user_pattern=None)
     memes = []
     if 'cells' not in notebook_data:
         return doc
+    if cell_docs is None:
+        cell_docs = [cell_to_solr_document(notebook_id, path, cell, i, compact=compact)
+                     for i, cell in enumerate(notebook_data['cells'])]
     execution_end_times = []
-    doc['source'] = ''
-    doc['outputs'] = ''
-    for i, cell in enumerate(notebook_data['cells']):
+    texts = {} if compact else {'source': [], 'outputs': []}
+    for cell, fields in zip(notebook_data['cells'], cell_docs):
         if 'metadata' in cell and 'lc_cell_meme' in cell['metadata'] and 'current' in cell['metadata']['lc_cell_meme']:
             memes.append(cell['metadata']['lc_cell_meme']['current'])
-        fields = cell_to_solr_document(notebook_id, path, cell, i)
         for k, v in fields.items():
             if k == 'lc_cell_meme__execution_end_time':
                 execution_end_times.append(v)
                 continue
             if k.split('_')[0] not in ['outputs', 'source']:
                 continue
-            _add_field(doc, k, v)
+            texts.setdefault(k, []).append(v)
+    doc.update([(k, _join_field(v)) for k, v in texts.items()])
     doc['lc_cell_memes'] = ' '.join(memes)
     if len(execution_end_times) > 0:
         doc['lc_cell_meme__execution_end_time'] = sorted(execution_end_times)[-1]
-    doc['_text_'] = doc['filename'] + '\n' + doc['source'] + '\n' + doc['outputs']
+    if not compact:
+        doc['_text_'] = doc['filename'] + '\n' + doc['source'] + '\n' + doc['outputs']
     if 'source__markdown__heading' in doc:
         doc['source__markdown__heading_count'] = str(len(doc['source__markdown__heading'].split('\n')))
     else:
@@ -329,20 +453,31 @@ def _get_notebook_attr(notebook_data, base_attr=None):
         attr['server'] = attr['signature_server_url']
     return attr
 
-def ipynb_to_documents(path, notebook_data, attr=None, user_pattern=None):
+def ipynb_to_documents(path, notebook_data, attr=None, user_pattern=None, meme_encoding='lists', compact=False,
+                       timings=None):
+    """Build the documents for each core, adding the seconds spent parsing markdown to timings['markdown'] if given"""
     notebook_attr = _get_notebook_attr(notebook_data, base_attr=attr)
-    notebook_docs = notebook_to_solr_document(path, notebook_data, attr=notebook_attr, user_pattern=user_pattern)
     notebook_id = notebook_to_notebook_id(path, notebook_data)
     if 'cells' not in notebook_data:
+        notebook_docs = notebook_to_solr_document(path, notebook_data, attr=notebook_attr, user_pattern=user_pattern,
+                                                  compact=compact)
         return {
             'jupyter-notebook': [notebook_docs],
         }
+    heading_levels = get_heading_levels(notebook_data['cells'], timings=timings)
     cell_docs = [cell_to_solr_document(
                     notebook_id, path, cell, cell_index,
                     cells=notebook_data['cells'],
-                    notebook_attr=notebook_attr
+                    notebook_attr=notebook_attr,
+                    meme_encoding=meme_encoding,
+                    heading_levels=heading_levels,
+                    compact=compact,
+                    timings=timings,
                  )
                  for cell_index, cell in enumerate(notebook_data['cells'])]
+    # The notebook document is folded from the cell documents instead of converting the cells again
+    notebook_docs = notebook_to_solr_document(path, notebook_data, attr=notebook_attr, user_pattern=user_pattern,
+                                              compact=compact, cell_docs=cell_docs)
     return {
         'jupyter-cell': cell_docs,
         'jupyter-notebook': [notebook_docs],
@@ -33,6 +33,9 @@ class Source(LoggingConfigurable):
     def get_notebook(self, server, path):
         raise NotImplementedError()
 
+    def read_notebook(self, server, path):
+        raise NotImplementedError()
+
     def prepare(self):
         pass
 
@@ -57,10 +60,16 @@ class LocalSource(Source):
         return self._get_files(self.base_dir, '')
 
     def get_notebook(self, server, path):
+        data = self.read_notebook(server, path)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def read_notebook(self, server, path):
         if self.server != server:
             return None
-        with open(os.path.join(self.base_dir, path), 'r') as f:
-            return json.load(f)
+        with open(os.path.join(self.base_dir, path), 'rb') as f:
+            return f.read()
 
     def _get_files(self, actual_base_dir, db_base_dir, check_ignore_base=None):
         ignore_file = os.path.join(actual_base_dir, '.nbsearchignore')
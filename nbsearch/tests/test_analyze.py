@@ -0,0 +1,61 @@
+import json
+import os
+import tempfile
+
+from nbsearch.analyze import AnalyzeIndexHandler, format_summary, truncate_outputs
+
+
+NOTEBOOK = {
+    'cells': [
+        {'cell_type': 'markdown', 'source': ['# Heading'], 'metadata': {}},
+        {'cell_type': 'code', 'source': ['print("x" * 5000)'], 'metadata': {}, 'outputs': [
+            {'output_type': 'stream', 'name': 'stdout', 'text': ['x' * 3000, 'x' * 2000]},
+            {'output_type': 'execute_result', 'data': {'text/plain': ['1'], 'image/png': 'AAAA'}},
+        ]},
+    ],
+    'metadata': {},
+}
+
+
+def test_truncate_outputs():
+    truncated = truncate_outputs(NOTEBOOK, 1024)
+    outputs = truncated['cells'][1]['outputs']
+    assert outputs[0]['text'] == 'x' * 1024
+    assert outputs[1]['data'] == {'text/plain': '1', 'image/png': 'AAAA'}
+    assert truncated['cells'][0] is NOTEBOOK['cells'][0]
+    # The original notebook is not modified
+    assert NOTEBOOK['cells'][1]['outputs'][0]['text'] == ['x' * 3000, 'x' * 2000]
+
+
+def test_analyze():
+    with tempfile.TemporaryDirectory() as tempdirname:
+        notebook_dir = os.path.join(tempdirname, 'notebooks')
+        os.makedirs(notebook_dir)
+        for name in ['a.ipynb', 'b.ipynb', 'c.ipynb']:
+            with open(os.path.join(notebook_dir, name), 'w') as f:
+                json.dump(NOTEBOOK, f)
+        config_path = os.path.join(tempdirname, 'config.py')
+        with open(config_path, 'w') as f:
+            f.write(f'c.LocalSource.base_dir = {notebook_dir!r}\n')
+            f.write("c.LocalSource.server = 'http://localhost:8888/'\n")
+            f.write('c.NBSearchDB.solr_compact_documents = True\n')
+        report_path = os.path.join(tempdirname, 'report.json')
+        handler = AnalyzeIndexHandler(sample_size=2, top=1, truncate_outputs=[1024, 10000],
+                                      report_path=report_path)
+        summary = handler.analyze(config_path, 'local')
+        with open(report_path) as f:
+            assert json.load(f) == json.loads(json.dumps(summary))
+
+    assert summary['notebooks'] == 2
+    assert summary['failed'] == []
+    cell_core = summary['cores']['jupyter-cell']
+    assert cell_core['documents'] == 4
+    assert cell_core['fields'][0]['name'] == 'outputs__stdout'
+    assert cell_core['fields'][0]['bytes'] == 2 * 5000
+    assert summary['bytes'] == cell_core['bytes'] + summary['cores']['jupyter-notebook']['bytes']
+    assert len(summary['largest_notebooks']) == 1
+    assert summary['largest_cells'][0]['index'] == 1
+    # Each of the 2 notebooks has the output in the cell and the notebook documents
+    assert summary['truncate_outputs'][0]['saved_bytes'] == 2 * 2 * (5000 - 1024)
+    assert summary['truncate_outputs'][1]['saved_bytes'] == 0
+    assert 'outputs__stdout' in format_summary(summary)
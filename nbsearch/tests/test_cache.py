@@ -0,0 +1,53 @@
+import os
+import tempfile
+
+from nbsearch.cache import NotebookCache
+
+
+def _put(cache, notebook_id, data, etag):
+    temp = cache.temporary_file()
+    temp.write(data)
+    temp.close()
+    return cache.commit(notebook_id, temp.name, etag)
+
+
+def _cached(cache, notebook_id):
+    entry = cache.lookup(notebook_id)
+    if entry is None:
+        return False
+    entry[0].close()
+    return True
+
+
+def test_lookup_and_commit():
+    with tempfile.TemporaryDirectory() as tempdirname:
+        cache = NotebookCache(tempdirname, 1024)
+        assert cache.lookup('nb1') is None
+
+        with _put(cache, 'nb1', b'{"cells": []}', '"etag1"') as f:
+            assert f.read() == b'{"cells": []}'
+        found, etag, _ = cache.lookup('nb1')
+        with found:
+            assert found.read() == b'{"cells": []}'
+        assert etag == '"etag1"'
+        assert [n for n in os.listdir(tempdirname) if n.endswith('.tmp')] == []
+
+        # Entries are restored from the directory
+        cache = NotebookCache(tempdirname, 1024)
+        found, etag, _ = cache.lookup('nb1')
+        found.close()
+        assert etag == '"etag1"'
+
+
+def test_lru_eviction():
+    with tempfile.TemporaryDirectory() as tempdirname:
+        cache = NotebookCache(tempdirname, 25)
+        _put(cache, 'nb1', b'x' * 10, '"1"').close()
+        _put(cache, 'nb2', b'x' * 10, '"2"').close()
+        # nb1 becomes the most recently used entry
+        assert _cached(cache, 'nb1')
+        _put(cache, 'nb3', b'x' * 10, '"3"').close()
+        assert _cached(cache, 'nb1')
+        assert not _cached(cache, 'nb2')
+        assert _cached(cache, 'nb3')
+        assert len(os.listdir(tempdirname)) == 4
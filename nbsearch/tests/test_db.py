@@ -0,0 +1,717 @@
+import asyncio
+import gzip
+import io
+import json
+import math
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+
+from botocore.exceptions import ClientError
+from tornado.httpclient import HTTPClientError
+from tornado.simple_httpclient import HTTPTimeoutError
+from tornado.web import HTTPError
+
+from nbsearch.db import NBSearchDB, UpdateIndexHandler, UPDATE_INDEX_STAGES, _serialize_notebook, normalize_query
+from nbsearch.metrics import start_trace
+from nbsearch import solr
+
+
+# Assertions of unittest, as the tests are also run without pytest
+_assert = unittest.TestCase()
+
+
+def _response(body, code=200):
+    response = mock.Mock()
+    response.code = code
+    response.body = json.dumps(body).encode('utf8')
+    return response
+
+
+async def _collect(agen):
+    return [item async for item in agen]
+
+
+def _params(request):
+    return parse_qs(urlparse(request.url).query)
+
+
+def test_export_cursor():
+    db = NBSearchDB()
+    db.solr_export_rows = 2
+    responses = [
+        _response({
+            'response': {'docs': [{'id': 'a'}, {'id': 'b'}]},
+            'nextCursorMark': 'AoE1',
+        }),
+        _response({
+            'response': {'docs': [{'id': 'c'}]},
+            'nextCursorMark': 'AoE2',
+        }),
+        _response({
+            'response': {'docs': []},
+            'nextCursorMark': 'AoE2',
+        }),
+    ]
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(side_effect=responses)
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        pages = asyncio.run(_collect(db.export('jupyter-cell', '_text_:*', fl='id')))
+    assert pages == [[{'id': 'a'}, {'id': 'b'}], [{'id': 'c'}]]
+    requests = [c[0][0] for c in mock_client.fetch.call_args_list]
+    assert [_params(r)['cursorMark'] for r in requests] == [['*'], ['AoE1'], ['AoE2']]
+    assert all('/solr/jupyter-cell/select?' in r.url for r in requests)
+    assert _params(requests[0])['sort'] == ['id asc']
+    assert _params(requests[0])['fl'] == ['id']
+    assert _params(requests[0])['rows'] == ['2']
+
+
+def test_export_trace():
+    db = NBSearchDB()
+    db.solr_export_rows = 2
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(side_effect=[
+        _response({
+            'responseHeader': {'QTime': 30},
+            'response': {'docs': [{'id': 'a'}, {'id': 'b'}]},
+            'nextCursorMark': 'AoE1',
+        }),
+        _response({
+            'responseHeader': {'QTime': 5},
+            'response': {'docs': []},
+            'nextCursorMark': 'AoE1',
+        }),
+    ])
+
+    async def _run():
+        trace = start_trace()
+        await _collect(db.export('jupyter-cell', 'owner:alice', sort='mtime desc'))
+        return trace
+
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        trace = asyncio.run(_run())
+    assert trace.queries == [{
+        'core': 'jupyter-cell', 'query': 'owner:alice', 'rows': 2, 'start': None,
+        'sort': 'mtime desc,id asc', 'qtime': 35, 'pages': 2,
+    }]
+
+
+def test_export_sort_with_tie_breaker():
+    db = NBSearchDB()
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(return_value=_response({
+        'response': {'docs': []},
+        'nextCursorMark': '*',
+    }))
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        pages = asyncio.run(_collect(db.export('jupyter-notebook', '_text_:*', sort='mtime desc')))
+    assert pages == []
+    request = mock_client.fetch.call_args[0][0]
+    assert '/solr/jupyter-notebook/select?' in request.url
+    assert _params(request)['sort'] == ['mtime desc,id asc']
+
+
+async def _start_closing_server(closes, body):
+    """Solr stub closing the first `closes` connections after reading the request"""
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        await reader.readuntil(b'\r\n\r\n')
+        if len(connections) > closes:
+            data = json.dumps(body).encode('utf8')
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n' +
+                         f'Content-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode('utf8') + data)
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, f'http://127.0.0.1:{port}/', connections
+
+
+def test_query_retry_on_503():
+    db = NBSearchDB()
+    db.solr_retry_backoff = 0
+    db.solr_time_allowed = 500
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(side_effect=[
+        _response({}, code=503),
+        _response({}, code=503),
+        _response({'response': {'docs': [], 'numFound': 0, 'start': 0}}),
+    ])
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client) as mock_class:
+        _, result = asyncio.run(db.query('jupyter-cell', '_text_:*'))
+    assert result['response']['numFound'] == 0
+    assert mock_client.fetch.call_count == 3
+    assert _params(mock_client.fetch.call_args[0][0])['timeAllowed'] == ['500']
+    assert mock_class.call_args[1]['max_clients'] == db.solr_query_max_clients
+    assert mock_class.call_args[1]['defaults']['request_timeout'] == db.solr_query_timeout
+
+
+def test_query_retry_on_closed_connection():
+    db = NBSearchDB()
+    db.solr_retry_backoff = 0
+
+    async def run():
+        server, db.solr_base_url, connections = await _start_closing_server(
+            2, {'response': {'docs': [], 'numFound': 0, 'start': 0}},
+        )
+        async with server:
+            _, result = await db.query('jupyter-cell', '_text_:*')
+        return result, len(connections)
+
+    result, attempts = asyncio.run(run())
+    assert result['response']['numFound'] == 0
+    assert attempts == 3
+
+
+def test_query_retry_exhausted():
+    db = NBSearchDB()
+    db.solr_retry_backoff = 0
+    db.solr_max_retries = 1
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(return_value=_response({}, code=503))
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        with _assert.assertRaises(HTTPError):
+            asyncio.run(db.query('jupyter-cell', '_text_:*'))
+    assert mock_client.fetch.call_count == 2
+
+
+def test_query_timeout_not_retried():
+    db = NBSearchDB()
+    db.solr_retry_backoff = 0
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(side_effect=HTTPTimeoutError('Timeout during request'))
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        with _assert.assertRaises(HTTPTimeoutError):
+            asyncio.run(db.query('jupyter-cell', '_text_:*'))
+    assert mock_client.fetch.call_count == 1
+
+
+def test_post_document_not_retried():
+    db = NBSearchDB()
+    db.solr_retry_backoff = 0
+
+    async def run():
+        server, db.solr_base_url, connections = await _start_closing_server(1, {})
+        async with server:
+            with _assert.assertRaises(HTTPClientError) as e:
+                await db.post_document('jupyter-cell', [])
+        assert e.exception.code == 599
+        return len(connections)
+
+    assert asyncio.run(run()) == 1
+
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(return_value=_response({}))
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client) as mock_class:
+        asyncio.run(db.post_document('jupyter-cell', []))
+    assert mock_class.call_args[1]['max_clients'] == db.solr_update_max_clients
+    assert mock_class.call_args[1]['defaults']['request_timeout'] == db.solr_update_timeout
+
+
+def test_get_compact_documents():
+    copy_fields = {'copyFields': [{'source': s, 'dest': d} for s, d in solr.COMPACT_COPY_FIELDS] +
+                   [{'source': 'filename', 'dest': '_text_'}]}
+    for body, expected in [(copy_fields, True), ({'copyFields': []}, False)]:
+        db = NBSearchDB()
+        mock_client = mock.Mock()
+        mock_client.fetch = mock.AsyncMock(return_value=_response(body))
+        with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+            assert asyncio.run(db.get_compact_documents()) is expected
+            # The result is kept for the following documents
+            assert asyncio.run(db.get_compact_documents()) is expected
+        requests = [c[0][0] for c in mock_client.fetch.call_args_list]
+        assert sorted([r.url.split('/solr/')[1] for r in requests]) == [
+            'jupyter-cell/schema/copyfields?wt=json', 'jupyter-notebook/schema/copyfields?wt=json',
+        ]
+
+    # Cores without the Schema API are given legacy documents
+    db = NBSearchDB()
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(return_value=_response({}, code=404))
+    mock_client.fetch.return_value.rethrow.side_effect = HTTPClientError(404)
+    log = mock.Mock()
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        assert asyncio.run(db.get_compact_documents(log=log)) is False
+    assert log.warning.call_count == 1
+
+    db = NBSearchDB(solr_compact_documents=True)
+    assert asyncio.run(db.get_compact_documents()) is True
+
+
+def test_build_query_filters():
+    db = NBSearchDB()
+    urlquery = db._build_query(
+        '_text_:pandas',
+        filters={
+            'notebook_owner': ['bob', 'alice', 'bob'],
+            'cell_type': ['code'],
+            'notebook_server': [],
+        },
+        ranges={'estimated_mtime': ('NOW-7DAYS', None)},
+    )
+    params = parse_qs(urlquery)
+    assert params['q'] == ['_text_:pandas']
+    assert params['fq'] == [
+        'cell_type:("code")',
+        'notebook_owner:("alice" OR "bob")',
+        'estimated_mtime:[NOW-7DAYS TO *]',
+    ]
+    assert db._build_filter_queries(filters={'owner': ['a"b\\c']}) == ['owner:("a\\"b\\\\c")']
+
+
+def test_build_query_collapse():
+    db = NBSearchDB()
+    params = parse_qs(db._build_query(
+        '_text_:pandas',
+        sort='estimated_mtime desc',
+        collapse='notebook_id',
+        expand_rows=2,
+    ))
+    assert params['fq'] == ["{!collapse field=notebook_id sort='estimated_mtime desc'}"]
+    assert params['expand'] == ['true']
+    assert params['expand.rows'] == ['2']
+    assert params['expand.sort'] == ['estimated_mtime desc']
+
+    # Groups are expanded even without other documents to get their numFound
+    params = parse_qs(db._build_query('_text_:pandas', collapse='notebook_id', expand_rows=0))
+    assert params['fq'] == ['{!collapse field=notebook_id}']
+    assert params['expand'] == ['true']
+    assert params['expand.rows'] == ['0']
+    assert 'expand.sort' not in params
+
+    params = parse_qs(db._build_query('_text_:pandas', collapse='notebook_id'))
+    assert 'expand' not in params
+
+
+def test_query_meme_neighborhood_positions():
+    db = NBSearchDB(solr_meme_encoding='positions')
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(side_effect=[
+        _response({'response': {'docs': [
+            {'notebook_id': 'nb1', 'index': 3},
+            {'notebook_id': 'nb2', 'index': 0},
+        ]}}),
+        _response({'response': {'docs': [], 'numFound': 0, 'start': 0}}),
+    ])
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        asyncio.run(db.query('jupyter-cell', 'lc_cell_memes__previous__in_section:"MEME_1" AND source:x'))
+    anchor_request, request = [c[0][0] for c in mock_client.fetch.call_args_list]
+    assert _params(anchor_request)['q'] == ['lc_cell_meme__current:"MEME_1"']
+    assert _params(request)['q'] == [
+        '((notebook_id:"nb1" AND index:{3 TO *] AND lc_cell_position__section_beginning:[* TO 3]) OR '
+        '(notebook_id:"nb2" AND index:{0 TO *] AND lc_cell_position__section_beginning:[* TO 0])) AND source:x'
+    ]
+
+    # Queries are passed through with the default encoding
+    db = NBSearchDB()
+    query = 'lc_cell_memes__next__in_notebook:MEME_1'
+    assert asyncio.run(db.resolve_meme_neighborhoods(query)) == query
+
+
+class _Body(object):
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self, size=None):
+        if size is None:
+            size = len(self.data)
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+
+def _mock_s3_session(s3):
+    client = mock.MagicMock()
+    client.__aenter__ = mock.AsyncMock(return_value=s3)
+    client.__aexit__ = mock.AsyncMock(return_value=False)
+    session = mock.Mock()
+    session.client.return_value = client
+    return session
+
+
+def test_download_file_cached():
+    with tempfile.TemporaryDirectory() as tempdirname:
+        db = NBSearchDB(s3_cache_dir=tempdirname, s3_cache_max_age=0)
+        s3 = mock.Mock()
+        not_modified = ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        s3.get_object = mock.AsyncMock(side_effect=[
+            {'Body': _Body(b'{"cells": []}'), 'ETag': '"etag1"'},
+            not_modified,
+        ])
+        with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+            for _ in range(2):
+                f = io.BytesIO()
+                asyncio.run(db.download_file('nb1', f))
+                assert f.getvalue() == b'{"cells": []}'
+        assert s3.get_object.call_count == 2
+        assert 'IfNoneMatch' not in s3.get_object.call_args_list[0][1]
+        assert s3.get_object.call_args_list[1][1]['IfNoneMatch'] == '"etag1"'
+        assert (db._cache.hits, db._cache.misses) == (1, 1)
+
+        # Fresh entries are served without contacting S3
+        db.s3_cache_max_age = 60
+        with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+            chunks = asyncio.run(_collect(db.stream_file('nb1')))
+        assert b''.join(chunks) == b'{"cells": []}'
+        assert s3.get_object.call_count == 2
+
+
+def test_download_file_cached_evicted():
+    async def _run(db):
+        blob = await db._download_to_cache('nb1')
+        # A concurrent download evicts nb1 before its blob is read
+        await db.download_file('nb2', io.BytesIO())
+        assert db._cache.lookup('nb1') is None
+        f = io.BytesIO()
+        async for chunk in db._read_file(blob):
+            f.write(chunk)
+        return f.getvalue()
+
+    with tempfile.TemporaryDirectory() as tempdirname:
+        db = NBSearchDB(s3_cache_dir=tempdirname, s3_cache_max_size=20)
+        s3 = mock.Mock()
+        s3.get_object = mock.AsyncMock(side_effect=[
+            {'Body': _Body(b'{"cells": [1]}'), 'ETag': '"etag1"'},
+            {'Body': _Body(b'{"cells": [2]}'), 'ETag': '"etag2"'},
+        ])
+        with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+            assert asyncio.run(_run(db)) == b'{"cells": [1]}'
+
+
+def test_prefetch():
+    async def _run(db):
+        db.prefetch(['nb1', 'nb2', 'nb3'], user='alice')
+        await asyncio.gather(*db._prefetch_tasks)
+        # The budget is spent by nb1 until it is requested
+        db.prefetch(['nb2', 'nb3'], user='alice')
+        assert len(db._prefetch_tasks) == 0
+        f = io.BytesIO()
+        await db.download_file('nb1', f)
+        db.prefetch(['nb2'], user='alice')
+        await asyncio.gather(*db._prefetch_tasks)
+
+    with tempfile.TemporaryDirectory() as tempdirname:
+        db = NBSearchDB(s3_cache_dir=tempdirname, prefetch_top_n=2,
+                        prefetch_max_concurrency_per_user=1, prefetch_max_bytes=1)
+        s3 = mock.Mock()
+        s3.get_object = mock.AsyncMock(side_effect=lambda Bucket, Key: {
+            'Body': _Body(b'{"cells": []}'), 'ETag': f'"{Key}"',
+        })
+        with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+            asyncio.run(_run(db))
+        assert [c[1]['Key'] for c in s3.get_object.call_args_list] == ['nb1', 'nb2']
+        assert (db.prefetch_issued, db.prefetch_hits) == (2, 1)
+        assert db._prefetch_running == {}
+
+
+def test_prefetch_budget_counts_in_progress():
+    async def _run(db):
+        # Prefetches of all users are started before any of them completes
+        for user in ['alice', 'bob', 'carol']:
+            db.prefetch([f'{user}1', f'{user}2'], user=user)
+        assert sorted(db._prefetched.keys()) == ['alice1', 'alice2']
+        await asyncio.gather(*db._prefetch_tasks)
+
+    with tempfile.TemporaryDirectory() as tempdirname:
+        db = NBSearchDB(s3_cache_dir=tempdirname, prefetch_top_n=2, prefetch_reserved_bytes=10,
+                        prefetch_max_bytes=20)
+        s3 = mock.Mock()
+        s3.get_object = mock.AsyncMock(side_effect=lambda Bucket, Key: {
+            'Body': _Body(b'{"cells": []}'), 'ETag': f'"{Key}"',
+        })
+        with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+            asyncio.run(_run(db))
+        assert s3.get_object.call_count == 2
+        # The reservations are replaced with the actual sizes
+        assert sorted([size for _, size, _ in db._prefetched.values()]) == [13, 13]
+
+
+def test_prefetch_disabled_without_cache():
+    db = NBSearchDB(prefetch_top_n=2)
+    db.prefetch(['nb1'], user='alice')
+    assert db._prefetch_tasks == set()
+
+
+def test_get_notebook_meta():
+    db = NBSearchDB(solr_meta_cache_size=1)
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(side_effect=[
+        _response({'doc': {'id': 'nb1', 'filename': 'a.ipynb'}}),
+        _response({'doc': None}),
+        _response({'doc': {'id': 'nb2', 'filename': 'b.ipynb'}}),
+        _response({'doc': {'id': 'nb1', 'filename': 'a.ipynb'}}),
+    ])
+
+    async def lookup(ids):
+        return [await db.get_notebook_meta(id) for id in ids]
+
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        docs = asyncio.run(lookup(['nb1', 'nb1', 'missing', 'nb2', 'nb1']))
+    assert [d['id'] if d is not None else None for d in docs] == ['nb1', 'nb1', None, 'nb2', 'nb1']
+    requests = [c[0][0] for c in mock_client.fetch.call_args_list]
+    # The second lookup of nb1 is served from the cache, the last one was evicted by nb2
+    assert [_params(r)['id'] for r in requests] == [['nb1'], ['missing'], ['nb2'], ['nb1']]
+    assert '/solr/jupyter-notebook/get?' in requests[0].url
+
+
+def test_serialize_notebook():
+    notebook_data = {
+        'cells': [
+            {'cell_type': 'markdown', 'source': ['# 見出し']},
+            {'cell_type': 'code', 'source': ['print(1)'], 'outputs': []},
+        ],
+        'metadata': {},
+        'nbformat': 4,
+    }
+    body, offsets = _serialize_notebook(notebook_data)
+    assert body == json.dumps(notebook_data, ensure_ascii=False).encode('utf8')
+    assert [json.loads(body[s:e]) for s, e in offsets] == notebook_data['cells']
+
+    body, offsets = _serialize_notebook({'metadata': {}})
+    assert body == b'{"metadata": {}}'
+    assert offsets is None
+
+
+def test_download_cells():
+    notebook_data = {
+        'cells': [{'cell_type': 'code', 'source': [str(i)]} for i in range(5)],
+    }
+    body, offsets = _serialize_notebook(notebook_data)
+    cell_index = json.dumps({'size': len(body), 'cells': offsets}).encode('utf8')
+
+    def get_object(Bucket, Key, Range=None):
+        if Key.endswith('.cells.json'):
+            return {'Body': _Body(cell_index)}
+        start, end = [int(v) for v in Range[len('bytes='):].split('-')]
+        return {
+            'Body': _Body(body[start:end + 1]),
+            'ContentRange': f'bytes {start}-{end}/{len(body)}',
+        }
+
+    db = NBSearchDB()
+    s3 = mock.Mock()
+    s3.get_object = mock.AsyncMock(side_effect=get_object)
+    with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+        cells, total = asyncio.run(db.download_cells('nb1', 1, 3))
+    assert cells == notebook_data['cells'][1:3]
+    assert total == 5
+    assert s3.get_object.call_args[1]['Range'] == f'bytes={offsets[1][0]}-{offsets[2][1] - 1}'
+
+
+def test_download_cells_without_index():
+    notebook_data = {
+        'cells': [{'cell_type': 'code', 'source': [str(i)]} for i in range(5)],
+    }
+    db = NBSearchDB()
+    s3 = mock.Mock()
+    s3.get_object = mock.AsyncMock(side_effect=ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject'))
+
+    async def download_fileobj(bucket, key, f):
+        f.write(json.dumps(notebook_data).encode('utf8'))
+
+    s3.download_fileobj = mock.AsyncMock(side_effect=download_fileobj)
+    with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+        cells, total = asyncio.run(db.download_cells('nb1', 3, None))
+    assert cells == notebook_data['cells'][3:]
+    assert total == 5
+
+
+def test_get_parsed_notebook():
+    notebook_data = {
+        'cells': [
+            {'cell_type': 'markdown', 'source': ['# Heading']},
+            {'cell_type': 'code', 'source': ['print(1)']},
+        ],
+    }
+    db = NBSearchDB()
+
+    async def download_file(notebook_id, f):
+        f.write(json.dumps(notebook_data).encode('utf8'))
+
+    async def get_twice():
+        return [await db.get_parsed_notebook('nb1') for _ in range(2)]
+
+    with mock.patch.object(db, 'download_file', side_effect=download_file) as mock_download_file:
+        parsed = asyncio.run(get_twice())
+    assert parsed[0] == (notebook_data, [(1, 1), None])
+    assert parsed[1] is parsed[0]
+    assert mock_download_file.call_count == 1
+
+
+def test_upload_file_with_light_variant():
+    notebook_data = {
+        'cells': [
+            {'cell_type': 'markdown', 'source': ['![a](attachment:a.png)'],
+             'attachments': {'a.png': {'image/png': 'AAAA'}}},
+            {'cell_type': 'code', 'source': ['print(1)'],
+             'outputs': [{'output_type': 'stream', 'name': 'stdout', 'text': ['1']}]},
+        ],
+        'metadata': {},
+    }
+    uploaded = {}
+
+    async def upload_fileobj(f, bucket, key, ExtraArgs=None):
+        uploaded[key] = (f.read(), ExtraArgs)
+
+    for compression in [False, True]:
+        db = NBSearchDB(s3_light_variant_compression=compression)
+        s3 = mock.Mock()
+        s3.list_buckets = mock.AsyncMock(return_value={'Buckets': [{'Name': 'notebooks'}]})
+        s3.upload_fileobj = mock.AsyncMock(side_effect=upload_fileobj)
+        uploaded.clear()
+        with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+            asyncio.run(db.upload_file('nb1', notebook_data))
+        assert sorted(uploaded.keys()) == ['nb1', 'nb1.cells.json', 'nb1.light.json']
+        assert json.loads(uploaded['nb1'][0]) == notebook_data
+        light, extra_args = uploaded['nb1.light.json']
+        if compression:
+            assert extra_args['ContentEncoding'] == 'gzip'
+            light = gzip.decompress(light)
+        assert json.loads(light)['cells'] == [
+            {'cell_type': 'markdown', 'source': ['![a](attachment:a.png)']},
+            {'cell_type': 'code', 'source': ['print(1)'], 'outputs': []},
+        ]
+
+        s3.get_object = mock.AsyncMock(return_value={
+            'Body': _Body(uploaded['nb1.light.json'][0]),
+            'ContentEncoding': extra_args.get('ContentEncoding'),
+        })
+        with mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+            assert asyncio.run(db.download_light('nb1')) == json.loads(light)
+
+
+def test_get_notebook_metas():
+    db = NBSearchDB()
+    db._put_notebook_meta('nb1', {'id': 'nb1'}, time.monotonic())
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(return_value=_response({
+        'response': {'docs': [{'id': 'nb2'}], 'numFound': 1, 'start': 0},
+    }))
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client):
+        docs = asyncio.run(db.get_notebook_metas(['nb1', 'nb2', 'nb"3', 'nb2']))
+    assert docs == {'nb1': {'id': 'nb1'}, 'nb2': {'id': 'nb2'}}
+    assert mock_client.fetch.call_count == 1
+    params = _params(mock_client.fetch.call_args[0][0])
+    assert params['q'] == ['id:("nb2" OR "nb\\"3")']
+    assert params['rows'] == ['2']
+
+
+def test_metrics():
+    db = NBSearchDB()
+    mock_client = mock.Mock()
+    mock_client.fetch = mock.AsyncMock(side_effect=[
+        _response({
+            'responseHeader': {'status': 0, 'QTime': 12},
+            'response': {'docs': [], 'numFound': 0, 'start': 0},
+        }),
+        _response({'doc': {'id': 'nb1', 'filename': 'a.ipynb'}}),
+    ])
+
+    async def _run():
+        trace = start_trace()
+        await db.query('jupyter-notebook', '_text_:*', rows=10)
+        await db.get_notebook_meta('nb1')
+        await db.get_notebook_meta('nb1')
+        await db.download_file('nb1', io.BytesIO())
+        return trace
+
+    s3 = mock.Mock()
+
+    async def download_fileobj(bucket, key, f):
+        f.write(b'{"cells": []}')
+
+    s3.download_fileobj = mock.AsyncMock(side_effect=download_fileobj)
+    with mock.patch('nbsearch.db.AsyncHTTPClient', return_value=mock_client), \
+            mock.patch('nbsearch.db.aioboto3.Session', return_value=_mock_s3_session(s3)):
+        trace = asyncio.run(_run())
+    assert trace.queries == [{
+        'core': 'jupyter-notebook', 'query': '_text_:*', 'rows': 10, 'start': None, 'sort': None, 'qtime': 12,
+    }]
+    assert trace.durations['solr'] > 0 and trace.durations['s3'] > 0
+    registry = db.metrics.registry
+    assert registry.get_sample_value('nbsearch_solr_request_duration_seconds_count', {'kind': 'query'}) == 2
+    assert registry.get_sample_value('nbsearch_solr_qtime_seconds_sum') == 0.012
+    assert registry.get_sample_value('nbsearch_s3_download_bytes_total', {'operation': 'file'}) == 13
+    assert registry.get_sample_value('nbsearch_cache_hits_total', {'cache': 'notebook_meta'}) == 1
+    assert registry.get_sample_value('nbsearch_cache_hit_ratio', {'cache': 'notebook_meta'}) == 0.5
+    assert registry.get_sample_value('nbsearch_cache_hit_ratio', {'cache': 'parsed_notebook'}) is None
+
+
+def _write_local_source(tempdirname, names):
+    notebook_dir = os.path.join(tempdirname, 'notebooks')
+    os.makedirs(notebook_dir)
+    for name in names:
+        with open(os.path.join(notebook_dir, name), 'w') as f:
+            json.dump({'cells': [
+                {'cell_type': 'markdown', 'source': ['# Heading'], 'metadata': {}},
+                {'cell_type': 'code', 'source': ['print(1)'], 'outputs': [], 'metadata': {}},
+            ], 'metadata': {}}, f)
+    config_path = os.path.join(tempdirname, 'config.py')
+    with open(config_path, 'w') as f:
+        f.write(f'c.LocalSource.base_dir = {notebook_dir!r}\n')
+        f.write("c.LocalSource.server = 'http://localhost:8888/'\n")
+    return config_path
+
+
+def test_update_index_report():
+    with tempfile.TemporaryDirectory() as tempdirname:
+        config_path = _write_local_source(tempdirname, ['a.ipynb', 'b.ipynb'])
+        report_path = os.path.join(tempdirname, 'report.json')
+        handler = UpdateIndexHandler(report_path=report_path, report_slowest=1)
+        with mock.patch.object(NBSearchDB, 'post_document', mock.AsyncMock()), \
+                mock.patch.object(NBSearchDB, 'upload_file', mock.AsyncMock()):
+            asyncio.run(handler.update(config_path, 'local', None))
+        with open(report_path) as f:
+            report = json.load(f)
+    assert (report['notebooks'], report['failed']) == (2, 0)
+    assert list(report['stages'].keys()) == UPDATE_INDEX_STAGES
+    assert report['stages']['markdown']['total'] > 0
+    assert len(report['slowest']) == 1
+    assert report['slowest'][0]['path'] in ['a.ipynb', 'b.ipynb']
+    assert math.isclose(report['slowest'][0]['total'], sum(report['slowest'][0]['timings'].values()))
+
+
+def test_update_index_profile():
+    with tempfile.TemporaryDirectory() as tempdirname:
+        config_path = _write_local_source(tempdirname, ['a.ipynb', 'b.ipynb'])
+        profile_dir = os.path.join(tempdirname, 'profiles')
+        handler = UpdateIndexHandler(profile_dir=profile_dir, profile_paths=['b.*'], profile_engine='cprofile')
+        with mock.patch.object(NBSearchDB, 'post_document', mock.AsyncMock()), \
+                mock.patch.object(NBSearchDB, 'upload_file', mock.AsyncMock()):
+            asyncio.run(handler.update(config_path, 'local', None))
+        profiles = os.listdir(profile_dir)
+    assert len(profiles) == 1
+    assert profiles[0].endswith('.prof')
+    assert '-index-b.ipynb-' in profiles[0]
+
+
+def test_request_profile():
+    with tempfile.TemporaryDirectory() as tempdirname:
+        db = NBSearchDB(profile_dir=tempdirname, profile_engine='cprofile', profile_slow_threshold=1.0)
+        profile = db.start_request_profile()
+        assert profile is not None
+        # Only one profile runs at a time
+        assert db.start_request_profile() is None
+        assert db.finish_request_profile(profile, 'search-GET-200', 0.5) is None
+        profile = db.start_request_profile()
+        path = db.finish_request_profile(profile, 'search-GET-200', 1.5)
+        assert os.path.basename(path).split('-')[1:5] == ['search', 'GET', '200', '1500ms']
+        assert os.listdir(tempdirname) == [os.path.basename(path)]
+
+        db.profile_slow_threshold = 0.0
+        assert db.start_request_profile() is None
+        db.profile_sample_rate = 1.0
+        profile = db.start_request_profile()
+        assert db.finish_request_profile(profile, 'data-GET-200', 0.01) is not None
+
+
+def test_normalize_query():
+    assert normalize_query('_text_:foo  AND owner:"a \\"b" AND mtime:[NOW-1DAY TO *]') == \
+        '_text_:? AND owner:? AND mtime:?'
+    assert normalize_query('(cell_type:code OR source__code:{a TO b}) pandas') == \
+        '(cell_type:? OR source__code:?) pandas'
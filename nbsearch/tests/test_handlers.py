@@ -1,4 +1,3 @@
-import io
 import json
 from urllib.parse import quote
 import os
@@ -6,11 +5,25 @@ from stat import S_IREAD
 import shutil
 import tempfile
 import unittest
+from tornado.httpclient import HTTPClientError
 import tornado.testing
 import tornado.web
 from unittest import mock
 import nbsearch.server
-from nbsearch.v1.handlers import SearchHandler, ImportHandler, DataHandler
+from nbsearch.v1.handlers import (
+    SearchHandler,
+    CombinedSearchHandler,
+    ExportHandler,
+    ImportHandler,
+    BulkImportHandler,
+    DataHandler,
+    CellsHandler,
+    SectionHandler,
+    DiffHandler,
+    MetricsHandler,
+)
+from nbsearch.db import NBSearchDB
+from nbsearch.metrics import current_trace
 
 collection_name = 'test_notebooks'
 history_name = 'test_history'
@@ -22,16 +35,54 @@ class TestableSearchHandler(SearchHandler):
         return "test_user"
 
 
+class TestableCombinedSearchHandler(CombinedSearchHandler):
+    def get_current_user(self):
+        return "test_user"
+
+
+class TestableExportHandler(ExportHandler):
+    def get_current_user(self):
+        return "test_user"
+
+
 class TestableImportHandler(ImportHandler):
     def get_current_user(self):
         return "test_user"
 
 
+class TestableBulkImportHandler(BulkImportHandler):
+    def get_current_user(self):
+        return "test_user"
+
+    def check_xsrf_cookie(self):
+        pass
+
+
 class TestableDataHandler(DataHandler):
     def get_current_user(self):
         return "test_user"
 
 
+class TestableCellsHandler(CellsHandler):
+    def get_current_user(self):
+        return "test_user"
+
+
+class TestableSectionHandler(SectionHandler):
+    def get_current_user(self):
+        return "test_user"
+
+
+class TestableDiffHandler(DiffHandler):
+    def get_current_user(self):
+        return "test_user"
+
+
+class TestableMetricsHandler(MetricsHandler):
+    def get_current_user(self):
+        return "test_user"
+
+
 class ApiHandlerTestCaseBase(tornado.testing.AsyncHTTPTestCase):
 
     def setUp(self):
@@ -41,6 +92,7 @@ class ApiHandlerTestCaseBase(tornado.testing.AsyncHTTPTestCase):
             'NBSearchDB',
         )
         self.mock_nbsearchdb = self.nbsearchdb_patcher.start()
+        self.mock_nbsearchdb().slow_query_threshold = 0.0
         super().setUp()
 
     def tearDown(self):
@@ -54,9 +106,16 @@ class ApiHandlerTestCaseBase(tornado.testing.AsyncHTTPTestCase):
         handler_settings['base_dir'] = self.base_dir
 
         handlers = [
+            (r"/v1/search", TestableCombinedSearchHandler, handler_settings),
             (r"/v1/(?P<target>[^\/]+)/search", TestableSearchHandler, handler_settings),
+            (r"/v1/(?P<target>[^\/]+)/export", TestableExportHandler, handler_settings),
+            (r"/v1/import", TestableBulkImportHandler, handler_settings),
             (r"/v1/import(?P<path>/.+)?/(?P<id>[^\/]+)", TestableImportHandler, handler_settings),
             (r"/v1/data/(?P<id>[^\/]+)", TestableDataHandler, handler_settings),
+            (r"/v1/data/(?P<id>[^\/]+)/cells", TestableCellsHandler, handler_settings),
+            (r"/v1/data/(?P<id>[^\/]+)/section", TestableSectionHandler, handler_settings),
+            (r"/v1/diff", TestableDiffHandler, handler_settings),
+            (r"/metrics", TestableMetricsHandler, handler_settings),
         ]
 
         return tornado.web.Application(
@@ -138,6 +197,227 @@ class TestSearchHandler(ApiHandlerTestCaseBase):
         self.assertEqual(mock_query.call_args[0][1], '_text_:*')
 
 
+    def test_cell_search_with_filters(self):
+        result = {
+            'response': {
+                'docs': [],
+                'numFound': 0,
+                'start': 0,
+            },
+        }
+        mock_query = mock.AsyncMock(return_value=('_text_:*', result))
+        self.mock_nbsearchdb().query.side_effect = mock_query
+        response = self.fetch('/v1/cell/search?query=' + quote('_text_:*') +
+                              '&notebook_owner=alice&notebook_owner=bob&cell_type=code' +
+                              '&estimated_mtime_from=NOW-7DAYS&owner=ignored')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(mock_query.call_args[1]['filters'], {
+            'notebook_owner': ['alice', 'bob'],
+            'cell_type': ['code'],
+        })
+        self.assertEqual(mock_query.call_args[1]['ranges'], {
+            'estimated_mtime': ('NOW-7DAYS', None),
+        })
+
+    def test_search_with_invalid_range(self):
+        response = self.fetch('/v1/notebook/search?query=' + quote('_text_:*') +
+                              '&mtime_to=' + quote('* ] OR [*'))
+        self.assertEqual(response.code, 400)
+
+    def test_cell_search_group_by_notebook(self):
+        result = {
+            'response': {
+                'docs': [
+                    {'id': 'nb1_0', 'notebook_id': 'nb1'},
+                    {'id': 'nb2_3', 'notebook_id': 'nb2'},
+                ],
+                'numFound': 2,
+                'start': 0,
+            },
+            'expanded': {
+                'nb1': {
+                    'numFound': 4,
+                    'start': 0,
+                    'docs': [
+                        {'id': 'nb1_1', 'notebook_id': 'nb1'},
+                        {'id': 'nb1_2', 'notebook_id': 'nb1'},
+                    ],
+                },
+            },
+        }
+        mock_query = mock.AsyncMock(return_value=('_text_:*', result))
+        self.mock_nbsearchdb().query.side_effect = mock_query
+        response = self.fetch('/v1/cell/search?query=' + quote('_text_:*') +
+                              '&group_by=notebook')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(mock_query.call_args[1]['collapse'], 'notebook_id')
+        self.assertEqual(mock_query.call_args[1]['expand_rows'], 2)
+        resp = json.loads(response.body.decode('utf8'))
+        self.assertEqual(resp['group_by'], 'notebook')
+        self.assertEqual(resp['numFound'], 2)
+        self.assertEqual([(g['value'], g['numFound'], [d['id'] for d in g['docs']])
+                          for g in resp['groups']], [
+            ('nb1', 5, ['nb1_0', 'nb1_1', 'nb1_2']),
+            ('nb2', 1, ['nb2_3']),
+        ])
+
+    def test_cell_search_group_limit_one(self):
+        result = {
+            'response': {
+                'docs': [
+                    {'id': 'nb1_0', 'notebook_id': 'nb1'},
+                ],
+                'numFound': 1,
+                'start': 0,
+            },
+            'expanded': {
+                'nb1': {
+                    'numFound': 4,
+                    'start': 0,
+                    'docs': [],
+                },
+            },
+        }
+        mock_query = mock.AsyncMock(return_value=('_text_:*', result))
+        self.mock_nbsearchdb().query.side_effect = mock_query
+        response = self.fetch('/v1/cell/search?query=' + quote('_text_:*') +
+                              '&group_by=notebook&group_limit=1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(mock_query.call_args[1]['expand_rows'], 0)
+        resp = json.loads(response.body.decode('utf8'))
+        self.assertEqual([(g['value'], g['numFound'], [d['id'] for d in g['docs']])
+                          for g in resp['groups']], [
+            ('nb1', 5, ['nb1_0']),
+        ])
+
+        response = self.fetch('/v1/cell/search?query=' + quote('_text_:*') +
+                              '&group_by=notebook&group_limit=0')
+        self.assertEqual(response.code, 400)
+        response = self.fetch('/v1/cell/search?query=' + quote('_text_:*') +
+                              '&group_by=notebook&group_limit=abc')
+        self.assertEqual(response.code, 400)
+
+        # group_limit is ignored without group_by
+        for group_limit in ['0', 'abc']:
+            response = self.fetch('/v1/cell/search?query=' + quote('_text_:*') +
+                                  '&group_limit=' + group_limit)
+            self.assertEqual(response.code, 200)
+            self.assertIsNone(mock_query.call_args[1]['expand_rows'])
+
+    def test_cell_search_prefetch(self):
+        result = {
+            'response': {
+                'docs': [
+                    {'id': 'nb1_0', 'notebook_id': 'nb1'},
+                    {'id': 'nb1_1', 'notebook_id': 'nb1'},
+                    {'id': 'nb2_3', 'notebook_id': 'nb2'},
+                ],
+                'numFound': 3,
+                'start': 0,
+            },
+        }
+        mock_query = mock.AsyncMock(return_value=('_text_:*', result))
+        self.mock_nbsearchdb().query.side_effect = mock_query
+        response = self.fetch('/v1/cell/search?query=' + quote('_text_:*'))
+        self.assertEqual(response.code, 200)
+        prefetch = self.mock_nbsearchdb().prefetch
+        self.assertEqual(prefetch.call_count, 1)
+        self.assertEqual(prefetch.call_args[0][0], ['nb1', 'nb2'])
+
+    def test_notebook_search_group_by_unsupported(self):
+        response = self.fetch('/v1/notebook/search?query=' + quote('_text_:*') +
+                              '&group_by=notebook')
+        self.assertEqual(response.code, 400)
+
+
+class TestCombinedSearchHandler(ApiHandlerTestCaseBase):
+
+    def test_missing_query(self):
+        response = self.fetch('/v1/search')
+        self.assertEqual(response.code, 400)
+
+    def test_combined_search(self):
+        async def mock_query(core, query, **kwargs):
+            result = {
+                'response': {
+                    'docs': [{'core': core}],
+                    'numFound': 1,
+                    'start': 0,
+                },
+            }
+            return query, result
+
+        mock_query = mock.AsyncMock(side_effect=mock_query)
+        self.mock_nbsearchdb().query.side_effect = mock_query
+        response = self.fetch('/v1/search?query=' + quote('_text_:*') +
+                              '&notebook_sort=' + quote('mtime desc') +
+                              '&owner=alice&group_by=notebook')
+        self.assertEqual(response.code, 200)
+        resp = json.loads(response.body.decode('utf8'))
+        self.assertEqual(resp['notebook']['notebooks'], [{'core': 'jupyter-notebook'}])
+        self.assertEqual(resp['notebook']['sort'], 'mtime desc')
+        self.assertEqual(resp['cell']['cells'], [{'core': 'jupyter-cell'}])
+        self.assertEqual(resp['cell']['group_by'], 'notebook')
+        self.assertEqual(sorted(resp['timings'].keys()), ['cell', 'notebook', 'total'])
+        self.assertEqual(mock_query.call_count, 2)
+        kwargs = dict([(c[0][0], c[1]) for c in mock_query.call_args_list])
+        self.assertEqual(kwargs['jupyter-notebook']['filters'], {'owner': ['alice']})
+        self.assertIsNone(kwargs['jupyter-notebook']['collapse'])
+        self.assertEqual(kwargs['jupyter-cell']['filters'], {})
+        self.assertEqual(kwargs['jupyter-cell']['collapse'], 'notebook_id')
+
+class TestExportHandler(ApiHandlerTestCaseBase):
+
+    def test_missing_query(self):
+        response = self.fetch('/v1/cell/export')
+        self.assertEqual(response.code, 400)
+
+    def test_export_cells(self):
+        pages = [
+            [{'id': 'a'}, {'id': 'b'}],
+            [{'id': 'c'}],
+        ]
+        calls = []
+
+        async def mock_export(core, query, **kwargs):
+            calls.append((core, query, kwargs))
+            for page in pages:
+                yield page
+
+        self.mock_nbsearchdb().export = mock_export
+        response = self.fetch('/v1/cell/export?query=' + quote('_text_:*') + '&fl=id')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/x-ndjson')
+        lines = response.body.decode('utf8').splitlines()
+        self.assertEqual([json.loads(l) for l in lines],
+                         [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][0], 'jupyter-cell')
+        self.assertEqual(calls[0][1], '_text_:*')
+        self.assertEqual(calls[0][2]['fl'], 'id')
+        self.assertEqual(calls[0][2]['q_op'], 'AND')
+
+    def test_export_failure_after_first_page(self):
+        async def mock_export(core, query, **kwargs):
+            yield [{'id': 'a'}]
+            raise tornado.web.HTTPError(503)
+
+        self.mock_nbsearchdb().export = mock_export
+        # The connection is closed so that the client sees the truncated export
+        with self.assertRaises(HTTPClientError) as cm:
+            self.fetch('/v1/cell/export?query=' + quote('_text_:*'))
+        self.assertEqual(cm.exception.code, 599)
+
+        async def mock_export_failed(core, query, **kwargs):
+            raise tornado.web.HTTPError(503)
+            yield
+
+        self.mock_nbsearchdb().export = mock_export_failed
+        response = self.fetch('/v1/cell/export?query=' + quote('_text_:*'))
+        self.assertEqual(response.code, 503)
+
+
 class TestImportHandler(ApiHandlerTestCaseBase):
 
     def setUp(self):
@@ -150,18 +430,9 @@ class TestImportHandler(ApiHandlerTestCaseBase):
         dummy_doc = {
             'filename': self.notebook_filename,
         }
-        result = {
-            'response': {
-                'docs': [
-                    dummy_doc,
-                ],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
-        mock_query = mock.AsyncMock(return_value=(None, result))
+        mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
         mock_download_file = mock.AsyncMock()
-        self.mock_nbsearchdb().query.side_effect = mock_query
+        self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
         self.mock_nbsearchdb().download_file.side_effect = mock_download_file
 
         dest_path = 'dest'
@@ -171,14 +442,12 @@ class TestImportHandler(ApiHandlerTestCaseBase):
         response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
         self.assertEqual(response.code, 200)
 
-        self.assertEqual(mock_query.call_count, 1)
-        self.assertEqual(mock_query.call_args[0][0], 'jupyter-notebook')
-        self.assertEqual(mock_query.call_args[0][1], 'id:"0123456789ab0123456789ab"')
+        self.assertEqual(mock_get_notebook_meta.call_count, 1)
+        self.assertEqual(mock_get_notebook_meta.call_args[0][0], self.notebook_file_id)
         self.assertEqual(mock_download_file.call_count, 1)
         self.assertEqual(mock_download_file.call_args[0][0], self.notebook_file_id)
-        self.assertIsInstance(mock_download_file.call_args[0][1], io.BufferedIOBase)
-        self.assertEqual(mock_download_file.call_args[0][1].name,
-                         os.path.join(dest_full_path, self.notebook_filename))
+        self.assertEqual(json.loads(response.body)['filename'], self.notebook_filename)
+        self.assertTrue(os.path.exists(os.path.join(dest_full_path, self.notebook_filename)))
         mock_chmod.assert_not_called()
 
     @mock.patch('nbsearch.v1.handlers.os.chmod')
@@ -186,18 +455,9 @@ class TestImportHandler(ApiHandlerTestCaseBase):
         dummy_doc = {
             'filename': self.notebook_filename,
         }
-        result = {
-            'response': {
-                'docs': [
-                    dummy_doc,
-                ],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
-        mock_query = mock.AsyncMock(return_value=(None, result))
+        mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
         mock_download_file = mock.AsyncMock()
-        self.mock_nbsearchdb().query.side_effect = mock_query
+        self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
         self.mock_nbsearchdb().download_file.side_effect = mock_download_file
 
         dest_path = 'nbsearch-tmp'
@@ -207,14 +467,12 @@ class TestImportHandler(ApiHandlerTestCaseBase):
         response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
         self.assertEqual(response.code, 200)
 
-        self.assertEqual(mock_query.call_count, 1)
-        self.assertEqual(mock_query.call_args[0][0], 'jupyter-notebook')
-        self.assertEqual(mock_query.call_args[0][1], 'id:"0123456789ab0123456789ab"')
+        self.assertEqual(mock_get_notebook_meta.call_count, 1)
+        self.assertEqual(mock_get_notebook_meta.call_args[0][0], self.notebook_file_id)
         self.assertEqual(mock_download_file.call_count, 1)
         self.assertEqual(mock_download_file.call_args[0][0], self.notebook_file_id)
-        self.assertIsInstance(mock_download_file.call_args[0][1], io.BufferedIOBase)
-        self.assertEqual(mock_download_file.call_args[0][1].name,
-                         os.path.join(dest_full_path, self.notebook_filename))
+        self.assertEqual(json.loads(response.body)['filename'], self.notebook_filename)
+        self.assertTrue(os.path.exists(os.path.join(dest_full_path, self.notebook_filename)))
         mock_chmod.assert_called_once()
         self.assertTrue(mock_chmod.call_args[0][0].endswith('/' + self.notebook_filename))
         self.assertEqual(mock_chmod.call_args[0][1], S_IREAD)
@@ -232,47 +490,28 @@ class TestImportHandler(ApiHandlerTestCaseBase):
         dummy_doc = {
             'filename': self.notebook_filename,
         }
-        result = {
-            'response': {
-                'docs': [
-                    dummy_doc,
-                ],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
         for dest_notebook_filename in dest_notebook_filenames:
-            mock_query = mock.AsyncMock(return_value=(None, result))
+            mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
             mock_download_file = mock.AsyncMock()
-            self.mock_nbsearchdb().query.side_effect = mock_query
+            self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
             self.mock_nbsearchdb().download_file.side_effect = mock_download_file
 
             response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
             self.assertEqual(response.code, 200)
 
-            self.assertEqual(mock_query.call_count, 1)
-            self.assertEqual(mock_query.call_args[0][0], 'jupyter-notebook')
-            self.assertEqual(mock_query.call_args[0][1], 'id:"0123456789ab0123456789ab"')
+            self.assertEqual(mock_get_notebook_meta.call_count, 1)
+            self.assertEqual(mock_get_notebook_meta.call_args[0][0], self.notebook_file_id)
             self.assertEqual(mock_download_file.call_count, 1)
-            self.assertEqual(mock_download_file.call_args[0][1].name,
-                             os.path.join(dest_full_path, dest_notebook_filename))
+            self.assertEqual(json.loads(response.body)['filename'], dest_notebook_filename)
+            self.assertTrue(os.path.exists(os.path.join(dest_full_path, dest_notebook_filename)))
 
     def test_import_to_nested_path(self):
         dummy_doc = {
             'filename': self.notebook_filename,
         }
-        result = {
-            'response': {
-                'docs': [
-                    dummy_doc,
-                ],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
-        mock_query = mock.AsyncMock(return_value=(None, result))
+        mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
         mock_download_file = mock.AsyncMock()
-        self.mock_nbsearchdb().query.side_effect = mock_query
+        self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
         self.mock_nbsearchdb().download_file.side_effect = mock_download_file
 
         dest_path = 'dest/a/b/c'
@@ -284,9 +523,8 @@ class TestImportHandler(ApiHandlerTestCaseBase):
 
         self.assertEqual(mock_download_file.call_count, 1)
         self.assertEqual(mock_download_file.call_args[0][0], self.notebook_file_id)
-        self.assertIsInstance(mock_download_file.call_args[0][1], io.BufferedIOBase)
-        self.assertEqual(mock_download_file.call_args[0][1].name,
-                         os.path.join(dest_full_path, self.notebook_filename))
+        self.assertEqual(json.loads(response.body)['filename'], self.notebook_filename)
+        self.assertTrue(os.path.exists(os.path.join(dest_full_path, self.notebook_filename)))
 
     def test_import_multiple_to_nested_path(self):
         dest_notebook_filenames = [
@@ -301,30 +539,97 @@ class TestImportHandler(ApiHandlerTestCaseBase):
         dummy_doc = {
             'filename': self.notebook_filename,
         }
-        result = {
-            'response': {
-                'docs': [
-                    dummy_doc,
-                ],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
         for dest_notebook_filename in dest_notebook_filenames:
-            mock_query = mock.AsyncMock(return_value=(None, result))
+            mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
             mock_download_file = mock.AsyncMock()
-            self.mock_nbsearchdb().query.side_effect = mock_query
+            self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
             self.mock_nbsearchdb().download_file.side_effect = mock_download_file
 
             response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
             self.assertEqual(response.code, 200)
 
-            self.assertEqual(mock_query.call_count, 1)
-            self.assertEqual(mock_query.call_args[0][0], 'jupyter-notebook')
-            self.assertEqual(mock_query.call_args[0][1], 'id:"0123456789ab0123456789ab"')
+            self.assertEqual(mock_get_notebook_meta.call_count, 1)
+            self.assertEqual(mock_get_notebook_meta.call_args[0][0], self.notebook_file_id)
             self.assertEqual(mock_download_file.call_count, 1)
-            self.assertEqual(mock_download_file.call_args[0][1].name,
-                             os.path.join(dest_full_path, dest_notebook_filename))
+            self.assertEqual(json.loads(response.body)['filename'], dest_notebook_filename)
+            self.assertTrue(os.path.exists(os.path.join(dest_full_path, dest_notebook_filename)))
+
+    def test_import_content(self):
+        mock_get_notebook_meta = mock.AsyncMock(return_value={
+            'filename': self.notebook_filename,
+        })
+
+        async def mock_download_file(file_id, f):
+            await f.write(b'{"cells": ')
+            await f.write(b'[]}')
+
+        self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
+        self.mock_nbsearchdb().download_file.side_effect = mock_download_file
+
+        dest_path = 'dest'
+        dest_full_path = os.path.join(self.base_dir, dest_path)
+        os.mkdir(dest_full_path)
+
+        response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(os.listdir(dest_full_path), [self.notebook_filename])
+        with open(os.path.join(dest_full_path, self.notebook_filename), 'rb') as f:
+            self.assertEqual(f.read(), b'{"cells": []}')
+
+    def test_import_mode(self):
+        mock_get_notebook_meta = mock.AsyncMock(return_value={
+            'filename': self.notebook_filename,
+        })
+
+        async def mock_download_file(file_id, f):
+            await f.write(b'{"cells": []}')
+
+        self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
+        self.mock_nbsearchdb().download_file.side_effect = mock_download_file
+
+        dest_path = 'dest'
+        dest_full_path = os.path.join(self.base_dir, dest_path)
+        os.mkdir(dest_full_path)
+
+        response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
+        self.assertEqual(response.code, 200)
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = os.stat(os.path.join(dest_full_path, self.notebook_filename)).st_mode
+        self.assertEqual(mode & 0o777, 0o666 & ~umask)
+
+    def test_import_download_failure(self):
+        mock_get_notebook_meta = mock.AsyncMock(return_value={
+            'filename': self.notebook_filename,
+        })
+
+        async def mock_download_file(file_id, f):
+            await f.write(b'{"cells": ')
+            raise ConnectionResetError()
+
+        self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
+        self.mock_nbsearchdb().download_file.side_effect = mock_download_file
+
+        dest_path = 'dest'
+        dest_full_path = os.path.join(self.base_dir, dest_path)
+        os.mkdir(dest_full_path)
+
+        response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
+        self.assertEqual(response.code, 500)
+        self.assertEqual(os.listdir(dest_full_path), [])
+
+    def test_import_not_found(self):
+        mock_get_notebook_meta = mock.AsyncMock(return_value=None)
+        self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
+        self.mock_nbsearchdb().download_file.side_effect = mock.AsyncMock()
+
+        dest_path = 'dest'
+        dest_full_path = os.path.join(self.base_dir, dest_path)
+        os.mkdir(dest_full_path)
+
+        response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
+        self.assertEqual(response.code, 404)
+        self.assertEqual(os.listdir(dest_full_path), [])
 
     def test_import_to_empty_path(self):
         response = self.fetch('/v1/import/{}/{}'.format('', self.notebook_file_id))
@@ -339,24 +644,15 @@ class TestImportHandler(ApiHandlerTestCaseBase):
         dummy_doc = {
             'filename': self.notebook_filename,
         }
-        result = {
-            'response': {
-                'docs': [
-                    dummy_doc,
-                ],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
         for dest_path in dest_paths:
-            mock_query = mock.AsyncMock(return_value=(None, result))
+            mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
             mock_download_file = mock.AsyncMock()
-            self.mock_nbsearchdb().query.side_effect = mock_query
+            self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
             self.mock_nbsearchdb().download_file.side_effect = mock_download_file
 
             response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
             self.assertEqual(response.code, 400)
-            self.assertEqual(mock_query.call_count, 1)
+            self.assertEqual(mock_get_notebook_meta.call_count, 0)
             self.assertEqual(mock_download_file.call_count, 0)
 
     def test_import_to_start_with_multiple_slashed_path(self):
@@ -367,27 +663,68 @@ class TestImportHandler(ApiHandlerTestCaseBase):
         dummy_doc = {
             'filename': self.notebook_filename,
         }
-        result = {
-            'response': {
-                'docs': [
-                    dummy_doc,
-                ],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
         for dest_path in dest_paths:
-            mock_query = mock.AsyncMock(return_value=(None, result))
+            mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
             mock_download_file = mock.AsyncMock()
-            self.mock_nbsearchdb().query.side_effect = mock_query
+            self.mock_nbsearchdb().get_notebook_meta.side_effect = mock_get_notebook_meta
             self.mock_nbsearchdb().download_file.side_effect = mock_download_file
 
             response = self.fetch('/v1/import/{}/{}'.format(dest_path, self.notebook_file_id))
             self.assertEqual(response.code, 400)
-            self.assertEqual(mock_query.call_count, 1)
+            self.assertEqual(mock_get_notebook_meta.call_count, 0)
             self.assertEqual(mock_download_file.call_count, 0)
 
 
+class TestBulkImportHandler(ApiHandlerTestCaseBase):
+
+    def test_bulk_import(self):
+        notebooks = {
+            'id1': {'id': 'id1', 'filename': 'a/notebook1.ipynb'},
+            'id2': {'id': 'id2', 'filename': 'b/notebook1.ipynb'},
+            'id3': {'id': 'id3', 'filename': 'notebook3.ipynb'},
+        }
+        mock_get_notebook_metas = mock.AsyncMock(return_value=notebooks)
+
+        async def mock_download_file(file_id, f):
+            if file_id == 'id3':
+                raise ConnectionResetError()
+            await f.write(file_id.encode('utf8'))
+
+        self.mock_nbsearchdb().get_notebook_metas = mock_get_notebook_metas
+        self.mock_nbsearchdb().get_notebook_meta = mock.AsyncMock()
+        self.mock_nbsearchdb().download_file = mock.AsyncMock(side_effect=mock_download_file)
+        self.mock_nbsearchdb().s3_max_concurrent_downloads = 2
+
+        dest_path = 'dest'
+        dest_full_path = os.path.join(self.base_dir, dest_path)
+        os.mkdir(dest_full_path)
+
+        response = self.fetch('/v1/import', method='POST', body=json.dumps({
+            'ids': ['id1', 'id2', 'id3', 'missing'],
+            'path': dest_path,
+        }))
+        self.assertEqual(response.code, 200)
+        results = json.loads(response.body)['results']
+        self.assertEqual([r['id'] for r in results], ['id1', 'id2', 'id3', 'missing'])
+        self.assertEqual(sorted([results[0]['filename'], results[1]['filename']]),
+                         ['notebook1 (1).ipynb', 'notebook1.ipynb'])
+        self.assertIn('error', results[2])
+        self.assertEqual(results[3]['error'], 'Not found')
+        self.assertEqual(sorted(os.listdir(dest_full_path)),
+                         ['notebook1 (1).ipynb', 'notebook1.ipynb'])
+        for result in results[:2]:
+            with open(os.path.join(dest_full_path, result['filename']), 'rb') as f:
+                self.assertEqual(f.read(), result['id'].encode('utf8'))
+        self.assertEqual(mock_get_notebook_metas.call_count, 1)
+        self.assertEqual(mock_get_notebook_metas.call_args[0][0], ['id1', 'id2', 'id3', 'missing'])
+        self.mock_nbsearchdb().get_notebook_meta.assert_not_called()
+
+    def test_bulk_import_invalid(self):
+        for body in ['invalid', json.dumps({'ids': 'id1'}), json.dumps({'ids': ['id1'], 'path': '../x'})]:
+            response = self.fetch('/v1/import', method='POST', body=body)
+            self.assertEqual(response.code, 400)
+
+
 class TestDataHandler(ApiHandlerTestCaseBase):
 
     def setUp(self):
@@ -418,23 +755,16 @@ class TestDataHandler(ApiHandlerTestCaseBase):
             'signature_server_url': 'http://test.server',
             'mtime': '2023-01-01T00:00:00Z'
         }
-        result = {
-            'response': {
-                'docs': [dummy_doc],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
 
-        # Mock the query and download_file methods
-        mock_query = mock.AsyncMock(return_value=(None, result))
+        # Mock the get_notebook_meta and download_file methods
+        mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
 
         def mock_download_file(file_id, file_obj):
             file_obj.write(notebook_json.encode('utf-8'))
             return mock.AsyncMock()
 
         mock_download = mock.AsyncMock(side_effect=mock_download_file)
-        self.mock_nbsearchdb().query = mock_query
+        self.mock_nbsearchdb().get_notebook_meta = mock_get_notebook_meta
         self.mock_nbsearchdb().download_file = mock_download
 
         response = self.fetch(f'/v1/data/{self.notebook_file_id}')
@@ -457,15 +787,9 @@ class TestDataHandler(ApiHandlerTestCaseBase):
         self.assertEqual(metadata['modified'], '2023-01-01T00:00:00Z')
 
     def test_data_not_found(self):
-        result = {
-            'response': {
-                'docs': [],
-                'numFound': 0,
-                'start': 0,
-            },
-        }
-        mock_query = mock.AsyncMock(return_value=(None, result))
-        self.mock_nbsearchdb().query = mock_query
+        mock_get_notebook_meta = mock.AsyncMock(return_value=None)
+        self.mock_nbsearchdb().get_notebook_meta = mock_get_notebook_meta
+        self.mock_nbsearchdb().download_file = mock.AsyncMock()
 
         response = self.fetch(f'/v1/data/{self.notebook_file_id}')
         self.assertEqual(response.code, 404)
@@ -474,27 +798,337 @@ class TestDataHandler(ApiHandlerTestCaseBase):
         dummy_doc = {
             'filename': self.notebook_filename,
         }
-        result = {
-            'response': {
-                'docs': [dummy_doc],
-                'numFound': 1,
-                'start': 0,
-            },
-        }
 
-        mock_query = mock.AsyncMock(return_value=(None, result))
+        mock_get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
 
         def mock_download_file(file_id, file_obj):
             file_obj.write(b'invalid json content')
             return mock.AsyncMock()
 
         mock_download = mock.AsyncMock(side_effect=mock_download_file)
-        self.mock_nbsearchdb().query = mock_query
+        self.mock_nbsearchdb().get_notebook_meta = mock_get_notebook_meta
         self.mock_nbsearchdb().download_file = mock_download
 
         response = self.fetch(f'/v1/data/{self.notebook_file_id}')
         self.assertEqual(response.code, 400)
 
+    def test_data_light(self):
+        notebook_data = {
+            "cells": [{"cell_type": "code", "source": ["1"], "outputs": []}],
+        }
+        self.mock_nbsearchdb().get_notebook_meta = mock.AsyncMock(return_value={
+            'filename': self.notebook_filename,
+        })
+        mock_download_light = mock.AsyncMock(return_value=notebook_data)
+        self.mock_nbsearchdb().download_light = mock_download_light
+        self.mock_nbsearchdb().download_file = mock.AsyncMock()
+
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}?variant=light')
+        self.assertEqual(response.code, 200)
+        response_data = json.loads(response.body.decode())
+        self.assertEqual(response_data['notebook'], notebook_data)
+        self.assertEqual(response_data['metadata']['filename'], 'test_notebook.ipynb')
+        self.assertEqual(mock_download_light.call_args[0][0], self.notebook_file_id)
+        self.mock_nbsearchdb().download_file.assert_not_called()
+
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}?variant=unknown')
+        self.assertEqual(response.code, 400)
+
+    def _mock_stream(self, chunks):
+        dummy_doc = {
+            'filename': self.notebook_filename,
+            'owner': 'test_user',
+        }
+        self.mock_nbsearchdb().get_notebook_meta = mock.AsyncMock(return_value=dummy_doc)
+        self.mock_nbsearchdb().download_file = mock.AsyncMock()
+
+        async def mock_stream_file(file_id):
+            for chunk in chunks:
+                yield chunk
+
+        self.mock_nbsearchdb().stream_file = mock_stream_file
+
+    def test_data_stream(self):
+        notebook_data = {
+            "cells": [],
+            "metadata": {"title": "\u30c6\u30b9\u30c8"},
+            "nbformat": 4,
+            "nbformat_minor": 4
+        }
+        notebook_bytes = json.dumps(notebook_data, ensure_ascii=False).encode('utf-8')
+        # Split in the middle of a multibyte character
+        split = notebook_bytes.index('\u30c6'.encode('utf-8')) + 1
+        self._mock_stream([notebook_bytes[:split], notebook_bytes[split:]])
+
+        for validate in ['false', 'true']:
+            response = self.fetch(f'/v1/data/{self.notebook_file_id}?stream=true&validate={validate}')
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.headers['Content-Type'], 'application/json')
+            response_data = json.loads(response.body.decode())
+            self.assertEqual(response_data['notebook'], notebook_data)
+            self.assertEqual(response_data['metadata']['filename'], 'test_notebook.ipynb')
+            self.assertEqual(response_data['metadata']['owner'], 'test_user')
+        self.mock_nbsearchdb().download_file.assert_not_called()
+
+    def test_data_stream_invalid(self):
+        self._mock_stream([b'invalid json content'])
+
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}?stream=true&validate=true')
+        self.assertEqual(response.code, 400)
+
+        self._mock_stream([b'{"cells": [}'])
+
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}?stream=true&validate=true')
+        self.assertEqual(response.code, 400)
+
+    def test_data_stream_invalid_after_start(self):
+        for chunks in [
+            [b'{"cells": [', b'}'],
+            [b'{"cells": [', b'\xff]}'],
+            [b'{"cells": [', b']'],
+        ]:
+            self._mock_stream(chunks)
+
+            # The connection is closed so that the client sees the truncated response
+            with self.assertRaises(HTTPClientError) as cm:
+                self.fetch(f'/v1/data/{self.notebook_file_id}?stream=true&validate=true')
+            self.assertEqual(cm.exception.code, 599)
+
+
+class TestCellsHandler(ApiHandlerTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.notebook_file_id = '0123456789ab0123456789ab'
+        self.notebook_filename = '/path/to/test_notebook.ipynb'
+
+    def test_cells(self):
+        cells = [{'cell_type': 'code', 'source': ['1']}]
+        self.mock_nbsearchdb().get_notebook_meta = mock.AsyncMock(return_value={
+            'filename': self.notebook_filename,
+        })
+        mock_download_cells = mock.AsyncMock(return_value=(cells, 10))
+        self.mock_nbsearchdb().download_cells = mock_download_cells
+
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}/cells?start=2&end=3')
+        self.assertEqual(response.code, 200)
+        response_data = json.loads(response.body.decode())
+        self.assertEqual(response_data['cells'], cells)
+        self.assertEqual(response_data['start'], 2)
+        self.assertEqual(response_data['end'], 3)
+        self.assertEqual(response_data['total'], 10)
+        self.assertEqual(response_data['metadata']['filename'], 'test_notebook.ipynb')
+        self.assertEqual(mock_download_cells.call_args[0], (self.notebook_file_id, 2, 3))
+
+    def test_cells_invalid_range(self):
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}/cells?start=x')
+        self.assertEqual(response.code, 400)
+
+    def test_cells_not_found(self):
+        self.mock_nbsearchdb().get_notebook_meta = mock.AsyncMock(return_value=None)
+        self.mock_nbsearchdb().download_cells = mock.AsyncMock(return_value=([], 0))
+
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}/cells')
+        self.assertEqual(response.code, 404)
+
+
+class TestSectionHandler(ApiHandlerTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.notebook_file_id = '0123456789ab0123456789ab'
+        self.cells = [
+            {'cell_type': 'markdown', 'source': ['# Section - 1']},
+            {'cell_type': 'code', 'source': ['print(1)'], 'outputs': [{'output_type': 'stream'}],
+             'metadata': {'lc_cell_meme': {'current': 'MEME_1'}}},
+            {'cell_type': 'code', 'source': ['print(2)'], 'outputs': [],
+             'metadata': {'lc_cell_meme': {'current': 'MEME_2'}}},
+            {'cell_type': 'markdown', 'source': ['# Section - 2']},
+            {'cell_type': 'code', 'source': ['print(3)'], 'outputs': []},
+        ]
+        self.mock_nbsearchdb().get_notebook_meta = mock.AsyncMock(return_value={
+            'filename': 'test_notebook.ipynb',
+        })
+        self.mock_nbsearchdb().get_parsed_notebook = mock.AsyncMock(return_value=(
+            {'cells': self.cells},
+            [(1, 1), None, None, (1, 1), None],
+        ))
+
+    def _fetch_cells(self, query):
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}/section?{query}')
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body.decode())['cells']
+
+    def test_section(self):
+        self.assertEqual(self._fetch_cells('meme=MEME_2'), self.cells[0:3])
+        self.assertEqual(self._fetch_cells('meme=MEME_2&range=before'), self.cells[0:3])
+        self.assertEqual(self._fetch_cells('meme=MEME_1&range=after'), self.cells[1:3])
+        self.assertEqual(self._fetch_cells('meme=MEME_1&scope=cell'), self.cells[1:2])
+        self.assertEqual(self._fetch_cells('meme=MEME_2&scope=notebook&range=after'), self.cells[2:])
+
+    def test_section_without_outputs(self):
+        cells = self._fetch_cells('meme=MEME_1&scope=cell&outputs=false')
+        self.assertEqual(cells[0]['outputs'], [])
+        self.assertEqual(cells[0]['source'], ['print(1)'])
+        # The cached notebook is not modified
+        self.assertEqual(len(self.cells[1]['outputs']), 1)
+
+    def test_section_not_found(self):
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}/section?meme=MEME_X')
+        self.assertEqual(response.code, 404)
+        response = self.fetch(f'/v1/data/{self.notebook_file_id}/section?meme=MEME_1&scope=x')
+        self.assertEqual(response.code, 400)
+
+
+class TestDiffHandler(ApiHandlerTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.left_cells = [
+            {'cell_type': 'code', 'source': ['print(1)'], 'outputs': [],
+             'metadata': {'lc_cell_meme': {'current': 'MEME_1'}}},
+            {'cell_type': 'code', 'source': ['print(2)'], 'outputs': [],
+             'metadata': {'lc_cell_meme': {'current': 'MEME_2'}}},
+        ]
+        self.mock_nbsearchdb().get_notebook_meta = mock.AsyncMock(return_value={
+            'filename': 'test_notebook.ipynb',
+        })
+        self.mock_nbsearchdb().get_parsed_notebook = mock.AsyncMock(return_value=(
+            {'cells': self.left_cells}, [None, None],
+        ))
+
+    def test_diff_with_local_notebook(self):
+        right_cells = [
+            self.left_cells[0],
+            dict(self.left_cells[1], outputs=[{'output_type': 'stream'}]),
+        ]
+        with open(os.path.join(self.base_dir, 'right.ipynb'), 'w') as f:
+            json.dump({'cells': right_cells}, f)
+        response = self.fetch('/v1/diff?left=nb1&right=' + quote('/right.ipynb'))
+        self.assertEqual(response.code, 200)
+        resp = json.loads(response.body.decode())
+        self.assertEqual(resp['left']['metadata']['id'], 'nb1')
+        self.assertEqual(resp['right']['metadata'], {'path': '/right.ipynb'})
+        self.assertEqual([(h['op'], h['left']['start'], h['right']['start']) for h in resp['hunks']],
+                         [('replace', 1, 1)])
+        self.assertEqual(resp['hunks'][0]['right']['cells'], right_cells[1:])
+
+        response = self.fetch('/v1/diff?left=nb1&right=' + quote('/right.ipynb') + '&outputs=false')
+        self.assertEqual(json.loads(response.body.decode())['hunks'], [])
+
+    def test_diff_invalid_path(self):
+        response = self.fetch('/v1/diff?left=nb1&right=' + quote('/../right.ipynb'))
+        self.assertEqual(response.code, 400)
+        response = self.fetch('/v1/diff?left=nb1&right=' + quote('/missing.ipynb'))
+        self.assertEqual(response.code, 404)
+
+
+class TestMetricsHandler(ApiHandlerTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = NBSearchDB()
+        self.mock_nbsearchdb().metrics = self.db.metrics
+
+    def test_metrics(self):
+        result = {
+            'response': {'docs': [], 'numFound': 0, 'start': 0},
+        }
+        self.mock_nbsearchdb().query = mock.AsyncMock(return_value=('_text_:*', result))
+        response = self.fetch('/v1/cell/search?query=' + quote('_text_:*'))
+        self.assertEqual(response.code, 200)
+        response = self.fetch('/v1/cell/search')
+        self.assertEqual(response.code, 400)
+
+        registry = self.db.metrics.registry
+        self.assertEqual(registry.get_sample_value('nbsearch_request_duration_seconds_count', {
+            'endpoint': 'search', 'method': 'GET', 'code': '200',
+        }), 1)
+        self.assertEqual(registry.get_sample_value('nbsearch_request_duration_seconds_count', {
+            'endpoint': 'search', 'method': 'GET', 'code': '400',
+        }), 1)
+        self.assertEqual(registry.get_sample_value('nbsearch_requests_in_flight', {'endpoint': 'search'}), 0)
+        self.assertGreater(registry.get_sample_value('nbsearch_response_size_bytes_sum', {'endpoint': 'search'}), 0)
+
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        body = response.body.decode('utf8')
+        self.assertIn('nbsearch_request_duration_seconds_bucket{code="200",endpoint="search"', body)
+        self.assertIn('nbsearch_cache_hits_total{cache="notebook_meta"} 0.0', body)
+
+
+class TestRequestTrace(ApiHandlerTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = NBSearchDB()
+        self.mock_nbsearchdb().metrics = self.db.metrics
+
+        async def query(core, query, **kwargs):
+            # Observed in the context of the request as NBSearchDB does
+            self.db.metrics.observe_solr('query', 0.25)
+            trace = current_trace()
+            trace.queries.append({
+                'core': core, 'query': query, 'rows': kwargs['rows'],
+                'start': kwargs['start'], 'sort': kwargs['sort'], 'qtime': 200,
+            })
+            return query, {'response': {'docs': [], 'numFound': 0, 'start': 0}}
+
+        self.mock_nbsearchdb().query = mock.AsyncMock(side_effect=query)
+
+    def test_server_timing(self):
+        response = self.fetch('/v1/cell/search?query=' + quote('_text_:secret'))
+        self.assertEqual(response.code, 200)
+        timings = dict([entry.split(';dur=') for entry in response.headers['Server-Timing'].split(', ')])
+        self.assertEqual(list(timings.keys()), ['solr', 's3', 'serialize', 'total'])
+        self.assertEqual(float(timings['solr']), 250.0)
+        self.assertEqual(float(timings['s3']), 0.0)
+
+        response = self.fetch('/v1/cell/search')
+        self.assertEqual(response.code, 400)
+        self.assertIn('Server-Timing', response.headers)
+
+    def test_slow_query_log(self):
+        self.mock_nbsearchdb().slow_query_threshold = 10.0
+        with self.assertNoLogs(level='WARNING'):
+            self.fetch('/v1/cell/search?query=' + quote('_text_:secret'))
+
+        self.mock_nbsearchdb().slow_query_threshold = 0.000001
+        with self.assertLogs(level='WARNING') as logs:
+            self.fetch('/v1/cell/search?query=' + quote('_text_:secret') + '&sort=' + quote('mtime desc'))
+        messages = [r.getMessage() for r in logs.records if 'slow query' in r.getMessage()]
+        self.assertEqual(len(messages), 1)
+        record = json.loads(messages[0].split('nbsearch slow query: ')[1])
+        self.assertEqual(record['endpoint'], 'search')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['response_bytes'], 0)
+        self.assertEqual(record['solr_ms'], 250.0)
+        self.assertEqual(record['queries'], [{
+            'core': 'jupyter-cell', 'query': '_text_:?', 'rows': 50, 'start': 0,
+            'sort': 'mtime desc', 'qtime_ms': 200,
+        }])
+
+    def test_slow_query_log_export(self):
+        async def export(core, query, **kwargs):
+            current_trace().queries.append({
+                'core': core, 'query': query, 'rows': 1000, 'start': None,
+                'sort': 'id asc', 'qtime': 300, 'pages': 3,
+            })
+            yield [{'id': 'a'}]
+
+        self.mock_nbsearchdb().export = export
+        self.mock_nbsearchdb().slow_query_threshold = 0.000001
+        with self.assertLogs(level='WARNING') as logs:
+            self.fetch('/v1/cell/export?query=' + quote('owner:alice'))
+        messages = [r.getMessage() for r in logs.records if 'slow query' in r.getMessage()]
+        record = json.loads(messages[0].split('nbsearch slow query: ')[1])
+        self.assertEqual(record['endpoint'], 'export')
+        self.assertEqual(record['queries'], [{
+            'core': 'jupyter-cell', 'query': 'owner:?', 'rows': 1000, 'start': None,
+            'sort': 'id asc', 'qtime_ms': 300, 'pages': 3,
+        }])
+
 
 if __name__ == '__main__':
     unittest.main()
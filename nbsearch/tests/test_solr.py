@@ -1,4 +1,16 @@
-from nbsearch.solr import cell_to_solr_document
+from collections import Counter
+import os
+import re
+import unittest
+import xml.etree.ElementTree as ET
+
+from nbsearch.solr import (
+    cell_to_solr_document, diff_cells, find_cell_by_meme, find_section, get_heading_levels,
+    has_compact_copy_fields, ipynb_to_documents, notebook_to_solr_document, _add_field, _join_field,
+)
+
+
+SOLR_CONF_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'solr')
 
 
 def test_cell_to_solr_document():
@@ -422,3 +434,163 @@ def test_cell_to_solr_document_memes():
     )
     assert doc['lc_cell_memes__next__in_section'] == ''
     assert doc['lc_cell_memes__previous__in_section'] == 'CURRENT_METADATA_2 CURRENT_METADATA_3'
+
+
+def test_cell_to_solr_document_positions():
+    sources = ['Preface', '# Section - 1', 'a = 1', '## Subsection', 'b = 2', 'c = 3',
+               '# Section - 2', 'd = 4', '### Deep', 'e = 5']
+    cells = [
+        {
+            'cell_type': 'markdown' if source[0] in 'P#' else 'code',
+            'source': [source],
+            'metadata': {'lc_cell_meme': {'current': f'MEME_{i}'}},
+        }
+        for i, source in enumerate(sources)
+    ]
+    lists = [cell_to_solr_document('NOTEBOOK_ID', 'path/to/notebook', cell, i, cells=cells)
+             for i, cell in enumerate(cells)]
+    positions = [cell_to_solr_document('NOTEBOOK_ID', 'path/to/notebook', cell, i, cells=cells,
+                                       meme_encoding='positions')
+                 for i, cell in enumerate(cells)]
+    assert 'lc_cell_memes__next__in_notebook' not in positions[0]
+    # The ranges used by NBSearchDB.resolve_meme_neighborhoods select the same cells as the lists
+    for a in range(len(cells)):
+        meme = f'MEME_{a}'
+        for doc, pos in zip(lists, positions):
+            c = pos['index']
+            assert (meme in doc['lc_cell_memes__previous__in_notebook'].split()) == (c > a)
+            assert (meme in doc['lc_cell_memes__next__in_notebook'].split()) == (c < a)
+            assert (meme in doc['lc_cell_memes__previous__in_section'].split()) == \
+                (c > a and pos['lc_cell_position__section_beginning'] <= a)
+            assert (meme in doc['lc_cell_memes__next__in_section'].split()) == \
+                (c < a and pos['lc_cell_position__section_ending'] > a)
+
+
+def test_find_section():
+    cells = [
+        {'cell_type': 'markdown', 'source': ['Preface']},
+        {'cell_type': 'markdown', 'source': ['# Section - 1'],
+         'metadata': {'lc_cell_meme': {'current': 'MEME_1'}}},
+        {'cell_type': 'code', 'source': ['# Python Code'],
+         'metadata': {'lc_cell_meme': {'current': 'MEME_2'}}},
+        {'cell_type': 'markdown', 'source': ['## Section - 1-1']},
+        {'cell_type': 'code', 'source': ['print(1)'],
+         'metadata': {'lc_cell_meme': {'current': 'MEME_4'}}},
+        {'cell_type': 'markdown', 'source': ['# Section - 2']},
+        {'cell_type': 'code', 'source': ['print(2)']},
+    ]
+    headings = get_heading_levels(cells)
+    assert headings == [None, (1, 1), None, (2, 2), None, (1, 1), None]
+    assert find_cell_by_meme(cells, 'MEME_2') == 2
+    assert find_cell_by_meme(cells, 'MEME_X') is None
+    assert find_section(headings, 2) == (1, 5)
+    assert find_section(headings, 1) == (1, 5)
+    assert find_section(headings, 4) == (3, 5)
+    assert find_section(headings, 6) == (5, 7)
+
+
+def test_diff_cells():
+    left = [
+        {'cell_type': 'code', 'source': ['a = 1'], 'metadata': {'lc_cell_meme': {'current': 'MEME_1'}}},
+        {'cell_type': 'code', 'source': ['b = 2'], 'metadata': {'lc_cell_meme': {'current': 'MEME_2'}}},
+        {'cell_type': 'markdown', 'source': ['# Notes']},
+        {'cell_type': 'code', 'source': ['c = 3'], 'metadata': {'lc_cell_meme': {'current': 'MEME_3'}}},
+    ]
+    right = [
+        {'cell_type': 'code', 'source': ['a = 1'],
+         'metadata': {'lc_cell_meme': {'current': 'MEME_1', 'next': 'MEME_X'}}},
+        {'cell_type': 'code', 'source': ['x = 0'], 'metadata': {'lc_cell_meme': {'current': 'MEME_X'}}},
+        {'cell_type': 'code', 'source': ['b = 20'], 'metadata': {'lc_cell_meme': {'current': 'MEME_2'}}},
+        {'cell_type': 'markdown', 'source': '# Notes'},
+    ]
+    hunks = diff_cells(left, right)
+    assert [(h['op'], h['left']['start'], h['left']['end'], h['right']['start'], h['right']['end'])
+            for h in hunks] == [
+        ('insert', 1, 1, 1, 2),
+        ('replace', 1, 2, 2, 3),
+        ('delete', 3, 4, 4, 4),
+    ]
+    assert hunks[1]['right']['cells'] == [right[2]]
+    assert diff_cells(left, left) == []
+
+
+def _copy_fields(core):
+    schema = ET.parse(os.path.join(SOLR_CONF_DIR, core, 'conf', 'schema.xml'))
+    return [(rule.get('source'), rule.get('dest')) for rule in schema.getroot().iter('copyField')]
+
+
+def _apply_copy_fields(doc, copy_fields):
+    """Expand the document in the same way as copyField rules of the schema"""
+    expanded = dict([(k, [v]) for k, v in doc.items()])
+    for source, dest in copy_fields:
+        if source in doc:
+            expanded.setdefault(dest, []).append(doc[source])
+    return expanded
+
+
+def _terms(values):
+    # Term frequencies matter for ranking
+    return Counter(re.findall(r'\w+', '\n'.join([str(v) for v in values])))
+
+
+@unittest.skipIf(not os.path.isdir(SOLR_CONF_DIR), 'Solr configurations are not available')
+def test_compact_documents_match_schema():
+    notebook_data = {
+        'cells': [
+            {'cell_type': 'markdown', 'source': ['# Setup\n', 'Install *pandas*']},
+            {'cell_type': 'code', 'source': ['import pandas\n', 'print(pandas.__version__)'],
+             'outputs': [{'output_type': 'stream', 'name': 'stdout', 'text': ['2.0.0\n']},
+                         {'output_type': 'execute_result', 'data': {'text/plain': ['OK']}}]},
+            {'cell_type': 'code', 'source': ['x = 1'], 'outputs': []},
+            {'cell_type': 'raw'},
+        ],
+    }
+    attr = {'owner': 'alice', 'mtime': '2024-01-01T00:00:00Z'}
+    documents = {
+        False: ipynb_to_documents('path/to/notebook.ipynb', notebook_data, attr=attr),
+        True: ipynb_to_documents('path/to/notebook.ipynb', notebook_data, attr=attr, compact=True),
+    }
+    for core in ['jupyter-cell', 'jupyter-notebook']:
+        # The schemas before compact documents had no copyField rules
+        baseline_copy_fields = []
+        shipped_copy_fields = _copy_fields(core)
+        # NBSearchDB sends compact documents only to cores with the rules
+        assert not has_compact_copy_fields(core, baseline_copy_fields)
+        assert has_compact_copy_fields(core, shipped_copy_fields)
+        baseline_docs = [_apply_copy_fields(doc, baseline_copy_fields) for doc in documents[False][core]]
+        for copy_fields in [baseline_copy_fields, shipped_copy_fields]:
+            compact = has_compact_copy_fields(core, copy_fields)
+            for baseline_doc, doc in zip(baseline_docs, documents[compact][core]):
+                if compact:
+                    assert 'source' not in doc and 'outputs' not in doc
+                expanded = _apply_copy_fields(doc, copy_fields)
+                # Every field is indexed with the same terms and frequencies as the baseline
+                for k in set(expanded.keys()) | set(baseline_doc.keys()):
+                    assert _terms(expanded.get(k, [])) == _terms(baseline_doc.get(k, [])), (core, k)
+        # Legacy documents would index every text twice in the shipped schema
+        doubled = _apply_copy_fields(documents[False][core][0], shipped_copy_fields)
+        assert _terms(doubled['_text_']) != _terms(baseline_docs[0]['_text_'])
+
+
+def test_notebook_document_folded_from_cells():
+    for texts in [[], [''], ['', 'a', '', 'b'], ['a', ''], ['', '']]:
+        fields = {}
+        for text in texts:
+            _add_field(fields, 'f', text)
+        assert _join_field(texts) == fields.get('f', '')
+
+    notebook_data = {
+        'cells': [
+            {'cell_type': 'markdown', 'source': ['# Title\n', 'See [docs](https://example.com)'],
+             'metadata': {'lc_cell_meme': {'current': 'MEME_1'}}},
+            {'cell_type': 'code', 'source': [''], 'outputs': [],
+             'metadata': {'lc_cell_meme': {'current': 'MEME_2', 'execution_end_time': '2024-01-02T00:00:00Z'}}},
+            {'cell_type': 'code', 'source': ['print(1)'],
+             'outputs': [{'output_type': 'stream', 'name': 'stdout', 'text': ['1\n']}]},
+        ],
+    }
+    docs = ipynb_to_documents('path/to/notebook.ipynb', notebook_data)
+    standalone = notebook_to_solr_document('path/to/notebook.ipynb', notebook_data)
+    assert list(docs['jupyter-notebook'][0].items()) == list(standalone.items())
+    assert standalone['source'] == '# Title\nSee [docs](https://example.com)\n\nprint(1)'
+    assert standalone['lc_cell_meme__execution_end_time'] == '2024-01-02T00:00:00Z'
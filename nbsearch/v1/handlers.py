@@ -1,35 +1,377 @@
+import asyncio
+import codecs
 from datetime import datetime
+from functools import partial
 import json
 import os
+import re
 from stat import S_IREAD
+import tempfile
+import threading
+import time
 
 from jupyter_server.base.handlers import APIHandler
 from tornado import web
 import tornado.escape
 import tornado.ioloop
 import tornado.web
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .. import solr
+from ..db import normalize_query
+from ..metrics import start_trace
 
 
 NBSEARCH_TMP = 'nbsearch-tmp'
 
+_import_lock = threading.Lock()
+
+# os.umask can only be read by replacing it, which is done once while importing the module
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+FILTER_FIELDS = {
+    'notebook': ['owner', 'server', 'signature_server_url'],
+    'cell': ['notebook_owner', 'notebook_server', 'cell_type', 'notebook_id'],
+}
+
+RANGE_FIELDS = {
+    'notebook': ['mtime', 'atime', 'ctime', 'lc_cell_meme__execution_end_time'],
+    'cell': ['notebook_mtime', 'notebook_atime', 'notebook_ctime', 'estimated_mtime',
+             'lc_cell_meme__execution_end_time'],
+}
+
+GROUP_FIELDS = {
+    'cell': {
+        'notebook': 'notebook_id',
+    },
+}
+
+RANGE_VALUE_PATTERN = re.compile(r'^[0-9A-Za-z:.+\-/]+$')
+
+
+def _get_filters(handler, target):
+    filters = {}
+    for field in FILTER_FIELDS.get(target, []):
+        values = handler.get_query_arguments(field)
+        if len(values) > 0:
+            filters[field] = values
+    ranges = {}
+    for field in RANGE_FIELDS.get(target, []):
+        range_from = handler.get_query_argument(f'{field}_from', None)
+        range_to = handler.get_query_argument(f'{field}_to', None)
+        if range_from is None and range_to is None:
+            continue
+        for value in [range_from, range_to]:
+            if value is not None and not RANGE_VALUE_PATTERN.match(value):
+                raise tornado.web.HTTPError(400, f'Invalid range for {field}: {value}')
+        ranges[field] = (range_from, range_to)
+    return filters, ranges
+
+
+async def _get_notebook_meta(db, id, pending):
+    """Resolve metadata of the notebook while `pending` (e.g. the download) is running"""
+    # Retrieve the result of the pending task so that an abandoned failure is not reported
+    pending.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        notebook = await db.get_notebook_meta(id)
+    except:
+        pending.cancel()
+        raise
+    if notebook is None:
+        pending.cancel()
+        raise tornado.web.HTTPError(404)
+    return notebook
+
+
+def _get_metadata(id, notebook):
+    _, filename = os.path.split(notebook['filename'])
+    return {
+        'id': id,
+        'filename': filename,
+        'original_path': notebook['filename'],
+        'owner': notebook.get('owner'),
+        'server': notebook.get('signature_server_url'),
+        'modified': notebook.get('mtime')
+    }
+
+
+class _ExecutorWriter(object):
+    """Binary file wrapper whose writes run in the thread pool, not to block the event loop"""
+
+    def __init__(self, f):
+        self.f = f
+
+    async def write(self, data):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.f.write, data)
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_STRING_CHARS = re.compile(r'[^"\\\x00-\x1f]*')
+_JSON_ESCAPE = re.compile(r'\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})')
+_JSON_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+_JSON_TOKEN = re.compile(r'[0-9A-Za-z.+\-]*')
+_JSON_LITERALS = ['true', 'false', 'null']
+
+
+class _JSONValidator(object):
+    """Incremental syntax check of a JSON object fed in chunks of text
+
+    Only the nesting of the containers and the incomplete token at the end of
+    a chunk are kept, so the whole document is never buffered.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.expect = 'value'
+        self.in_string = False
+        self.pending = ''
+        self.offset = 0
+
+    def feed(self, text, final=False):
+        text = self.pending + text
+        self.pending = ''
+        pos = 0
+        while pos < len(text):
+            if self.in_string:
+                pos = _JSON_STRING_CHARS.match(text, pos).end()
+                if pos == len(text):
+                    break
+                c = text[pos]
+                if c == '"':
+                    self.in_string = False
+                    pos += 1
+                    self._end_token()
+                elif c == '\\':
+                    m = _JSON_ESCAPE.match(text, pos)
+                    if m is None:
+                        if not final and len(text) - pos < 6:
+                            break
+                        self._error('invalid escape in string', pos)
+                    pos = m.end()
+                else:
+                    self._error('control character in string', pos)
+                continue
+            pos = _JSON_WHITESPACE.match(text, pos).end()
+            if pos == len(text):
+                break
+            c = text[pos]
+            if c in '{[':
+                self._start_value(pos, c)
+                self.stack.append(c)
+                self.expect = 'key_or_close' if c == '{' else 'value_or_close'
+                pos += 1
+            elif c in '}]':
+                opening = '{' if c == '}' else '['
+                if len(self.stack) == 0 or self.stack[-1] != opening or \
+                        self.expect not in ['comma_or_close', 'key_or_close', 'value_or_close']:
+                    self._error(f'unexpected {c}', pos)
+                self.stack.pop()
+                pos += 1
+                self._end_value()
+            elif c == ':':
+                if self.expect != 'colon':
+                    self._error('unexpected :', pos)
+                self.expect = 'value'
+                pos += 1
+            elif c == ',':
+                if self.expect != 'comma_or_close':
+                    self._error('unexpected ,', pos)
+                self.expect = 'key' if self.stack[-1] == '{' else 'value'
+                pos += 1
+            elif c == '"':
+                if self.expect in ['key', 'key_or_close']:
+                    self.expect = 'key_string'
+                else:
+                    self._start_value(pos, c)
+                self.in_string = True
+                pos += 1
+            else:
+                end = _JSON_TOKEN.match(text, pos).end()
+                if end == len(text) and not final:
+                    # The number or the literal may continue in the next chunk
+                    break
+                token = text[pos:end]
+                if token not in _JSON_LITERALS and not _JSON_NUMBER.fullmatch(token):
+                    self._error('invalid value', pos)
+                self._start_value(pos, c)
+                pos = end
+                self._end_value()
+        self.pending = text[pos:]
+        self.offset += pos
+        if final:
+            if self.in_string or len(self.stack) > 0 or self.expect != 'end':
+                self._error('unexpected end of notebook', 0)
+
+    def _start_value(self, pos, c):
+        if self.expect not in ['value', 'value_or_close']:
+            self._error(f'unexpected {c}', pos)
+        if len(self.stack) == 0 and c != '{':
+            raise ValueError('notebook is not a JSON object')
+
+    def _end_token(self):
+        if self.expect == 'key_string':
+            self.expect = 'colon'
+        else:
+            self._end_value()
+
+    def _end_value(self):
+        self.expect = 'comma_or_close' if len(self.stack) > 0 else 'end'
+
+    def _error(self, reason, pos):
+        raise ValueError(f'{reason} at offset {self.offset + pos}')
+
+
+async def _prepend(first, chunks):
+    try:
+        chunk = await first
+    except StopAsyncIteration:
+        return
+    yield chunk
+    async for chunk in chunks:
+        yield chunk
+
+
+class BaseHandler(APIHandler):
+    """Base of the API handlers, recording the latency and size of each response to the metrics
+
+    The time spent in Solr, S3 and serialization is sent as the Server-Timing header,
+    slow requests are logged with their Solr queries, and requests are profiled as
+    configured by NBSearchDB.profile_*.
+    """
+
+    endpoint = None
 
-class SearchHandler(APIHandler):
     def initialize(self, db, base_dir):
         self.db = db
+        self.base_dir = base_dir
+        self._response_size = 0
+        self._request_finished = False
+        self.db.metrics.request_started(self.endpoint)
+        self._profile = self.db.start_request_profile()
+        self._trace = None
+
+    def prepare(self):
+        self._trace = start_trace()
+        return super().prepare()
+
+    def write(self, chunk):
+        started = time.perf_counter()
+        super().write(chunk)
+        if self._trace is not None:
+            self._trace.add('serialize', time.perf_counter() - started)
+
+    def flush(self, include_footers=False):
+        if not self._headers_written and self._trace is not None:
+            self.set_header('Server-Timing', self._trace.server_timing(self.request.request_time()))
+        self._response_size += sum([len(chunk) for chunk in self._write_buffer])
+        return super().flush(include_footers)
+
+    def on_finish(self):
+        self._finish_request()
+        super().on_finish()
+
+    def on_connection_close(self):
+        self._finish_request()
+        super().on_connection_close()
+
+    def _finish_request(self):
+        if self._request_finished:
+            return
+        self._request_finished = True
+        self.db.metrics.request_finished(
+            self.endpoint, self.request.method, self.get_status(),
+            self.request.request_time(), self._response_size,
+        )
+        threshold = self.db.slow_query_threshold
+        if threshold > 0 and self.request.request_time() >= threshold:
+            self._log_slow_request()
+        if self._profile is None:
+            return
+        try:
+            path = self.db.finish_request_profile(
+                self._profile, f'{self.endpoint}-{self.request.method}-{self.get_status()}',
+                self.request.request_time(),
+            )
+        except Exception:
+            self.log.exception('failed to write the profile')
+            return
+        if path is not None:
+            self.log.info(f'profile of {self.request.method} {self.request.uri}: {path}')
+
+    def _log_slow_request(self):
+        trace = self._trace
+        record = {
+            'endpoint': self.endpoint,
+            'method': self.request.method,
+            'path': self.request.path,
+            'status': self.get_status(),
+            'duration_ms': round(self.request.request_time() * 1000, 1),
+            'response_bytes': self._response_size,
+        }
+        if trace is not None:
+            record.update([(f'{name}_ms', round(duration * 1000, 1))
+                           for name, duration in trace.durations.items()])
+            record['queries'] = []
+            for q in trace.queries:
+                query = {
+                    'core': q['core'],
+                    'query': normalize_query(q['query']),
+                    'rows': q['rows'],
+                    'start': q['start'],
+                    'sort': q['sort'],
+                    'qtime_ms': q['qtime'],
+                }
+                if 'pages' in q:
+                    # Exports summarize all their cursor pages in one entry
+                    query['pages'] = q['pages']
+                record['queries'].append(query)
+        self.log.warning('nbsearch slow query: ' + json.dumps(record, ensure_ascii=False))
+
+
+class SearchHandler(BaseHandler):
+    endpoint = 'search'
 
     @web.authenticated
     async def get(self, target):
+        resp = await self._search(
+            target,
+            sort=self.get_query_argument('sort', None),
+            group_by=self.get_query_argument('group_by', None),
+        )
+        self.write(resp)
+        self._prefetch(target, resp)
+
+    async def _search(self, target, sort=None, group_by=None):
         start, limit = self._get_page()
-        sort = self.get_query_argument('sort', None)
         query = self.get_query_argument('query')
         q_op = self.get_query_argument('q_op', 'AND')
+        filters, ranges = _get_filters(self, target)
+        collapse = None
+        expand_rows = None
+        if group_by is not None:
+            if group_by not in GROUP_FIELDS.get(target, {}):
+                raise tornado.web.HTTPError(400, f'Unsupported group_by for {target}: {group_by}')
+            collapse = GROUP_FIELDS[target][group_by]
+            group_limit = self.get_query_argument('group_limit', '3')
+            try:
+                expand_rows = int(group_limit) - 1
+            except ValueError:
+                raise tornado.web.HTTPError(400, f'Invalid group_limit: {group_limit}')
+            if expand_rows < 0:
+                raise tornado.web.HTTPError(400, f'Invalid group_limit: {group_limit}')
         solrquery, result = await self.db.query(
             f'jupyter-{target}',
             query,
             q_op=q_op,
             start=start,
             rows=limit,
-            sort=sort
+            sort=sort,
+            filters=filters,
+            ranges=ranges,
+            collapse=collapse,
+            expand_rows=expand_rows,
         )
         resp = {
             '{}s'.format(target): result['response']['docs'] if 'response' in result else None,
@@ -41,7 +383,39 @@ class SearchHandler(APIHandler):
             'solrquery': solrquery,
             'error': result['error'] if 'error' in result else None,
         }
-        self.write(resp)
+        if collapse is not None:
+            resp['group_by'] = group_by
+            resp['groups'] = self._get_groups(result, collapse)
+        return resp
+
+    def _get_groups(self, result, collapse):
+        if 'response' not in result:
+            return None
+        expanded = result.get('expanded', {})
+        groups = []
+        for doc in result['response']['docs']:
+            key = doc.get(collapse)
+            others = expanded.get(key, {'numFound': 0, 'docs': []})
+            groups.append({
+                'value': key,
+                'numFound': others['numFound'] + 1,
+                'docs': [doc] + others['docs'],
+            })
+        return groups
+
+    def _prefetch(self, target, resp):
+        docs = resp['{}s'.format(target)] or []
+        key = 'id' if target == 'notebook' else 'notebook_id'
+        notebook_ids = []
+        for doc in docs:
+            if key in doc and doc[key] not in notebook_ids:
+                notebook_ids.append(doc[key])
+        user = self.current_user
+        if isinstance(user, dict):
+            user = user.get('name')
+        else:
+            user = getattr(user, 'username', user)
+        self.db.prefetch(notebook_ids, user=user, log=self.log)
 
     def _get_page(self):
         start = self.get_query_argument('start', '0')
@@ -49,10 +423,77 @@ class SearchHandler(APIHandler):
         return int(start), int(limit)
 
 
-class ImportHandler(APIHandler):
-    def initialize(self, db, base_dir):
-        self.db = db
-        self.base_dir = base_dir
+class CombinedSearchHandler(SearchHandler):
+    endpoint = 'combined_search'
+
+    @web.authenticated
+    async def get(self):
+        """
+        Search notebooks and cells concurrently with a single query
+        """
+        started = time.perf_counter()
+        targets = ['notebook', 'cell']
+        results = await asyncio.gather(*[
+            self._timed_search(
+                target,
+                sort=self.get_query_argument(f'{target}_sort', None),
+                group_by=self.get_query_argument('group_by', None) if target == 'cell' else None,
+            )
+            for target in targets
+        ])
+        resp = dict([(target, r) for target, (r, _) in zip(targets, results)])
+        resp['timings'] = dict([(target, elapsed) for target, (_, elapsed) in zip(targets, results)])
+        resp['timings']['total'] = (time.perf_counter() - started) * 1000
+        self.write(resp)
+        for target in targets:
+            self._prefetch(target, resp[target])
+
+    async def _timed_search(self, target, **kwargs):
+        started = time.perf_counter()
+        resp = await self._search(target, **kwargs)
+        return resp, (time.perf_counter() - started) * 1000
+
+
+class ExportHandler(BaseHandler):
+    endpoint = 'export'
+
+    @web.authenticated
+    async def get(self, target):
+        """
+        Stream all matched documents as NDJSON
+        """
+        query = self.get_query_argument('query')
+        q_op = self.get_query_argument('q_op', 'AND')
+        sort = self.get_query_argument('sort', None)
+        fl = self.get_query_argument('fl', None)
+        filters, ranges = _get_filters(self, target)
+        self.set_header('Content-Type', 'application/x-ndjson')
+        started = False
+        try:
+            async for docs in self.db.export(
+                f'jupyter-{target}',
+                query,
+                q_op=q_op,
+                sort=sort,
+                fl=fl,
+                filters=filters,
+                ranges=ranges,
+            ):
+                for doc in docs:
+                    self.write(json.dumps(doc, ensure_ascii=False) + '\n')
+                await self.flush()
+                started = True
+        except Exception:
+            if started:
+                # The status has already been sent; close the connection so that
+                # the client sees a truncated export instead of a finished one
+                self.request.connection.close()
+            raise
+        await self.finish(set_content_type='application/x-ndjson')
+
+
+class ImportHandler(BaseHandler):
+    endpoint = 'import'
 
     def _has_special(self, path):
         if path == '/' or path == '':
@@ -65,74 +506,148 @@ class ImportHandler(APIHandler):
         return self._has_special(parent)
 
     def _unique_filename(self, path, filename):
-        if not os.path.exists(os.path.join(self.base_dir, path, filename)):
+        # List the directory once instead of checking each candidate
+        existing = set(os.listdir(os.path.join(self.base_dir, path)))
+        if filename not in existing:
             return filename
         base_filename, ext = os.path.splitext(filename)
         index = 1
         alt_filename = '{} ({}){}'.format(base_filename, index, ext)
-        while os.path.exists(os.path.join(self.base_dir, path, alt_filename)):
+        while alt_filename in existing:
             index += 1
             alt_filename = '{} ({}){}'.format(base_filename, index, ext)
         return alt_filename
 
-    @web.authenticated
-    async def get(self, path, id):
-        solrquery, result = await self.db.query(
-            'jupyter-notebook',
-            f'id:"{id}"',
-        )
-        docs = result['response']['docs']
-        if len(docs) == 0:
-            raise tornado.web.HTTPError(404)
-        notebook = docs[0]
-        _, filename = os.path.split(notebook['filename'])
+    def _move_into(self, path, filename, temp_path):
+        # Concurrent imports into the same directory must not choose the same filename
+        with _import_lock:
+            filename = self._unique_filename(path, filename)
+            os.replace(temp_path, os.path.join(self.base_dir, path, filename))
+        return filename
+
+    def _normalize_path(self, path):
         if path is not None and path.startswith('/'):
             path = path[1:]
         if path is not None and path.startswith('/'):
             raise tornado.web.HTTPError(400)
         if path is not None and self._has_special(path):
             raise tornado.web.HTTPError(400)
-        path = path if path is not None else '.'
-        filename = self._unique_filename(path, filename)
+        return path if path is not None else '.'
+
+    @web.authenticated
+    async def get(self, path, id):
+        path = self._normalize_path(path)
+        filename = await self._import(path, id)
+        self.write({'filename': filename})
+
+    async def _import(self, path, id, notebook=None):
+        loop = asyncio.get_running_loop()
         to_tmp = False
         if path == NBSEARCH_TMP:
-            os.makedirs(os.path.join(self.base_dir, NBSEARCH_TMP),
-                        exist_ok=True)
+            await loop.run_in_executor(None, partial(
+                os.makedirs, os.path.join(self.base_dir, NBSEARCH_TMP), exist_ok=True,
+            ))
             to_tmp = True
-        full_path = os.path.join(self.base_dir, path, filename)
-        with open(full_path, 'wb') as f:
-            await self.db.download_file(id, f)
+        # Download into a hidden file while the filename is resolved from Solr,
+        # then move it into place so that a failure never leaves a partial notebook
+        f = await loop.run_in_executor(None, partial(
+            tempfile.NamedTemporaryFile, dir=os.path.join(self.base_dir, path),
+            prefix='.nbsearch-', suffix='.tmp', delete=False,
+        ))
+        try:
+            try:
+                # NamedTemporaryFile is created with 0600; imported notebooks follow the umask as before
+                await loop.run_in_executor(None, os.fchmod, f.fileno(), 0o666 & ~_UMASK)
+                download = asyncio.ensure_future(self.db.download_file(id, _ExecutorWriter(f)))
+                if notebook is None:
+                    notebook = await _get_notebook_meta(self.db, id, download)
+                await download
+            finally:
+                await loop.run_in_executor(None, f.close)
+            _, filename = os.path.split(notebook['filename'])
+            filename = await loop.run_in_executor(None, self._move_into, path, filename, f.name)
+            full_path = os.path.join(self.base_dir, path, filename)
+        except:
+            if os.path.exists(f.name):
+                os.remove(f.name)
+            raise
         if to_tmp:
             os.chmod(full_path, S_IREAD)
-        self.write({'filename': filename})
+        return filename
 
 
-class DataHandler(APIHandler):
-    def initialize(self, db, base_dir):
-        self.db = db
-        self.base_dir = base_dir
+class BulkImportHandler(ImportHandler):
+    endpoint = 'bulk_import'
+
+    @web.authenticated
+    async def post(self):
+        """
+        Import multiple notebooks into the path in parallel
+        """
+        try:
+            body = json.loads(self.request.body)
+        except json.JSONDecodeError:
+            raise tornado.web.HTTPError(400, 'Invalid JSON')
+        ids = body.get('ids') if isinstance(body, dict) else None
+        if not isinstance(ids, list) or not all([isinstance(id, str) for id in ids]):
+            raise tornado.web.HTTPError(400, 'ids must be a list of notebook ids')
+        path = self._normalize_path(body.get('path') or None)
+        notebooks = await self.db.get_notebook_metas(ids)
+        semaphore = asyncio.Semaphore(self.db.s3_max_concurrent_downloads)
+        results = await asyncio.gather(*[
+            self._import_with_result(semaphore, path, id, notebooks.get(id))
+            for id in ids
+        ])
+        self.write({'results': results})
+
+    async def _import_with_result(self, semaphore, path, id, notebook):
+        if notebook is None:
+            return {'id': id, 'error': 'Not found'}
+        try:
+            async with semaphore:
+                filename = await self._import(path, id, notebook=notebook)
+            return {'id': id, 'filename': filename}
+        except Exception as e:
+            self.log.exception(f'failed to import {id}')
+            return {'id': id, 'error': str(e) or type(e).__name__}
+
+
+class DataHandler(BaseHandler):
+    endpoint = 'data'
 
     @web.authenticated
     async def get(self, id):
         """
         Get notebook data as JSON response without saving to disk
         """
-        solrquery, result = await self.db.query(
-            'jupyter-notebook',
-            f'id:"{id}"',
-        )
-        docs = result['response']['docs']
-        if len(docs) == 0:
-            raise tornado.web.HTTPError(404)
+        variant = self.get_query_argument('variant', 'full')
+        if variant not in ['full', 'light']:
+            raise tornado.web.HTTPError(400, f'Invalid variant: {variant}')
+        if variant == 'light':
+            download = asyncio.ensure_future(self.db.download_light(id))
+            notebook = await _get_notebook_meta(self.db, id, download)
+            self.write({
+                'notebook': await download,
+                'metadata': _get_metadata(id, notebook),
+            })
+            return
 
-        notebook = docs[0]
+        if self.get_query_argument('stream', 'false') == 'true':
+            validate = self.get_query_argument('validate', 'false') == 'true'
+            chunks = self.db.stream_file(id)
+            first_chunk = asyncio.ensure_future(chunks.__anext__())
+            notebook = await _get_notebook_meta(self.db, id, first_chunk)
+            await self._stream(id, notebook, _prepend(first_chunk, chunks), validate)
+            return
 
         # Create a temporary file-like object to capture the notebook data
         from io import BytesIO
         notebook_data = BytesIO()
 
-        # Download notebook data to memory
-        await self.db.download_file(id, notebook_data)
+        # Download notebook data to memory while the metadata is resolved
+        download = asyncio.ensure_future(self.db.download_file(id, notebook_data))
+        notebook = await _get_notebook_meta(self.db, id, download)
+        await download
 
         # Get the raw notebook content
         notebook_data.seek(0)
@@ -143,20 +658,188 @@ class DataHandler(APIHandler):
             notebook_json = json.loads(notebook_content.decode('utf-8'))
 
             # Add metadata from Solr
-            _, filename = os.path.split(notebook['filename'])
             response = {
                 'notebook': notebook_json,
-                'metadata': {
-                    'id': id,
-                    'filename': filename,
-                    'original_path': notebook['filename'],
-                    'owner': notebook.get('owner'),
-                    'server': notebook.get('signature_server_url'),
-                    'modified': notebook.get('mtime')
-                }
+                'metadata': _get_metadata(id, notebook),
             }
 
             self.write(response)
 
         except (json.JSONDecodeError, UnicodeDecodeError) as e:
             raise tornado.web.HTTPError(400, f"Invalid notebook format: {str(e)}")
+
+    async def _stream(self, id, notebook, chunks, validate):
+        # Write the metadata envelope and pass the stored notebook bytes through unchanged
+        decoder = codecs.getincrementaldecoder('utf-8')() if validate else None
+        validator = _JSONValidator() if validate else None
+        started = False
+        self.set_header('Content-Type', 'application/json')
+        async for chunk in chunks:
+            if validate:
+                try:
+                    validator.feed(decoder.decode(chunk))
+                except ValueError as e:
+                    # UnicodeDecodeError is also a ValueError
+                    self._invalid_stream(started, str(e))
+            if not started:
+                metadata = json.dumps({'metadata': _get_metadata(id, notebook)})
+                self.write(metadata[:-1] + ', "notebook": ')
+                started = True
+            self.write(chunk)
+            await self.flush()
+        if not started:
+            self._invalid_stream(started, 'notebook is empty')
+        if validate:
+            try:
+                validator.feed(decoder.decode(b'', final=True), final=True)
+            except ValueError as e:
+                self._invalid_stream(started, str(e))
+        self.write('}')
+        await self.finish()
+
+    def _invalid_stream(self, started, reason):
+        if started:
+            # The status has already been sent; close the connection so that
+            # the client sees a truncated response instead of a finished one
+            self.request.connection.close()
+            raise IOError(f'Invalid notebook format: {reason}')
+        raise tornado.web.HTTPError(400, f"Invalid notebook format: {reason}")
+
+
+class CellsHandler(BaseHandler):
+    endpoint = 'cells'
+
+    @web.authenticated
+    async def get(self, id):
+        """
+        Get a window of cells of the notebook without downloading the whole notebook
+        """
+        start = self._get_index('start')
+        end = self._get_index('end')
+        download = asyncio.ensure_future(self.db.download_cells(id, start, end))
+        notebook = await _get_notebook_meta(self.db, id, download)
+        cells, total = await download
+        start, end, _ = slice(start, end).indices(total)
+        self.write({
+            'cells': cells,
+            'start': start,
+            'end': max(start, end),
+            'total': total,
+            'metadata': _get_metadata(id, notebook),
+        })
+
+    def _get_index(self, name):
+        value = self.get_query_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, f'Invalid {name}: {value}')
+
+
+class SectionHandler(BaseHandler):
+    endpoint = 'section'
+
+    @web.authenticated
+    async def get(self, id):
+        """
+        Get the cells around the cell with the MEME, selected in the same way as magic search
+        """
+        meme = self.get_query_argument('meme')
+        scope = self.get_query_argument('scope', 'section')
+        range_ = self.get_query_argument('range', 'all')
+        outputs = self.get_query_argument('outputs', 'true') == 'true'
+        if scope not in ['cell', 'section', 'notebook']:
+            raise tornado.web.HTTPError(400, f'Invalid scope: {scope}')
+        if range_ not in ['before', 'after', 'all']:
+            raise tornado.web.HTTPError(400, f'Invalid range: {range_}')
+        download = asyncio.ensure_future(self.db.get_parsed_notebook(id))
+        notebook = await _get_notebook_meta(self.db, id, download)
+        notebook_data, heading_levels = await download
+        cells = notebook_data.get('cells', [])
+        index = solr.find_cell_by_meme(cells, meme)
+        if index is None:
+            raise tornado.web.HTTPError(404, f'Cell not found: {meme}')
+        if scope == 'cell':
+            start, end = index, index + 1
+        elif scope == 'section':
+            start, end = solr.find_section(heading_levels, index)
+        else:
+            start, end = 0, len(cells)
+        if range_ == 'before':
+            end = index + 1
+        elif range_ == 'after':
+            start = index
+        selected = cells[start:end]
+        if not outputs:
+            selected = [dict(cell, outputs=[]) if 'outputs' in cell else cell
+                        for cell in selected]
+        self.write({
+            'cells': selected,
+            'index': index,
+            'start': start,
+            'end': end,
+            'metadata': _get_metadata(id, notebook),
+        })
+
+
+class DiffHandler(BaseHandler):
+    endpoint = 'diff'
+
+    @web.authenticated
+    async def get(self):
+        """
+        Get the changed hunks between two notebooks, the right one can be a local path starting with /
+        """
+        outputs = self.get_query_argument('outputs', 'true') == 'true'
+        (left_data, left_metadata), (right_data, right_metadata) = await asyncio.gather(
+            self._load(self.get_query_argument('left')),
+            self._load(self.get_query_argument('right')),
+        )
+        left_cells = left_data.get('cells', [])
+        right_cells = right_data.get('cells', [])
+        if not outputs:
+            left_cells, right_cells = [
+                [dict(cell, outputs=[]) if 'outputs' in cell else cell for cell in cells]
+                for cells in [left_cells, right_cells]
+            ]
+        self.write({
+            'hunks': solr.diff_cells(left_cells, right_cells),
+            'left': {'metadata': left_metadata, 'size': len(left_cells)},
+            'right': {'metadata': right_metadata, 'size': len(right_cells)},
+        })
+
+    async def _load(self, value):
+        if value.startswith('/'):
+            loop = asyncio.get_running_loop()
+            notebook_data = await loop.run_in_executor(None, self._read_local, value)
+            return notebook_data, {'path': value}
+        download = asyncio.ensure_future(self.db.get_parsed_notebook(value))
+        notebook = await _get_notebook_meta(self.db, value, download)
+        notebook_data, _ = await download
+        return notebook_data, _get_metadata(value, notebook)
+
+    def _read_local(self, path):
+        base_dir = os.path.realpath(self.base_dir)
+        local_path = os.path.realpath(os.path.join(base_dir, path.lstrip('/')))
+        if not local_path.startswith(base_dir + os.sep):
+            raise tornado.web.HTTPError(400, f'Invalid path: {path}')
+        if not os.path.isfile(local_path):
+            raise tornado.web.HTTPError(404, f'Notebook not found: {path}')
+        try:
+            with open(local_path, 'r', encoding='utf8') as f:
+                return json.load(f)
+        except ValueError:
+            raise tornado.web.HTTPError(400, f'Invalid notebook: {path}')
+
+
+class MetricsHandler(BaseHandler):
+    endpoint = 'metrics'
+
+    @web.authenticated
+    async def get(self):
+        """
+        Get the metrics in the Prometheus text format
+        """
+        await self.finish(self.db.metrics.generate(), set_content_type=CONTENT_TYPE_LATEST)